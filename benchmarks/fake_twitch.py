@@ -0,0 +1,107 @@
+"""A fake twitch API, for load testing the twitch poller without sending thousands of requests to twitch
+It answers /kraken/streams/?channel=a,b,c the same way twitch does, with some of those channels live
+Channels go live and offline at random, and responses can be slowed down or fail, to see how the poller copes
+
+To load test the bot with it:
+    python3 benchmarks/fake_twitch.py seed [channels] [db_path]
+        Saves that many members with twitch notifications on, into a memory backend at db_path (fake_twitch.db)
+    python3 benchmarks/fake_twitch.py [port] [live] [flap] [latency_ms] [failures]
+        Runs the API on port (8080), with live (0.1) of the channels live to start with, each channel going
+        live/offline with a chance of flap (0.01) every time it's checked, every response taking latency_ms (50)
+        And failures (0.0) of the responses being a 500 error
+
+Then run the bot with these in config.yml, the poller's cycle time and channels per second are shown in dbstats
+    db_backend: 'memory'
+    db_path: 'fake_twitch.db'
+    twitch_api_url: 'http://localhost:8080/kraken'"""
+import asyncio
+import os
+import random
+import sys
+import time
+
+from aiohttp import web
+
+
+class FakeTwitch:
+    def __init__(self, live, flap, latency, failures):
+        self.live_chance = live
+        self.flap = flap
+        self.latency = latency
+        self.failures = failures
+        # channel: whether they're live
+        self.channels = {}
+
+        self.requests = 0
+        self.checked = 0
+        self.errors = 0
+        self.largest_batch = 0
+        self.started = time.monotonic()
+
+    def is_live(self, channel):
+        if channel not in self.channels:
+            self.channels[channel] = random.random() < self.live_chance
+        elif random.random() < self.flap:
+            self.channels[channel] = not self.channels[channel]
+        return self.channels[channel]
+
+    async def streams(self, request):
+        await asyncio.sleep(self.latency)
+        self.requests += 1
+        if random.random() < self.failures:
+            self.errors += 1
+            return web.json_response({'error': 'Internal Server Error', 'status': 500}, status=500)
+
+        channels = [c for c in request.GET.get('channel', '').lower().split(',') if c]
+        self.checked += len(channels)
+        self.largest_batch = max(self.largest_batch, len(channels))
+        streams = [{'_id': i, 'channel': {'name': channel, 'display_name': channel}}
+                   for i, channel in enumerate(channels) if self.is_live(channel)]
+        return web.json_response({'_total': len(streams), 'streams': streams})
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(10)
+            elapsed = time.monotonic() - self.started
+            print("{} requests ({:.1f}/s), {} channels checked ({:.1f}/s), largest batch {}, {} errors, {} live".format(
+                self.requests, self.requests / elapsed, self.checked, self.checked / elapsed, self.largest_batch,
+                self.errors, sum(self.channels.values())))
+
+
+async def seed(count, path):
+    # The memory backend doesn't need the config, so it's imported on its own instead of through cogs.utils
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cogs', 'utils'))
+    from backends.memory import MemoryBackend
+
+    backend = MemoryBackend(path)
+    await backend.connect()
+    await backend.ensure({'twitch': 'member_id'}, {'twitch': {'notifications_on': ['notifications_on']}})
+    # No servers are given, so the bot checks every channel but never has anywhere to send a notification
+    await backend.bulk_insert('twitch', [{'member_id': str(100000000000000000 + i),
+                                          'twitch_url': 'https://www.twitch.tv/fake_channel_{}'.format(i),
+                                          'servers': [],
+                                          'notifications_on': 1,
+                                          'live': 0} for i in range(count)])
+    await backend.close()
+    print("Saved {} twitch channels into {}".format(count, path))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'seed':
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+        path = sys.argv[3] if len(sys.argv) > 3 else 'fake_twitch.db'
+        asyncio.get_event_loop().run_until_complete(seed(count, path))
+        sys.exit()
+
+    args = sys.argv[1:]
+    port = int(args[0]) if len(args) > 0 else 8080
+    fake = FakeTwitch(live=float(args[1]) if len(args) > 1 else 0.1,
+                      flap=float(args[2]) if len(args) > 2 else 0.01,
+                      latency=(float(args[3]) if len(args) > 3 else 50) / 1000,
+                      failures=float(args[4]) if len(args) > 4 else 0.0)
+
+    app = web.Application()
+    app.router.add_route('GET', '/kraken/streams/', fake.streams)
+    app.router.add_route('GET', '/kraken/streams', fake.streams)
+    asyncio.get_event_loop().create_task(fake.report())
+    web.run_app(app, port=port)
@@ -0,0 +1,113 @@
+"""Compares looking up a server's prefix and custom permissions the way the bot used to, to the way it does now
+The old way scanned every server's settings in the cache (and made new Permissions every time a check was ran)
+The new way is the bot's own config.command_prefix, and the check made by checks.custom_perms
+
+This needs the bot's requirements installed, but not a database or a config file (a temporary one is used)
+Run it with: python3 benchmarks/settings_lookup.py [servers]"""
+import os
+import random
+import sys
+import tempfile
+import timeit
+
+# cogs.utils reads config.yml from the directory it's imported from, so give it one that uses the memory backend
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp())
+with open('config.yml', 'w') as f:
+    f.write("bot_token: 'benchmark'\nowner_id: []\ndb_backend: 'memory'\n")
+
+import discord  # noqa: E402
+
+from cogs.utils import checks, config  # noqa: E402
+
+servers = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+lookups = 10000
+
+# Build up some settings that look like what is saved, about half the servers have a custom prefix and permissions
+documents = {}
+for i in range(servers):
+    entry = {'server_id': str(100000000000000000 + i)}
+    if i % 2:
+        entry['prefix'] = '?'
+        entry['permissions'] = {'play': 8, 'skip': 4}
+    documents[entry['server_id']] = entry
+# This is what the changefeed fills in when the bot is running
+config.cache['server_settings'].documents = documents
+
+
+class Stub:
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+channel = Stub(is_private=False)
+author = Stub(permissions_in=lambda channel: discord.Permissions.all())
+command = Stub(qualified_name='play')
+contexts = [Stub(message=Stub(server=Stub(id=random.choice(list(documents))), channel=channel, author=author),
+                 command=command) for _ in range(lookups)]
+messages = [ctx.message for ctx in contexts]
+
+
+def old_command_prefix(bot, message):
+    # config.command_prefix, as it was before the cache was keyed by server ID
+    try:
+        prefixes = config.cache['server_settings'].values
+        prefix = [x for x in prefixes if x['server_id'] == message.server.id][0]['prefix']
+        return prefix or config.default_prefix
+    except (KeyError, TypeError, IndexError, AttributeError):
+        return config.default_prefix
+
+
+def old_custom_perms(**perms):
+    # checks.custom_perms, as it was before the cache was keyed by server ID
+    def predicate(ctx):
+        if ctx.message.channel.is_private:
+            return True
+
+        member_perms = ctx.message.author.permissions_in(ctx.message.channel)
+        required_perm = discord.Permissions.none()
+        for perm, setting in perms.items():
+            setattr(required_perm, perm, setting)
+
+        try:
+            server_settings = config.cache.get('server_settings').values
+            required_perm_value = [x for x in server_settings if x['server_id'] == ctx.message.server.id][0][
+                'permissions'][ctx.command.qualified_name]
+            required_perm = discord.Permissions(required_perm_value)
+        except (TypeError, IndexError, KeyError):
+            pass
+
+        return member_perms >= required_perm
+
+    return predicate
+
+
+def check_predicate(check):
+    # commands.check adds the predicate to whatever it decorates, so decorate something to get it back
+    def command():
+        pass
+
+    check(command)
+    return command.__commands_checks__[0]
+
+
+def run(func, args):
+    def loop():
+        for arg in args:
+            func(arg)
+
+    return min(timeit.repeat(loop, number=1, repeat=3)) / lookups * 1000000
+
+
+if __name__ == '__main__':
+    print("{} servers, {} lookups each (best of 3)".format(servers, lookups))
+    benchmarks = [
+        ('prefix', lambda m: old_command_prefix(None, m), lambda m: config.command_prefix(None, m), messages),
+        ('permissions', old_custom_perms(send_messages=True), check_predicate(checks.custom_perms(send_messages=True)),
+         contexts)
+    ]
+    for name, old, new, args in benchmarks:
+        old_time = run(old, args)
+        new_time = run(new, args)
+        print("{:<12} old: {:>10.3f}us  new: {:>8.3f}us  ({:.0f}x faster)".format(
+            name, old_time, new_time, old_time / new_time))
@@ -41,39 +41,24 @@ async def on_message(message):
 
 @bot.event
 async def on_command_completion(command, ctx):
-    # There's no reason to continue waiting for this to complete, so lets immediately launch this in a new future
-    bot.loop.create_task(process_command(ctx))
-
-
-async def process_command(ctx):
-    author = ctx.message.author
+    # Usage is counted in memory and saved in batches, so there's nothing here that we need to wait on
     server = ctx.message.server
-    command = ctx.command
-
-    command_usage = await utils.get_content('command_usage', key=command.qualified_name)
-    if command_usage is None:
-        command_usage = {'command': command.qualified_name}
-
-    # Add one to the total usage for this command, basing it off 0 to start with (obviously)
-    total_usage = command_usage.get('total_usage', 0) + 1
-    command_usage['total_usage'] = total_usage
+    utils.usage_buffer.record(command.qualified_name, ctx.message.author.id, server.id if server else None)
 
-    # Add one to the author's usage for this command
-    total_member_usage = command_usage.get('member_usage', {})
-    member_usage = total_member_usage.get(author.id, 0) + 1
-    total_member_usage[author.id] = member_usage
-    command_usage['member_usage'] = total_member_usage
 
-    # Add one to the server's usage for this command
-    if ctx.message.server is not None:
-        total_server_usage = command_usage.get('server_usage', {})
-        server_usage = total_server_usage.get(server.id, 0) + 1
-        total_server_usage[server.id] = server_usage
-        command_usage['server_usage'] = total_server_usage
-
-    # Save all the changes
-    if not await utils.update_content('command_usage', command_usage, command.qualified_name):
-        await utils.add_content('command_usage', command_usage)
+async def shutdown():
+    # Stop the background jobs first, so nothing new is started while we're shutting down
+    utils.scheduler.close()
+    # Make sure anything that is still waiting to be saved makes it to the database before we exit
+    try:
+        await utils.usage_buffer.close()
+    finally:
+        for value in utils.cache.values():
+            value.close()
+        utils.write_journal.close()
+        await utils.backend.close()
+        # Every cog shares this client, so it's only closed once they're all done with it
+        await utils.http_client.close()
 
 
 @bot.event
@@ -126,4 +111,11 @@ if __name__ == '__main__':
 
     for e in utils.extensions:
         bot.load_extension(e)
-    bot.run(utils.bot_token)
+
+    try:
+        bot.loop.run_until_complete(bot.start(utils.bot_token))
+    except KeyboardInterrupt:
+        bot.loop.run_until_complete(bot.logout())
+    finally:
+        bot.loop.run_until_complete(shutdown())
+        bot.loop.close()
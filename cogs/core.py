@@ -111,17 +111,20 @@ class Core:
         EXAMPLE: !motd
         RESULT: 'This is an example message of the day!'"""
         if date is None:
-            motd = await utils.get_content('motd')
-            try:
-                # Lets set this to the first one in the list first
-                latest_motd = motd[0]
-                for entry in motd:
+            # We only need the newest entry, so just go through them as they come instead of loading them all
+            latest_motd = None
+            latest_date = None
+            # This closes the cursor even if we stop partway through, such as a date that can't be parsed
+            async with utils.iter_content('motd') as entries:
+                async for entry in entries:
                     d = pendulum.parse(entry['date'])
 
                     # Check if the date for this entry is newer than our currently saved latest entry
-                    if d > pendulum.parse(latest_motd['date']):
+                    if latest_date is None or d > latest_date:
                         latest_motd = entry
+                        latest_date = d
 
+            try:
                 date = latest_motd['date']
                 motd = latest_motd['motd']
             # This will be hit if we do not have any entries for motd
@@ -1,5 +1,5 @@
 from .utils import config
-import aiohttp
+from .utils.http_client import http_client
 import logging
 import json
 
@@ -14,10 +14,6 @@ class StatsUpdate:
 
     def __init__(self, bot):
         self.bot = bot
-        self.session = aiohttp.ClientSession()
-
-    def __unload(self):
-        self.bot.loop.create_task(self.session.close())
 
     async def update(self):
         # Currently disabled
@@ -33,7 +29,7 @@ class StatsUpdate:
             'servercount': server_count
         }
 
-        async with self.session.post(carbonitex_url, data=carbon_payload) as resp:
+        async with http_client.post(carbonitex_url, data=carbon_payload) as resp:
             log.info('Carbonitex statistics returned {} for {}'.format(resp.status, carbon_payload))
 
         payload = json.dumps({
@@ -46,7 +42,7 @@ class StatsUpdate:
         }
 
         url = '{}/bots/{}/stats'.format(discord_bots_url, self.bot.user.id)
-        async with self.session.post(url, data=payload, headers=headers) as resp:
+        async with http_client.post(url, data=payload, headers=headers) as resp:
             log.info('bots.discord.pw statistics returned {} for {}'.format(resp.status, payload))
 
     async def on_server_join(self, server):
@@ -3,6 +3,7 @@ from discord.ext.commands.cooldowns import BucketType
 
 from . import utils
 
+from io import BytesIO
 import discord
 import random
 
@@ -138,11 +139,14 @@ class Interaction:
             if file is None:
                 await self.bot.say(url)
             else:
-                if '.gif' in url:
-                    filename = 'avatar.gif'
-                else:
-                    filename = 'avatar.webp'
-                    file = utils.convert_to_jpeg(file)
+                with file:
+                    if '.gif' in url:
+                        filename = 'avatar.gif'
+                        # The upload needs a real file object, which the downloaded file isn't
+                        file = BytesIO(file.read())
+                    else:
+                        filename = 'avatar.webp'
+                        file = utils.convert_to_jpeg(file)
                 await self.bot.upload(file, filename=filename)
         else:
             await self.bot.say(url)
@@ -259,19 +263,14 @@ class Interaction:
             return
 
         key = booper.id
-        boops = await utils.get_content('boops', key)
-        if boops is not None:
-            boops = boops['boops']
-            # If the booper has never booped the member provided, assure it's 0
-            amount = boops.get(boopee.id, 0) + 1
-            boops[boopee.id] = amount
-
-            await utils.update_content('boops', {'boops': boops}, key)
-        else:
-            entry = {'member_id': booper.id,
-                     'boops': {boopee.id: 1}}
-
-            await utils.add_content('boops', entry)
+        entry = {'boops': {boopee.id: 1}}
+
+        # If the booper has booped before, add one to the amount of times they've booped this member
+        # (assuring it's 0 if they haven't booped them before) and let the database do the math
+        boops = await utils.upsert_content('boops', key, entry, increment=True, return_changes=True)
+        try:
+            amount = boops['boops'][boopee.id]
+        except (TypeError, KeyError):
             amount = 1
 
         fmt = "{0.mention} has just booped {1.mention}{3}! That's {2} times now!"
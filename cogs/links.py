@@ -83,7 +83,8 @@ class Links:
                   'type': 'video',
                   'q': query}
 
-        data = await utils.request(url, payload=params)
+        # The same searches come up a lot, and the results don't change much, so we can cache them for a while
+        data = await utils.request(url, payload=params, cache_ttl=3600)
 
         if data is None:
             await self.bot.send_message(ctx.message.channel, "Sorry but I failed to connect to youtube!")
@@ -116,7 +117,7 @@ class Links:
                   "format": "json",
                   "srsearch": query}
 
-        data = await utils.request(base_url, payload=params)
+        data = await utils.request(base_url, payload=params, cache_ttl=3600)
 
         if data is None:
             await self.bot.send_message(ctx.message.channel, "Sorry but I failed to connect to Wikipedia!")
@@ -149,7 +150,7 @@ class Links:
         url = "http://api.urbandictionary.com/v0/define"
         params = {"term": msg}
         try:
-            data = await utils.request(url, payload=params)
+            data = await utils.request(url, payload=params, cache_ttl=3600)
             if data is None:
                 await self.bot.send_message(ctx.message.channel, "Sorry but I failed to connect to urban dictionary!")
                 return
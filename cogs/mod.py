@@ -5,7 +5,6 @@ from . import utils
 import discord
 import re
 import asyncio
-import rethinkdb as r
 
 valid_perms = [p for p in dir(discord.Permissions) if isinstance(getattr(discord.Permissions, p), property)]
 
@@ -131,10 +130,8 @@ class Mod:
             return
 
         key = ctx.message.server.id
-        entry = {'server_id': key,
-                 'notification_channel': channel.id}
-        if not await utils.update_content('server_settings', entry, key):
-            await utils.add_content('server_settings', entry)
+        entry = {'notification_channel': channel.id}
+        await utils.upsert_content('server_settings', key, entry)
         await self.bot.say("I have just changed this server's 'notifications' channel"
                            "\nAll notifications will now go to `{}`".format(channel))
 
@@ -150,10 +147,8 @@ class Mod:
         # When mod logging becomes available, that will be kept to it's own channel if wanted as well
         on_off = True if re.search("(on|yes|true)", on_off.lower()) else False
         key = ctx.message.server.id
-        entry = {'server_id': key,
-                 'join_leave': on_off}
-        if not await utils.update_content('server_settings', entry, key):
-            await utils.add_content('server_settings', entry)
+        entry = {'join_leave': on_off}
+        await utils.upsert_content('server_settings', key, entry)
 
         fmt = "notify" if on_off else "not notify"
         await self.bot.say("This server will now {} if someone has joined or left".format(fmt))
@@ -170,17 +165,7 @@ class Mod:
         EXAMPLE: !nsfw add
         RESULT: ;)"""
         key = ctx.message.server.id
-        entry = {'server_id': key,
-                 'nsfw_channels': [ctx.message.channel.id]}
-        update = {'nsfw_channels': r.row['nsfw_channels'].append(ctx.message.channel.id)}
-
-        server_settings = await utils.get_content('server_settings', key)
-        if server_settings and 'nsfw_channels' in server_settings.keys():
-            await utils.update_content('server_settings', update, key)
-        elif server_settings:
-            await utils.update_content('server_settings', entry, key)
-        else:
-            await utils.add_content('server_settings', entry)
+        await utils.append_content('server_settings', key, 'nsfw_channels', ctx.message.channel.id)
 
         await self.bot.say("This channel has just been registered as 'nsfw'! Have fun you naughties ;)")
 
@@ -192,7 +177,8 @@ class Mod:
         RESULT: ;("""
 
         key = ctx.message.server.id
-        server_settings = await utils.get_content('server_settings', key)
+        # This is read from the primary, as what we read is written straight back
+        server_settings = await utils.get_content('server_settings', key, primary=True)
         channel = ctx.message.channel.id
         try:
             channels = server_settings['nsfw_channels']
@@ -327,11 +313,9 @@ class Mod:
                 return
 
         key = ctx.message.server.id
-        entry = {'server_id': key,
-                 'permissions': {cmd.qualified_name: perm_value}}
+        entry = {'permissions': {cmd.qualified_name: perm_value}}
 
-        if not await utils.update_content('server_settings', entry, key):
-            await utils.add_content('server_settings', entry)
+        await utils.upsert_content('server_settings', key, entry)
 
         await self.bot.say("I have just added your custom permissions; "
                            "you now need to have `{}` permissions to use the command `{}`".format(permissions, command))
@@ -366,11 +350,9 @@ class Mod:
         if prefix.lower().strip() == "none":
             prefix = None
 
-        entry = {'server_id': key,
-                 'prefix': prefix}
+        entry = {'prefix': prefix}
 
-        if not await utils.update_content('server_settings', entry, key):
-            await utils.add_content('server_settings', entry)
+        await utils.upsert_content('server_settings', key, entry)
 
         if prefix is None:
             fmt = "I have just cleared your custom prefix, the default prefix will have to be used now"
@@ -496,17 +478,7 @@ class Mod:
         EXAMPLE: !rules add No fun allowed in this server >:c
         RESULT: No more fun...unless they break the rules!"""
         key = ctx.message.server.id
-        entry = {'server_id': key,
-                 'rules': [rule]}
-        update = {'rules': r.row['rules'].append(rule)}
-
-        server_settings = await utils.get_content('server_settings', key)
-        if server_settings and 'rules' in server_settings.keys():
-            await utils.update_content('server_settings', update, key)
-        elif server_settings:
-            await utils.update_content('server_settings', entry, key)
-        else:
-            await utils.add_content('server_settings', entry)
+        await utils.append_content('server_settings', key, 'rules', rule)
 
         await self.bot.say("I have just saved your new rule, use the rules command to view this server's current rules")
 
@@ -518,11 +490,17 @@ class Mod:
 
         EXAMPLE: !rules delete 5
         RESULT: Freedom from opression!"""
-        update = {'rules': r.row['rules'].delete_at(rule - 1)}
-        if not await utils.update_content('server_settings', update, ctx.message.server.id):
+        key = ctx.message.server.id
+        # The rule is removed by the database, so a rule added at the same time can't be lost
+        result = await utils.remove_at_content('server_settings', key, 'rules', rule - 1) if rule >= 1 else False
+        if result is utils.JOURNALED:
+            await self.bot.say("I can't reach my database right now, I'll remove that rule as soon as I can")
+            return
+        if not result:
             await self.bot.say("That is not a valid rule number, try running the command again.")
-        else:
-            await self.bot.say("I have just removed that rule from your list of rules!")
+            return
+
+        await self.bot.say("I have just removed that rule from your list of rules!")
 
 
 def setup(bot):
@@ -1,21 +1,18 @@
 from .utils import config
 from .utils import checks
 from .utils import images
+from .utils import utilities
 
 from discord.ext import commands
 import discord
 
-import aiohttp
-
 # https://github.com/ppy/osu-api/wiki
 base_url = 'https://osu.ppy.sh/api/'
-MAX_RETRIES = 5
 
 
 class Osu:
     def __init__(self, bot):
         self.bot = bot
-        self.headers = {'User-Agent': config.user_agent}
         self.key = config.osu_key
 
     async def _request(self, payload, endpoint):
@@ -28,19 +25,8 @@ class Osu:
         key = payload.get('k', self.key)
         payload['k'] = key
 
-        # Attempt to connect up to our max retries
-        for x in range(MAX_RETRIES):
-            try:
-                async with aiohttp.get(url, headers=self.headers, params=payload) as r:
-                    # If we failed to connect, attempt again
-                    if r.status != 200:
-                        continue
-
-                    data = await r.json()
-                    return data
-            # If any error happened when making the request, attempt again
-            except:
-                continue
+        # This goes through the shared client, which retries for us if it fails to connect
+        return await utilities.request(url, payload=payload)
 
     async def find_beatmap(self, query):
         """Finds a beatmap ID based on the first match of searching a beatmap"""
@@ -49,7 +49,8 @@ class Overwatch:
         if hero == "":
             # If no hero was provided, we just want the base stats for a player
             url = BASE_URL + "{}/stats".format(bt)
-            data = await utils.request(url)
+            # Stats only change once someone has played another game, so looking them up again can wait a few minutes
+            data = await utils.request(url, cache_ttl=300)
             region = [x for x in data.keys() if data[x] is not None][0]
             stats = data[region]['stats']['quickplay']
 
@@ -59,7 +60,7 @@ class Overwatch:
             # If there was a hero provided, search for a user's data on that hero
             hero = hero.lower().replace('-', '')
             url = BASE_URL + "{}/heroes".format(bt)
-            data = await utils.request(url)
+            data = await utils.request(url, cache_ttl=300)
 
             region = [x for x in data.keys() if data[x] is not None][0]
             stats = data[region]['heroes']['stats']['quickplay'].get(hero)
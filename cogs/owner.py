@@ -63,6 +63,54 @@ class Owner:
         except:
             pass
 
+    @commands.command()
+    @commands.check(utils.is_owner)
+    async def dbstats(self):
+        """Shows how long database queries have been taking, based on the table and operation"""
+        lines = ["Queries (most total time first):"]
+        queries = [(table, operation, stats) for table, operations in utils.query_stats.stats().items()
+                   for operation, stats in operations.items()]
+        queries.sort(key=lambda q: q[2]['total_ms'], reverse=True)
+        for table, operation, stats in queries:
+            lines.append("{}.{}: calls={calls} rows={rows} errors={errors} avg={avg_ms}ms p50={p50_ms}ms "
+                         "p95={p95_ms}ms p99={p99_ms}ms max={max_ms}ms".format(table, operation, **stats))
+
+        lines.append("\nSlow queries (over {}ms):".format(utils.query_stats.slow_threshold))
+        for query in utils.query_stats.slow_queries:
+            lines.append("{time} {table}.{operation}: {ms}ms rows={rows} error={error}".format(**query))
+
+        lines.append("\nBackend: {}".format(utils.backend.stats()))
+        lines.append("Usage buffer: {}".format(utils.usage_buffer.stats()))
+        lines.append("Write journal: {}".format(utils.write_journal.stats()))
+        lines.append("HTTP client: {}".format(utils.http_client.stats()))
+        lines.append("Response cache: {}".format(utils.response_cache.stats()))
+        lines.append("Request retries: {}".format(utils.retry_policy.stats()))
+        lines.append("Rate limit waits: {}".format(utils.http_client.limiter.stats()))
+        for name, stats in utils.scheduler.stats().items():
+            lines.append("Job {}: {}".format(name, stats))
+        for name, cog in self.bot.cogs.items():
+            if hasattr(cog, 'poll_stats'):
+                lines.append("{} poller: {}".format(name, cog.poll_stats.stats()))
+            if hasattr(cog, 'notifier'):
+                lines.append("{} notifications: {}".format(name, cog.notifier.stats()))
+            if hasattr(cog, 'expiry'):
+                lines.append("{} expiry: {}".format(name, cog.expiry.stats()))
+        for table, cache in utils.table_caches.items():
+            lines.append("LRU cache {}: {}".format(table, cache.stats()))
+        for table, cache in utils.cache.items():
+            lines.append("Changefeed cache {}: live={} staleness={}s resyncs={} changes={}".format(
+                table, cache.live, cache.staleness(), cache.resyncs, cache.changes))
+
+        # Send this in as many messages as it takes, without going over the message limit
+        message = ""
+        for line in lines:
+            if len(message) + len(line) > 1900:
+                await self.bot.say("```\n{}```".format(message))
+                message = ""
+            message += line[:1900] + "\n"
+        if message:
+            await self.bot.say("```\n{}```".format(message))
+
     @commands.command(pass_context=True)
     @commands.check(utils.is_owner)
     async def shutdown(self, ctx):
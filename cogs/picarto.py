@@ -1,16 +1,11 @@
-import aiohttp
-import asyncio
 import discord
 import re
-import rethinkdb as r
-import traceback
-import logging
+import time
 
 from discord.ext import commands
 
 from . import utils
 
-log = logging.getLogger()
 BASE_URL = 'https://ptvappapi.picarto.tv'
 
 # This is a public key for use, I don't care if this is seen
@@ -18,73 +13,65 @@ api_key = '03e26294-b793-11e5-9a41-005056984bd4'
 
 
 class Picarto:
+    # The table members' picarto urls are saved in, for the notifier
+    table = 'picarto'
+
     def __init__(self, bot):
         self.bot = bot
+        # The (lower-cased) channels that were online the last time we checked, and the time before that
+        self.online_channels = None
+        self.previous_channels = None
+        self.went_live = set()
+        self.went_offline = set()
+        self.poll_stats = utils.PollStats()
+        self.notifier = utils.StreamNotifier(bot, self, concurrency=utils.notification_concurrency)
+        utils.scheduler.add('picarto', self.notifier.check, interval=utils.stream_poll_interval,
+                            min_interval=utils.stream_poll_min_interval, max_interval=utils.stream_poll_max_interval,
+                            wait_for=bot.wait_until_ready)
+
+    def __unload(self):
+        utils.scheduler.remove('picarto')
 
     async def get_online_users(self):
-        # This method is in place to just return all online users so we can compare against it
+        """Gets everyone that is online, returning False if we couldn't
+        The channels that went live or offline since the last time are saved in went_live and went_offline"""
         url = BASE_URL + '/online/all'
         payload = {'key': api_key}
-        self.online_channels = await utils.request(url, payload=payload)
-
-    def channel_online(self, channel):
-        # Channel is the name we are checking against that
-        # This creates a list of all users that match this channel name (should only ever be 1)
-        # And returns True as long as it is more than 0
-        channel = re.search("(?<=picarto.tv/)(.*)", channel).group(1)
-        matches = [stream for stream in self.online_channels if stream['channel_name'].lower() == channel.lower()]
-        return len(matches) > 0
-
-    async def check_channels(self):
-        await self.bot.wait_until_ready()
-        # This is a loop that runs every 30 seconds, checking if anyone has gone online
+        start = time.monotonic()
+        # This is only used by the poller, so let anyone running a command go first
+        data = await utils.request(url, payload=payload, priority=utils.BACKGROUND)
         try:
-            while not self.bot.is_closed:
-                await self.get_online_users()
-                picarto = await utils.filter_content('picarto', {'notifications_on': 1})
-                for data in picarto:
-                    m_id = data['member_id']
-                    url = data['picarto_url']
-                    # Check if they are online
-                    online = self.channel_online(url)
-                    # If they're currently online, but saved as not then we'll send our notification
-                    if online and data['live'] == 0:
-                        for s_id in data['servers']:
-                            server = self.bot.get_server(s_id)
-                            if server is None:
-                                continue
-                            member = server.get_member(m_id)
-                            if member is None:
-                                continue
-                            server_settings = await utils.get_content('server_settings', s_id)
-                            if server_settings is not None:
-                                channel_id = server_settings.get('notification_channel', s_id)
-                            else:
-                                channel_id = s_id
-                            channel = server.get_channel(channel_id)
-                            await self.bot.send_message(channel, "{} has just gone live! View their stream at <{}>".format(member.display_name, data['picarto_url']))
-                            self.bot.loop.create_task(utils.update_content('picarto', {'live': 1}, m_id))
-                    elif not online and data['live'] == 1:
-                        for s_id in data['servers']:
-                            server = self.bot.get_server(s_id)
-                            if server is None:
-                                continue
-                            member = server.get_member(m_id)
-                            if member is None:
-                                continue
-                            server_settings = await utils.get_content('server_settings', s_id)
-                            if server_settings is not None:
-                                channel_id = server_settings.get('notification_channel', s_id)
-                            else:
-                                channel_id = s_id
-                            channel = server.get_channel(channel_id)
-                            await self.bot.send_message(channel, "{} has just gone offline! View their stream next time at <{}>".format(member.display_name, data['picarto_url']))
-                            self.bot.loop.create_task(utils.update_content('picarto', {'live': 0}, m_id))
-                await asyncio.sleep(30)
-        except Exception as e:
-            tb = traceback.format_exc()
-            fmt = "{1}\n{0.__class__.__name__}: {0}".format(tb, e)
-            log.error(fmt)
+            # Saved as a set, so that checking if someone is online doesn't mean going through everyone that is
+            online = {stream['channel_name'].lower() for stream in data}
+        except (KeyError, TypeError):
+            self.poll_stats.record(time.monotonic() - start, 0, 1, 1)
+            return False
+
+        # If we couldn't check last time, compare against the last time we could
+        self.previous_channels, self.online_channels = self.online_channels, online
+        if self.previous_channels is not None:
+            self.went_live = online - self.previous_channels
+            self.went_offline = self.previous_channels - online
+        self.poll_stats.record(time.monotonic() - start, len(online), 1)
+        return True
+
+    @staticmethod
+    def channel_name(picarto_url):
+        return re.search("(?<=picarto.tv/)(.*)", picarto_url).group(1).strip('/').lower()
+
+    async def live_channels(self, channels):
+        """Returns (the channels that are live, the channels we couldn't check), for the notifier"""
+        # If we couldn't get who's online, we don't know about anyone
+        if not await self.get_online_users():
+            return set(), set(channels)
+        return set(channels) & self.online_channels, set()
+
+    def changed_channels(self):
+        """Returns the channels that went live or offline since the last check, for the notifier
+        So only those members need to be looked at, None means this is the first check so everyone does"""
+        if self.previous_channels is None:
+            return None
+        return self.went_live | self.went_offline
 
     @commands.group(invoke_without_command=True, no_pm=True, pass_context=True)
     @utils.custom_perms(send_messages=True)
@@ -171,12 +158,18 @@ class Picarto:
                  'notifications_on': 1,
                  'live': 0,
                  'member_id': key}
-        if await utils.add_content('picarto', entry):
+        # If the add is journaled, so is the update, which is made after it in case they already had a URL saved
+        added = await utils.add_content('picarto', entry)
+        if not added:
+            await utils.update_content('picarto', {'picarto_url': url}, key)
+        if added is utils.JOURNALED:
+            await self.bot.say("I can't reach my database right now {}, I'll save your Picarto URL as soon as I "
+                               "can".format(ctx.message.author.mention))
+        elif added:
             await self.bot.say(
                 "I have just saved your Picarto URL {}, this server will now be notified when you go live".format(
                     ctx.message.author.mention))
         else:
-            await utils.update_content('picarto', {'picarto_url': url}, key)
             await self.bot.say("I have just updated your Picarto URL")
 
     @picarto.command(name='remove', aliases=['delete'], no_pm=True, pass_context=True)
@@ -209,7 +202,7 @@ class Picarto:
         elif ctx.message.server.id in result['servers']:
             await self.bot.say("I am already set to notify in this server...")
         else:
-            await utils.update_content('picarto', {'servers': r.row['servers'].append(ctx.message.server.id)}, key)
+            await utils.append_content('picarto', key, 'servers', ctx.message.server.id)
 
     @notify.command(name='on', aliases=['start,yes'], no_pm=True, pass_context=True)
     @utils.custom_perms(send_messages=True)
@@ -237,6 +230,4 @@ class Picarto:
 
 
 def setup(bot):
-    p = Picarto(bot)
-    bot.loop.create_task(p.check_channels())
     bot.add_cog(Picarto(bot))
\ No newline at end of file
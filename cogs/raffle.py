@@ -1,49 +1,81 @@
 from discord.ext import commands
 from . import utils
 
+import asyncio
+import calendar
 import discord
+import logging
 import random
 import pendulum
 import re
-import asyncio
-import traceback
+import time
+import uuid
+
+log = logging.getLogger()
+
+
+def _timestamp(expires):
+    # Raffles are saved with when they expire in UTC, as a string like 2017-01-01 12:00:00
+    return calendar.timegm(pendulum.parse(expires).utctimetuple())
 
 
 class Raffle:
     def __init__(self, bot):
         self.bot = bot
-        self.bot.loop.create_task(self.raffle_task())
+        # Each raffle is ended as soon as it expires, instead of checking every so often for any that have
+        self.expiry = utils.Timers(self.end_raffles)
+        self.bot.loop.create_task(self.load_raffles())
+
+    def __unload(self):
+        self.expiry.close()
 
-    async def raffle_task(self):
+    async def load_raffles(self):
+        # The raffles running are only loaded once, after this raffles are added to the timers as they're created
+        await self.bot.wait_until_ready()
         while True:
             try:
-                await self.check_raffles()
+                raffles = await utils.get_range_content('raffles', 'expires', utils.minval, utils.maxval) or []
+                break
             except Exception as error:
-                with open("error_log", 'a') as f:
-                    traceback.print_tb(error.__traceback__, file=f)
-                    print('{0.__class__.__name__}: {0}'.format(error), file=f)
-            await asyncio.sleep(900)
-
-    async def check_raffles(self):
-        # This is used to periodically check the current raffles, and see if they have ended yet
-        # If the raffle has ended, we'll pick a winner from the entrants
-        raffles = await utils.get_content('raffles')
-
-        if raffles is None:
-            return
+                # Most likely the database isn't ready yet, so try again in a bit
+                log.error("Failed to load the raffles, trying again in 60 seconds: {0.__class__.__name__}: {0}".format(
+                    error))
+                await asyncio.sleep(60)
 
         for raffle in raffles:
+            # Raffles on servers we can't see are on another shard, which will end them itself
+            if self.bot.get_server(raffle['server_id']) is not None:
+                self.expiry.schedule(raffle['id'], _timestamp(raffle['expires']))
+        self.expiry.start(self.bot.loop)
+
+    async def end_raffles(self, raffle_ids):
+        # This is called with the raffles that have just expired, we'll pick a winner from the entrants
+        raffles = await asyncio.gather(*[utils.get_content('raffles', raffle_id, primary=True)
+                                         for raffle_id in raffle_ids])
+
+        # The raffles that have ended, and what to say for each of them
+        # These are all removed at once, before any of the results are sent
+        expired = []
+        results = []
+        for raffle in raffles:
+            # This was removed since it was scheduled
+            if raffle is None:
+                continue
+
             server = self.bot.get_server(raffle['server_id'])
 
             # Check to see if this cog can find the server in question
+            # If we can't, it's most likely not available yet (such as during an outage) so try again in a bit
             if server is None:
+                self.expiry.schedule(raffle['id'], time.time() + self.expiry.retry)
                 continue
 
             now = pendulum.utcnow()
             expires = pendulum.parse(raffle['expires'])
 
-            # Now lets compare and see if this raffle has ended, if not just continue
+            # This shouldn't happen, but just in case we were called early, wait until it has actually ended
             if expires > now:
+                self.expiry.schedule(raffle['id'], _timestamp(raffle['expires']))
                 continue
 
             title = raffle['title']
@@ -72,14 +104,19 @@ class Raffle:
                     fmt = 'The raffle `{}` has just ended! The winner is {}!'.format(title, winner.display_name)
 
             # No matter which one of these matches were met, the raffle has ended and we want to remove it
-            # We don't have to wait for it however, so create a task for it
-            self.bot.loop.create_task(utils.remove_content('raffles', raffle_id ))
+            expired.append(raffle_id)
+            results.append((server, fmt))
+
+        if expired:
+            await utils.bulk_remove_content('raffles', expired)
 
-            server_settings = await utils.get_content('server_settings', str(server.id))
-            channel_id = server_settings.get('notification_channel', server.id)
-            channel = self.bot.get_channel(channel_id)
+        for server, fmt in results:
+            server_settings = utils.cache['server_settings'].get(server.id) or {}
+            channel = server.get_channel(server_settings.get('notification_channel', server.id))
+            if channel is None:
+                continue
             try:
-                await channel.send(fmt)
+                await self.bot.send_message(channel, fmt)
             except discord.Forbidden:
                 pass
 
@@ -90,8 +127,7 @@ class Raffle:
 
         EXAMPLE: !raffles
         RESULT: A list of the raffles setup on this server"""
-        r_filter = {'server_id': ctx.message.server.id}
-        raffles = await utils.filter_content('raffles', r_filter)
+        raffles = await utils.get_all_content('raffles', 'server_id', ctx.message.server.id)
         if raffles is None:
             await self.bot.say("There are currently no raffles setup on this server!")
             return
@@ -113,10 +149,9 @@ class Raffle:
         RESULT: You've entered the first raffle!"""
         # Lets let people use 1 - (length of raffles) and handle 0 base ourselves
         raffle_id -= 1
-        r_filter = {'server_id': ctx.message.server.id}
         author = ctx.message.author
 
-        raffles = await utils.filter_content('raffles', r_filter)
+        raffles = await utils.get_all_content('raffles', 'server_id', ctx.message.server.id)
         if raffles is None:
             await self.bot.say("There are currently no raffles setup on this server!")
             return
@@ -224,14 +259,18 @@ class Raffle:
         expires = now.add(**payload)
 
         # Now we're ready to add this as a new raffle
-        entry = {'title': title,
+        entry = {'id': str(uuid.uuid4()),
+                 'title': title,
                  'expires': expires.to_datetime_string(),
                  'entrants': [],
                  'author': author.id,
                  'server_id': server.id}
 
         # We don't want to pass a filter to this, because we can have multiple raffles per server
-        await utils.add_content('raffles', entry)
+        # A journaled raffle is saved once the database is back, which will most likely be before it ends
+        added = await utils.add_content('raffles', entry)
+        if added or added is utils.JOURNALED:
+            self.expiry.schedule(entry['id'], _timestamp(entry['expires']))
         await self.bot.say("I have just saved your new raffle!")
 
 
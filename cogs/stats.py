@@ -5,6 +5,9 @@ from . import utils
 
 import re
 
+# The most records that will be shown on the battle leaderboard
+leaderboard_size = 100
+
 
 class Stats:
     """Leaderboard/stats related commands"""
@@ -79,14 +82,14 @@ class Stats:
             await self.bot.say("`{}` is not a valid command".format(command))
             return
 
-        command_stats = await utils.get_content('command_usage', cmd.qualified_name)
+        command_stats = await utils.command_usage(cmd.qualified_name, ctx.message.author.id, ctx.message.server.id)
         if command_stats is None:
             await self.bot.say("That command has never been used! You know I worked hard on that! :c")
             return
 
-        total_usage = command_stats['total_usage']
-        member_usage = command_stats['member_usage'].get(ctx.message.author.id, 0)
-        server_usage = command_stats['server_usage'].get(ctx.message.server.id, 0)
+        total_usage = command_stats['total']
+        member_usage = command_stats['member']
+        server_usage = command_stats['server']
 
         try:
             data = [("Command Name", cmd.qualified_name),
@@ -114,14 +117,8 @@ class Stats:
         RESULT: The realization of how little of a life you have"""
         if re.search('(author|me)', option):
             author = ctx.message.author
-            # First lets get all the command usage
-            command_stats = await utils.get_content('command_usage')
-            # Now use a dictionary comprehension to get just the command name, and usage
-            # Based on the author's usage of the command
-            stats = {data['command']: data['member_usage'].get(author.id) for data in command_stats
-                     if data['member_usage'].get(author.id, 0) > 0}
-            # Now sort it by the amount of times used
-            sorted_stats = sorted(stats.items(), key=lambda x: x[1], reverse=True)
+            # Get the author's top 5 used commands, already sorted by the amount of times used
+            sorted_stats = await utils.top_commands('member', author.id, 5)
 
             # Create a string, each command on it's own line, based on the top 5 used commands
             # I'm letting it use the length of the sorted_stats[:5]
@@ -137,10 +134,7 @@ class Stats:
         elif re.search('server', option):
             # This is exactly the same as above, except server usage instead of member usage
             server = ctx.message.server
-            command_stats = await utils.get_content('command_usage')
-            stats = {data['command']: data['server_usage'].get(server.id) for data in command_stats
-                     if data['server_usage'].get(server.id, 0) > 0}
-            sorted_stats = sorted(stats.items(), key=lambda x: x[1], reverse=True)
+            sorted_stats = await utils.top_commands('server', server.id, 5)
 
             top_5 = "\n".join("{}: {}".format(data[0], data[1]) for data in sorted_stats[:5])
             await self.bot.say(
@@ -218,13 +212,11 @@ class Stats:
 
         EXAMPLE: !leaderboard
         RESULT: A leaderboard of this server's battle records"""
-        # Create a list of the ID's of all members in this server, for comparison to the records saved
+        # Create a list of the ID's of all members in this server, and let the database give us the top records
+        # for just those members; this way we only get back the records that are actually shown
         server_member_ids = [member.id for member in ctx.message.server.members]
-        battles = await utils.get_content('battle_records')
-        battles = [battle for battle in battles if battle['member_id'] in server_member_ids]
-
-        # Sort the members based on their rating
-        sorted_members = sorted(battles, key=lambda k: k['rating'], reverse=True)
+        sorted_members = await utils.get_top_content('battle_records', 'rating', leaderboard_size,
+                                                     keys=server_member_ids)
 
         output = []
         for x in sorted_members:
@@ -248,40 +240,29 @@ class Stats:
         RESULT: How good they are at winning a completely luck based game"""
         member = member or ctx.message.author
 
-        # For this one, we don't want to pass a filter, as we do need all battle records
-        # We need this because we want to make a comparison for overall rank
-        all_members = await utils.get_content('battle_records')
-
-        # Make a list comprehension to just check if the user has battled
-        if len([entry for entry in all_members if entry['member_id'] == member.id]) == 0:
+        entry = await utils.get_content('battle_records', member.id)
+        if entry is None:
             await self.bot.say("That user has not battled yet!")
             return
 
-        # Same concept as the leaderboard
+        # The ranks are counted by the database, based on how many records have a higher rating
+        # For the server rank, only the records for members in this server are counted
+        rating = entry['rating']
         server_member_ids = [member.id for member in ctx.message.server.members]
-        server_members = [stats for stats in all_members if stats['member_id'] in server_member_ids]
-        sorted_server_members = sorted(server_members, key=lambda x: x['rating'], reverse=True)
-        sorted_all_members = sorted(all_members, key=lambda x: x['rating'], reverse=True)
-
-        # Enumurate the list so that we can go through, find the user's place in the list
-        # and get just that for the rank
-        server_rank = [i for i, x in enumerate(sorted_server_members) if x['member_id'] == member.id][0] + 1
-        total_rank = [i for i, x in enumerate(sorted_all_members) if x['member_id'] == member.id][0] + 1
-        # The rest of this is straight forward, just formatting
+        server_rank, server_total = await utils.get_rank('battle_records', 'rating', rating, keys=server_member_ids)
+        total_rank, total = await utils.get_rank('battle_records', 'rating', rating)
 
-        entry = [m for m in server_members if m['member_id'] == member.id][0]
-        rating = entry['rating']
+        # The rest of this is straight forward, just formatting
         record = "{}-{}".format(entry['wins'], entry['losses'])
         try:
             title = 'Stats for {}'.format(member.display_name)
-            fmt = [('Record', record), ('Server Rank', '{}/{}'.format(server_rank, len(server_members))),
-                   ('Overall Rank', '{}/{}'.format(total_rank, len(all_members))), ('Rating', rating)]
+            fmt = [('Record', record), ('Server Rank', '{}/{}'.format(server_rank, server_total)),
+                   ('Overall Rank', '{}/{}'.format(total_rank, total)), ('Rating', rating)]
             banner = await utils.create_banner(member, title, fmt)
             await self.bot.upload(banner)
         except (FileNotFoundError, discord.Forbidden):
             fmt = 'Stats for {}:\n\tRecord: {}\n\tServer Rank: {}/{}\n\tOverall Rank: {}/{}\n\tRating: {}'
-            fmt = fmt.format(member.display_name, record, server_rank, len(server_members), total_rank,
-                             len(all_members), rating)
+            fmt = fmt.format(member.display_name, record, server_rank, server_total, total_rank, total, rating)
             await self.bot.say('```\n{}```'.format(fmt))
 
 
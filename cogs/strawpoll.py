@@ -3,12 +3,11 @@ import discord
 
 from .utils import config
 from .utils import checks
+from .utils.http_client import http_client
 
-import aiohttp
 import re
 import json
 import pendulum
-import rethinkdb as r
 
 
 def setup(bot):
@@ -29,7 +28,6 @@ class Strawpoll:
         # Strawpoll requires the content-type, so just add that to the default headers
         self.headers = {'User-Agent': 'Bonfire/1.0.0',
                         'Content-Type': 'application/json'}
-        self.session = aiohttp.ClientSession()
 
     @commands.group(aliases=['strawpoll', 'poll', 'polls'], pass_context=True, invoke_without_command=True, no_pm=True)
     @checks.custom_perms(send_messages=True)
@@ -61,8 +59,8 @@ class Strawpoll:
                 await self.bot.say("That poll does not exist on this server!")
                 return
 
-            async with self.session.get("{}/{}".format(self.url, poll_id),
-                                        headers={'User-Agent': 'Bonfire/1.0.0'}) as response:
+            async with http_client.get("{}/{}".format(self.url, poll_id),
+                                       headers={'User-Agent': 'Bonfire/1.0.0'}) as response:
                 data = await response.json()
 
             # The response for votes and options is provided as two separate lists
@@ -111,7 +109,7 @@ class Strawpoll:
         payload = {'title': title,
                    'options': options}
         try:
-            async with self.session.post(self.url, data=json.dumps(payload), headers=self.headers) as response:
+            async with http_client.post(self.url, data=json.dumps(payload), headers=self.headers) as response:
                 data = await response.json()
         except json.JSONDecodeError:
             await self.bot.say("Sorry, I couldn't connect to strawpoll at the moment. Please try again later")
@@ -120,17 +118,11 @@ class Strawpoll:
         # Save this strawpoll in the list of running strawpolls for a server
         poll_id = str(data['id'])
 
-        r_filter = {'server_id': ctx.message.server.id}
         sub_entry = {'poll_id': poll_id,
                      'author': ctx.message.author.id,
                      'date': str(pendulum.utcnow()),
                      'title': title}
-
-        entry = {'server_id': ctx.message.server.id,
-                 'polls': [sub_entry]}
-        update = {'polls': r.row['polls'].append(sub_entry)}
-        if not await config.update_content('strawpolls', update, r_filter):
-            await config.add_content('strawpolls', entry, {'poll_id': poll_id})
+        await config.append_content('strawpolls', ctx.message.server.id, 'polls', sub_entry)
         await self.bot.say("Link for your new strawpoll: https://strawpoll.me/{}".format(poll_id))
 
     @strawpolls.command(name='delete', aliases=['remove', 'stop'], pass_context=True, no_pm=True)
@@ -33,8 +33,7 @@ class Tags:
 
          EXAMPLE: !tag butts
          RESULT: Whatever you setup for the butts tag!!"""
-        r_filter = lambda row: (row['server_id'] == ctx.message.server.id) & (row['tag'] == tag)
-        tags = await config.filter_content('tags', r_filter)
+        tags = await config.get_all_content('tags', 'server_id_tag', [ctx.message.server.id, tag])
         if tags is None:
             await self.bot.say('That tag does not exist!')
             return
@@ -2,15 +2,10 @@ from discord.ext import commands
 
 from . import utils
 
-import aiohttp
 import asyncio
 import discord
 import re
-import rethinkdb as r
-import traceback
-import logging
-
-log = logging.getLogger()
+import time
 
 
 class Twitch:
@@ -18,76 +13,67 @@ class Twitch:
     You can add or remove your twitch stream for your user
     I will then notify the server when you have gone live or offline"""
 
+    # The table members' twitch urls are saved in, for the notifier
+    table = 'twitch'
+
     def __init__(self, bot):
         self.bot = bot
         self.key = utils.twitch_key
         self.params = {'client_id': self.key}
-
-    async def channel_online(self, twitch_url: str):
-        # Check a specific channel's data, and get the response in text format
-        channel = re.search("(?<=twitch.tv/)(.*)", twitch_url).group(1)
-        url = "https://api.twitch.tv/kraken/streams/{}".format(channel)
-
-        response = await utils.request(url, payload=self.params)
-
-        # For some reason Twitch's API call is not reliable, sometimes it returns stream as None
-        # That is what we're checking specifically, sometimes it doesn't exist in the returned JSON at all
-        # Sometimes it returns something that cannot be decoded with JSON (which means we'll get None back)
-        # In either error case, just assume they're offline, the next check will most likely work
+        self.poll_stats = utils.PollStats()
+        self.notifier = utils.StreamNotifier(bot, self, concurrency=utils.notification_concurrency)
+        utils.scheduler.add('twitch', self.notifier.check, interval=utils.stream_poll_interval,
+                            min_interval=utils.stream_poll_min_interval, max_interval=utils.stream_poll_max_interval,
+                            wait_for=bot.wait_until_ready)
+
+    def __unload(self):
+        utils.scheduler.remove('twitch')
+
+    @staticmethod
+    def channel_name(twitch_url):
+        # The channel is the last part of the url saved, https://www.twitch.tv/[channel]
+        return re.search("(?<=twitch.tv/)(.*)", twitch_url).group(1).strip('/').lower()
+
+    async def streams_online(self, channels):
+        """Returns the set of channels (lower-cased) that are live out of the ones given, up to 100 at a time
+        Or None if we couldn't find out"""
+        url = "{}/streams/".format(utils.twitch_api_url)
+        payload = dict(self.params, channel=','.join(channels), limit=len(channels))
+        # This is only used by the poller, so let anyone running a command go first
+        response = await utils.request(url, payload=payload, priority=utils.BACKGROUND)
+
+        # For some reason Twitch's API call is not reliable, sometimes it doesn't return the streams at all
+        # Or something that cannot be decoded with JSON (which means we'll get None back)
         try:
-            return response['stream'] is not None
+            return {stream['channel']['name'].lower() for stream in response['streams']}
         except (KeyError, TypeError):
-            return False
-
-    async def check_channels(self):
-        await self.bot.wait_until_ready()
-        # Loop through as long as the bot is connected
-        try:
-            while not self.bot.is_closed:
-                twitch = await utils.filter_content('twitch', {'notifications_on': 1})
-                for data in twitch:
-                    m_id = data['member_id']
-                    url = data['twitch_url']
-                    # Check if they are online
-                    online = await self.channel_online(url)
-                    # If they're currently online, but saved as not then we'll send our notification
-                    if online and data['live'] == 0:
-                        for s_id in data['servers']:
-                            server = self.bot.get_server(s_id)
-                            if server is None:
-                                continue
-                            member = server.get_member(m_id)
-                            if member is None:
-                                continue
-                            server_settings = await utils.get_content('server_settings', s_id)
-                            if server_settings is not None:
-                                channel_id = server_settings.get('notification_channel', s_id)
-                            else:
-                                channel_id = s_id
-                            channel = server.get_channel(channel_id)
-                            await self.bot.send_message(channel, "{} has just gone live! View their stream at <{}>".format(member.display_name, data['twitch_url']))
-                            self.bot.loop.create_task(utils.update_content('twitch', {'live': 1}, m_id))
-                    elif not online and data['live'] == 1:
-                        for s_id in data['servers']:
-                            server = self.bot.get_server(s_id)
-                            if server is None:
-                                continue
-                            member = server.get_member(m_id)
-                            if member is None:
-                                continue
-                            server_settings = await utils.get_content('server_settings', s_id)
-                            if server_settings is not None:
-                                channel_id = server_settings.get('notification_channel', s_id)
-                            else:
-                                channel_id = s_id
-                            channel = server.get_channel(channel_id)
-                            await self.bot.send_message(channel, "{} has just gone offline! View their stream next time at <{}>".format(member.display_name, data['twitch_url']))
-                            self.bot.loop.create_task(utils.update_content('twitch', {'live': 0}, m_id))
-                await asyncio.sleep(30)
-        except Exception as e:
-            tb = traceback.format_exc()
-            fmt = "{1}\n{0.__class__.__name__}: {0}".format(tb, e)
-            log.error(fmt)
+            return None
+
+    async def live_channels(self, channels):
+        """Checks which of the channels are live, batch_size channels per request with a few requests at once
+        Returns (the channels that are live, the channels we couldn't check)"""
+        channels = sorted(set(channels))
+        batches = [channels[i:i + utils.twitch_batch_size] for i in range(0, len(channels), utils.twitch_batch_size)]
+        # This way one slow response only holds up its own batch, not everyone else
+        semaphore = asyncio.Semaphore(utils.twitch_batch_concurrency)
+
+        async def check(batch):
+            async with semaphore:
+                return await self.streams_online(batch)
+
+        start = time.monotonic()
+        results = await asyncio.gather(*[check(batch) for batch in batches])
+
+        online = set()
+        unknown = set()
+        for batch, result in zip(batches, results):
+            if result is None:
+                unknown.update(batch)
+            else:
+                online.update(result)
+        self.poll_stats.record(time.monotonic() - start, len(channels), len(batches),
+                               len([r for r in results if r is None]))
+        return online, unknown
 
     @commands.group(no_pm=True, invoke_without_command=True, pass_context=True)
     @utils.custom_perms(send_messages=True)
@@ -167,9 +153,15 @@ class Twitch:
         # Check to see if this user has already saved a twitch URL
         # If they have, update the URL, otherwise create a new entry
         # Assuming they're not live, and notifications should be on
-        if not await utils.add_content('twitch', entry):
+        # If the add is journaled, so is the update, which is made after it in case they already had a URL saved
+        added = await utils.add_content('twitch', entry)
+        if not added:
             await utils.update_content('twitch', update, key)
-        await self.bot.say("I have just saved your twitch url {}".format(ctx.message.author.mention))
+        if added is utils.JOURNALED:
+            await self.bot.say("I can't reach my database right now {}, I'll save your twitch url as soon as I "
+                               "can".format(ctx.message.author.mention))
+        else:
+            await self.bot.say("I have just saved your twitch url {}".format(ctx.message.author.mention))
 
     @twitch.command(name='remove', aliases=['delete'], no_pm=True, pass_context=True)
     @utils.custom_perms(send_messages=True)
@@ -201,7 +193,7 @@ class Twitch:
         elif ctx.message.server.id in result['servers']:
             await self.bot.say("I am already set to notify in this server...")
         else:
-            await utils.update_content('twitch', {'servers': r.row['servers'].append(ctx.message.server.id)}, key)
+            await utils.append_content('twitch', key, 'servers', ctx.message.server.id)
             await self.bot.say("This server will now be notified if you go live")
 
     @notify.command(name='on', aliases=['start,yes'], no_pm=True, pass_context=True)
@@ -211,7 +203,11 @@ class Twitch:
 
         EXAMPLE: !twitch notify on
         RESULT: Notifications will be sent when you go live"""
-        if await utils.update_content('twitch', {"notifications_on": 1}, ctx.message.author.id):
+        result = await utils.update_content('twitch', {"notifications_on": 1}, ctx.message.author.id)
+        if result is utils.JOURNALED:
+            await self.bot.say("I can't reach my database right now {}, I'll turn your notifications on as soon as "
+                               "I can".format(ctx.message.author.mention))
+        elif result:
             await self.bot.say("I will notify if you go live {}, you'll get a bajillion followers I promise c:".format(
                 ctx.message.author.mention))
         else:
@@ -224,7 +220,11 @@ class Twitch:
 
         EXAMPLE: !twitch notify off
         RESULT: Notifications will not be sent when you go live"""
-        if await utils.update_content('twitch', {"notifications_on": 0}, ctx.message.author.id):
+        result = await utils.update_content('twitch', {"notifications_on": 0}, ctx.message.author.id)
+        if result is utils.JOURNALED:
+            await self.bot.say("I can't reach my database right now {}, I'll turn your notifications off as soon as "
+                               "I can".format(ctx.message.author.mention))
+        elif result:
             await self.bot.say(
                 "I will not notify if you go live anymore {}, "
                 "are you going to stream some lewd stuff you don't want people to see?~".format(
@@ -235,6 +235,4 @@ class Twitch:
 
 
 def setup(bot):
-    t = Twitch(bot)
-    bot.loop.create_task(t.check_channels())
     bot.add_cog(Twitch(bot))
\ No newline at end of file
@@ -2,5 +2,12 @@ from .cards import Deck
 from .checks import is_owner, custom_perms, db_check
 from .config import *
 from .utilities import *
+from .http_client import http_client, response_cache, retry_policy
+from .ratelimit import INTERACTIVE, BACKGROUND
+from .metrics import PollStats
+from .notifications import StreamNotifier
+from .scheduler import scheduler
+from .timers import Timers
+from .usage import usage_buffer, command_usage, top_commands
 from .images import create_banner
 from .paginator import Pages, CannotPaginate
\ No newline at end of file
@@ -0,0 +1 @@
+from .base import Backend, BackendUnavailable, minval, maxval
@@ -0,0 +1,144 @@
+class BackendUnavailable(Exception):
+    """Raised when the backend cannot be reached (for example, the database is down)"""
+    pass
+
+
+class _Bound:
+    # These are used in range queries on compound indexes, to match anything in the remaining fields
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+
+# Sorts before/after every other value, the same as r.minval and r.maxval
+minval = _Bound('minval')
+maxval = _Bound('maxval')
+
+
+class Backend:
+    """The interface every storage backend implements, the helpers in config.py are built on top of this
+    Every method here is a coroutine, unless it says otherwise
+
+    Tables are described by their primary key, and their secondary indexes as index name: list of fields
+    An index with more than one field is a compound index, which is queried with a list of values in the same order
+    A table that was never setup uses 'id' as its primary key, which is generated for documents that don't have one
+
+    Reads take primary, a backend with replicas can answer reads from them unless primary is True
+    Which means the read needs the latest data, such as when it's about to be written back"""
+
+    name = None
+
+    async def connect(self):
+        """Gets the backend ready to be used, raising BackendUnavailable if it can't be reached"""
+        raise NotImplementedError
+
+    async def close(self):
+        raise NotImplementedError
+
+    async def table_list(self):
+        """Returns a list of the tables that exist"""
+        raise NotImplementedError
+
+    async def ensure(self, tables, indexes):
+        """Creates any of the tables ({table: primary key}) and indexes ({table: {index: [fields]}}) that are missing
+        Returns a list of the tables that were created"""
+        raise NotImplementedError
+
+    async def insert(self, table, content):
+        """Inserts a document, or list of documents, returning how many were inserted
+        Documents with a primary key that already exists are not inserted"""
+        raise NotImplementedError
+
+    async def get(self, table, key, primary=False):
+        """Returns the document with this primary key, or None"""
+        raise NotImplementedError
+
+    async def get_all(self, table, index, values, primary=False):
+        """Returns a list of every document that matches any of the values on the index"""
+        raise NotImplementedError
+
+    async def scan(self, table, primary=False):
+        """Returns a list of every document in the table"""
+        raise NotImplementedError
+
+    async def filter(self, table, r_filter, primary=False):
+        """Returns a list of every document that matches the filter
+        The filter can be a dictionary of field: value, or a function that is given the document"""
+        raise NotImplementedError
+
+    async def delete(self, table, key):
+        """Deletes the document with this primary key, returning True if it existed"""
+        raise NotImplementedError
+
+    async def update(self, table, key, content):
+        """Merges content into the document with this primary key, returning True if it exists"""
+        raise NotImplementedError
+
+    async def replace(self, table, key, content):
+        """Replaces the document with this primary key with content, returning True if it exists"""
+        raise NotImplementedError
+
+    async def upsert(self, table, key, patch, increment=False, return_changes=False):
+        """Merges the patch into the document with this primary key, creating it if it doesn't exist
+        If increment is True, the numbers in the patch are added onto what is saved instead of replacing it
+        Returns the document as it is saved if return_changes is True, otherwise True if anything was written"""
+        raise NotImplementedError
+
+    async def increment(self, table, documents, field):
+        """Inserts the documents, adding their field onto what is saved for any that already exist"""
+        raise NotImplementedError
+
+    async def append(self, table, key, field, value):
+        """Appends value to the list in field, creating the list (and the document) if they don't exist"""
+        raise NotImplementedError
+
+    async def remove_at(self, table, key, field, index):
+        """Removes the value at index from the list in field, returning False if there was nothing there to remove"""
+        raise NotImplementedError
+
+    async def bulk_insert(self, table, documents):
+        """Inserts a list of documents in one query, returning a list of whether each one was inserted
+        Documents with a primary key that already exists are not inserted"""
+        raise NotImplementedError
+
+    async def bulk_update(self, table, updates, upsert=False):
+        """Merges each patch into the document with its primary key, given as a dictionary of key: patch
+        If upsert is True, documents that don't exist are created from the patch
+        Returns a dictionary of key: whether that document was written"""
+        raise NotImplementedError
+
+    async def bulk_delete(self, table, keys):
+        """Deletes every document with one of these primary keys
+        Returns a dictionary of key: whether that document existed"""
+        raise NotImplementedError
+
+    async def top(self, table, index, limit, keys=None, primary=False):
+        """Returns up to limit documents, highest first on the index
+        If keys are given, only the documents with those primary keys are included"""
+        raise NotImplementedError
+
+    async def rank(self, table, index, value, keys=None, primary=False):
+        """Returns (how many documents are higher than value on the index, how many documents there are)
+        If keys are given, only the documents with those primary keys are counted"""
+        raise NotImplementedError
+
+    async def range(self, table, index, lower, upper, limit=None, descending=False, primary=False):
+        """Returns the documents between lower and upper (inclusive) on the index, ordered by it"""
+        raise NotImplementedError
+
+    def iterate(self, table, r_filter=None, batch_size=None, primary=False):
+        """Returns an async iterator over the documents in the table (matching the filter, if given)
+        This is not a coroutine, the iterator can be used with async with to stop early"""
+        raise NotImplementedError
+
+    def changes(self, table):
+        """Returns an async iterator of the changes made to the table, first giving every current document
+        Changes are given like rethinkdb changefeeds, {'old_val': ..., 'new_val': ...}, with {'state': 'ready'}
+        once all current documents have been given. This is not a coroutine, and it should be closed when done"""
+        raise NotImplementedError
+
+    def stats(self):
+        """Returns a dictionary of stats about this backend, this is not a coroutine"""
+        return {'backend': self.name}
@@ -0,0 +1,567 @@
+import asyncio
+import copy
+import json
+import os
+import uuid
+
+from .base import Backend, minval, maxval
+
+# Used for documents that don't have the fields an index is made of, these aren't in the index
+_MISSING = object()
+
+
+def _freeze(value):
+    # Turns an index value into something that can be used as a dictionary key
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    return value
+
+
+def _order(value):
+    # Gives every value something that can be compared, in the same order rethinkdb sorts them in
+    if value is minval:
+        return (0,)
+    if value is maxval:
+        return (9,)
+    if isinstance(value, (list, tuple)):
+        return (1, tuple(_order(v) for v in value))
+    if isinstance(value, bool):
+        return (2, value)
+    if value is None:
+        return (3,)
+    if isinstance(value, (int, float)):
+        return (4, value)
+    if isinstance(value, dict):
+        return (5, json.dumps(value, sort_keys=True))
+    return (6, str(value))
+
+
+def _merge(document, patch):
+    # Merges patch into document, the same as rethinkdb's update does; nested objects are merged as well
+    for field, value in patch.items():
+        if isinstance(value, dict) and isinstance(document.get(field), dict):
+            _merge(document[field], value)
+        else:
+            document[field] = copy.deepcopy(value)
+    return document
+
+
+def _add(document, patch):
+    # The same as _merge, except every number in the patch is added onto what is saved
+    for field, value in patch.items():
+        if isinstance(value, dict):
+            if not isinstance(document.get(field), dict):
+                document[field] = {}
+            _add(document[field], value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            document[field] = (document.get(field) or 0) + value
+        else:
+            document[field] = copy.deepcopy(value)
+    return document
+
+
+def _matches(document, r_filter):
+    # A filter can either be a dictionary that the document needs to contain, or a function given the document
+    if isinstance(r_filter, dict):
+        for field, value in r_filter.items():
+            if isinstance(value, dict) and isinstance(document.get(field), dict):
+                if not _matches(document[field], value):
+                    return False
+            elif field not in document or document[field] != value:
+                return False
+        return True
+    try:
+        return bool(r_filter(document))
+    except Exception:
+        # rethinkdb treats a row that errors in the filter as not matching, so do the same
+        return False
+
+
+class _Table:
+    def __init__(self, primary_key='id'):
+        self.primary_key = primary_key
+        self.rows = {}
+        # index name: the fields it is made of, and index name: {index value: the keys with that value}
+        self.indexes = {}
+        self.lookups = {}
+
+    def index_value(self, index, document):
+        # Returns the value of document on the index, or MISSING if a field is missing (it isn't in the index)
+        if index == self.primary_key:
+            return document.get(index, _MISSING)
+        fields = self.indexes.get(index, [index])
+        values = [document.get(field, _MISSING) for field in fields]
+        if _MISSING in values:
+            return _MISSING
+        return values[0] if len(fields) == 1 else values
+
+    def add_index(self, index, fields):
+        self.indexes[index] = fields
+        self.lookups[index] = {}
+        for key, document in self.rows.items():
+            self._link(index, key, document)
+
+    def _link(self, index, key, document):
+        value = self.index_value(index, document)
+        if value is not _MISSING:
+            self.lookups[index].setdefault(_freeze(value), set()).add(key)
+
+    def _unlink(self, index, key, document):
+        value = self.index_value(index, document)
+        if value is _MISSING:
+            return
+        keys = self.lookups[index].get(_freeze(value))
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.lookups[index][_freeze(value)]
+
+    def put(self, key, document):
+        old = self.rows.get(key)
+        for index in self.indexes:
+            if old is not None:
+                self._unlink(index, key, old)
+            self._link(index, key, document)
+        self.rows[key] = document
+        return old
+
+    def remove(self, key):
+        old = self.rows.pop(key, None)
+        if old is not None:
+            for index in self.indexes:
+                self._unlink(index, key, old)
+        return old
+
+    def find(self, index, value):
+        if index == self.primary_key:
+            document = self.rows.get(value) if not isinstance(value, (list, dict)) else None
+            return [document] if document is not None else []
+        if index in self.lookups:
+            return [self.rows[key] for key in self.lookups[index].get(_freeze(value), ())]
+        # Not an index we have setup, so check every document
+        return [doc for doc in self.rows.values() if self.index_value(index, doc) == value]
+
+    def ordered(self, index, descending=False):
+        # Every document that is in the index, ordered by it
+        documents = [(self.index_value(index, doc), doc) for doc in self.rows.values()]
+        documents = [(value, doc) for value, doc in documents if value is not _MISSING]
+        documents.sort(key=lambda item: _order(item[0]), reverse=descending)
+        return documents
+
+
+class MemoryBackend(Backend):
+    """Keeps everything in memory, without needing a database server
+    This is useful for running the bot locally, in tests, or to benchmark the cogs without a database in the way
+
+    If a path is given, everything is saved to disk as well; every change is appended to a write ahead log
+    (path + '.wal') before it is made, and the log is compacted into a snapshot (path) once it gets long
+    When we connect, the snapshot is loaded and the log is replayed on top of it, so nothing that was logged is lost
+
+    Paramaters:
+        path -> Where the snapshot is saved, if None nothing is saved to disk
+        compact_after -> How many changes can be logged before the log is compacted into the snapshot"""
+
+    name = 'memory'
+
+    def __init__(self, path=None, *, compact_after=10000):
+        self.path = path
+        self.compact_after = compact_after
+        self._tables = {}
+        self._wal = None
+        self._logged = 0
+        self._feeds = {}
+        self._ready = asyncio.Event()
+
+        self.writes = 0
+        self.reads = 0
+        self.compactions = 0
+
+    # Persistence
+
+    def _apply(self, entry):
+        op = entry['op']
+        if op == 'create':
+            self._tables.setdefault(entry['table'], _Table(entry['primary_key']))
+        elif op == 'index':
+            self._tables[entry['table']].add_index(entry['index'], entry['fields'])
+        elif op == 'put':
+            self._tables[entry['table']].put(entry['key'], entry['document'])
+        elif op == 'delete':
+            self._tables[entry['table']].remove(entry['key'])
+
+    def _log(self, entry):
+        # The change is written (and flushed) to the log before it is applied
+        if self._wal is not None:
+            self._wal.write(json.dumps(entry) + '\n')
+            self._wal.flush()
+            self._logged += 1
+        self._apply(entry)
+        if self._wal is not None and self._logged >= self.compact_after:
+            self._compact()
+
+    def _load(self):
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    self._apply(json.loads(line))
+        wal_path = self.path + '.wal'
+        if os.path.exists(wal_path):
+            with open(wal_path) as f:
+                for line in f:
+                    try:
+                        self._apply(json.loads(line))
+                    except ValueError:
+                        # The last line can be cut off if we were stopped mid-write, that change never happened
+                        break
+
+    def _compact(self):
+        # Writes everything we have as a new snapshot, and only once that is fully saved is the old log dropped
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for name, table in self._tables.items():
+                f.write(json.dumps({'op': 'create', 'table': name, 'primary_key': table.primary_key}) + '\n')
+                for index, fields in table.indexes.items():
+                    f.write(json.dumps({'op': 'index', 'table': name, 'index': index, 'fields': fields}) + '\n')
+                for key, document in table.rows.items():
+                    f.write(json.dumps({'op': 'put', 'table': name, 'key': key, 'document': document}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+        if self._wal is not None:
+            self._wal.close()
+        self._wal = open(self.path + '.wal', 'w')
+        self._logged = 0
+        self.compactions += 1
+
+    async def connect(self):
+        if self._ready.is_set():
+            return
+        if self.path is not None:
+            self._load()
+            self._compact()
+        self._ready.set()
+
+    async def close(self):
+        if self._wal is not None:
+            self._wal.close()
+            self._wal = None
+        for queues in self._feeds.values():
+            for queue in queues:
+                queue.put_nowait(None)
+
+    # Helpers used by the operations below
+
+    def _table(self, table):
+        self.reads += 1
+        return self._tables.get(table)
+
+    def _put(self, table, key, document):
+        old = self._tables[table].rows.get(key)
+        self._log({'op': 'put', 'table': table, 'key': key, 'document': document})
+        self._notify(table, old, document)
+
+    def _delete(self, table, key):
+        old = self._tables[table].rows.get(key)
+        self._log({'op': 'delete', 'table': table, 'key': key})
+        self._notify(table, old, None)
+
+    def _notify(self, table, old, new):
+        self.writes += 1
+        for queue in self._feeds.get(table, ()):
+            queue.put_nowait({'old_val': copy.deepcopy(old), 'new_val': copy.deepcopy(new)})
+
+    def _create(self, table, primary_key='id'):
+        if table not in self._tables:
+            self._log({'op': 'create', 'table': table, 'primary_key': primary_key})
+
+    # The operations
+
+    async def table_list(self):
+        return list(self._tables)
+
+    async def ensure(self, tables, indexes):
+        created = []
+        for table, key in tables.items():
+            if table not in self._tables:
+                print("Creating table {}...".format(table))
+                self._create(table, key)
+                created.append(table)
+        for table, table_indexes in indexes.items():
+            for index, fields in table_indexes.items():
+                if self._tables[table].indexes.get(index) != fields:
+                    print("Creating index {} on {}...".format(index, table))
+                    self._log({'op': 'index', 'table': table, 'index': index, 'fields': fields})
+        return created
+
+    async def insert(self, table, content):
+        results = await self.bulk_insert(table, content if isinstance(content, list) else [content])
+        return results.count(True)
+
+    async def get(self, table, key, primary=False):
+        t = self._table(table)
+        try:
+            return copy.deepcopy(t.rows.get(key)) if t is not None else None
+        except TypeError:
+            # Something that can't be a key (like a filter) was given
+            return None
+
+    async def get_all(self, table, index, values, primary=False):
+        t = self._table(table)
+        if t is None:
+            return []
+        documents = {}
+        for value in values:
+            for document in t.find(index, value):
+                documents[document[t.primary_key]] = document
+        return copy.deepcopy(list(documents.values()))
+
+    async def scan(self, table, primary=False):
+        t = self._table(table)
+        return copy.deepcopy(list(t.rows.values())) if t is not None else []
+
+    async def filter(self, table, r_filter, primary=False):
+        t = self._table(table)
+        if t is None:
+            return []
+        return copy.deepcopy([doc for doc in t.rows.values() if _matches(doc, r_filter)])
+
+    async def delete(self, table, key):
+        t = self._table(table)
+        try:
+            if t is None or key not in t.rows:
+                return False
+        except TypeError:
+            return False
+        self._delete(table, key)
+        return True
+
+    async def update(self, table, key, content):
+        t = self._table(table)
+        try:
+            document = t.rows.get(key) if t is not None else None
+        except TypeError:
+            return False
+        if document is None:
+            return False
+        self._put(table, key, _merge(copy.deepcopy(document), content))
+        return True
+
+    async def replace(self, table, key, content):
+        t = self._table(table)
+        try:
+            if t is None or key not in t.rows:
+                return False
+        except TypeError:
+            return False
+        document = copy.deepcopy(content)
+        document[t.primary_key] = key
+        self._put(table, key, document)
+        return True
+
+    async def upsert(self, table, key, patch, increment=False, return_changes=False):
+        t = self._table(table)
+        if t is None:
+            return None if return_changes else False
+        document = copy.deepcopy(t.rows.get(key) or {t.primary_key: key})
+        document = _add(document, patch) if increment else _merge(document, patch)
+        self._put(table, key, document)
+        return copy.deepcopy(document) if return_changes else True
+
+    async def increment(self, table, documents, field):
+        t = self._table(table)
+        if t is None:
+            return False
+        for document in documents:
+            key = document[t.primary_key]
+            saved = t.rows.get(key)
+            if saved is None:
+                saved = copy.deepcopy(document)
+            else:
+                saved = copy.deepcopy(saved)
+                saved[field] = (saved.get(field) or 0) + document[field]
+            self._put(table, key, saved)
+        return len(documents) > 0
+
+    async def append(self, table, key, field, value):
+        t = self._table(table)
+        if t is None:
+            return False
+        document = copy.deepcopy(t.rows.get(key) or {t.primary_key: key})
+        document.setdefault(field, []).append(copy.deepcopy(value))
+        self._put(table, key, document)
+        return True
+
+    async def remove_at(self, table, key, field, index):
+        t = self._table(table)
+        try:
+            document = t.rows.get(key) if t is not None else None
+        except TypeError:
+            return False
+        if document is None or not isinstance(document.get(field), list) or not 0 <= index < len(document[field]):
+            return False
+        document = copy.deepcopy(document)
+        del document[field][index]
+        self._put(table, key, document)
+        return True
+
+    async def bulk_insert(self, table, documents):
+        self._create(table)
+        primary_key = self._tables[table].primary_key
+        results = []
+        for document in documents:
+            document = copy.deepcopy(document)
+            key = document.setdefault(primary_key, str(uuid.uuid4()))
+            if key in self._tables[table].rows:
+                results.append(False)
+                continue
+            self._put(table, key, document)
+            results.append(True)
+        return results
+
+    async def bulk_update(self, table, updates, upsert=False):
+        t = self._table(table)
+        results = {key: False for key in updates}
+        if t is None:
+            return results
+        for key, patch in updates.items():
+            document = t.rows.get(key)
+            if document is None:
+                if not upsert:
+                    continue
+                document = {t.primary_key: key}
+            self._put(table, key, _merge(copy.deepcopy(document), patch))
+            results[key] = True
+        return results
+
+    async def bulk_delete(self, table, keys):
+        t = self._table(table)
+        results = {key: False for key in keys}
+        if t is None:
+            return results
+        for key in keys:
+            if key in t.rows:
+                self._delete(table, key)
+                results[key] = True
+        return results
+
+    async def top(self, table, index, limit, keys=None, primary=False):
+        t = self._table(table)
+        if t is None:
+            return []
+        if keys is not None:
+            documents = [t.rows[key] for key in set(keys) if key in t.rows and index in t.rows[key]]
+            documents.sort(key=lambda doc: _order(doc[index]), reverse=True)
+        else:
+            documents = [doc for _, doc in t.ordered(index, descending=True)]
+        return copy.deepcopy(documents[:limit])
+
+    async def rank(self, table, index, value, keys=None, primary=False):
+        t = self._table(table)
+        if t is None:
+            return 0, 0
+        if keys is not None:
+            documents = [t.rows[key] for key in set(keys) if key in t.rows]
+            values = [doc[index] for doc in documents if index in doc]
+            total = len(documents)
+        else:
+            values = [v for v, _ in t.ordered(index)]
+            total = len(t.rows)
+        higher = len([v for v in values if _order(v) > _order(value)])
+        return higher, total
+
+    async def range(self, table, index, lower, upper, limit=None, descending=False, primary=False):
+        t = self._table(table)
+        if t is None:
+            return []
+        lower, upper = _order(lower), _order(upper)
+        documents = [doc for value, doc in t.ordered(index, descending) if lower <= _order(value) <= upper]
+        if limit is not None:
+            documents = documents[:limit]
+        return copy.deepcopy(documents)
+
+    def iterate(self, table, r_filter=None, batch_size=None, primary=False):
+        return _Iterator(self, table, r_filter)
+
+    def changes(self, table):
+        queue = asyncio.Queue()
+        self._feeds.setdefault(table, []).append(queue)
+        return _Changefeed(self, table, queue)
+
+    def stats(self):
+        stats = super().stats()
+        stats.update({
+            'tables': len(self._tables),
+            'rows': sum(len(t.rows) for t in self._tables.values()),
+            'reads': self.reads,
+            'writes': self.writes,
+            'wal_entries': self._logged,
+            'compactions': self.compactions
+        })
+        return stats
+
+
+class _Iterator:
+    # The documents are all in memory already, so this just hands out copies of them one at a time
+    def __init__(self, backend, table, r_filter):
+        self.backend = backend
+        self.table = table
+        self.r_filter = r_filter
+        self._documents = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._documents is None:
+            t = self.backend._table(self.table)
+            self._documents = iter(list(t.rows.values()) if t is not None else [])
+        for document in self._documents:
+            if self.r_filter is None or _matches(document, self.r_filter):
+                return copy.deepcopy(document)
+        raise StopAsyncIteration
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        self._documents = iter(())
+
+
+class _Changefeed:
+    # Gives every current document, then the ready state, then each change as it is made
+    def __init__(self, backend, table, queue):
+        self.backend = backend
+        self.table = table
+        self.queue = queue
+        self._initial = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._initial is None:
+            # Nothing has been loaded until we've connected, so there's nothing to give until then
+            await self.backend._ready.wait()
+            t = self.backend._tables.get(self.table)
+            initial = [{'new_val': copy.deepcopy(doc)} for doc in t.rows.values()] if t is not None else []
+            initial.append({'state': 'ready'})
+            self._initial = iter(initial)
+        for change in self._initial:
+            return change
+
+        change = await self.queue.get()
+        if change is None:
+            # The backend was closed
+            raise StopAsyncIteration
+        return change
+
+    async def close(self):
+        feeds = self.backend._feeds.get(self.table, [])
+        if self.queue in feeds:
+            feeds.remove(self.queue)
@@ -0,0 +1,556 @@
+import contextlib
+
+import rethinkdb as r
+
+from rethinkdb.net import Cursor
+
+from .base import Backend, BackendUnavailable, minval, maxval
+from ..pool import ConnectionPool, PoolTimeout
+
+
+def _bound(value):
+    # Swaps our minval/maxval for rethinkdb's, including inside of compound index values
+    if value is minval:
+        return r.minval
+    if value is maxval:
+        return r.maxval
+    if isinstance(value, (list, tuple)):
+        return [_bound(v) for v in value]
+    return value
+
+
+def _added(row, patch):
+    # Builds the fields to merge into row, where every number in the patch is added onto what is saved
+    # And anything else in the patch is saved as it is
+    fields = {}
+    for field, value in patch.items():
+        if isinstance(value, dict):
+            fields[field] = _added(row[field].default({}), value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            fields[field] = row[field].default(0).add(value)
+        else:
+            fields[field] = value
+    return fields
+
+
+def _missing(error):
+    # Whether a ReqlOpFailedError was because the table (or database) doesn't exist
+    return 'does not exist' in str(error)
+
+
+@contextlib.contextmanager
+def _availability():
+    # Turns the errors that mean the database can't be reached (or can't do this right now) into BackendUnavailable
+    try:
+        yield
+    except r.ReqlCursorEmpty:
+        # This is just the end of a cursor
+        raise
+    except (r.ReqlDriverError, OSError, PoolTimeout) as e:
+        raise BackendUnavailable(str(e)) from e
+    except r.ReqlOpFailedError as e:
+        # A table (or database) that doesn't exist is reported like this, which the methods below handle
+        # Anything else (such as the primary replica being unavailable) means the database can't do this now
+        if _missing(e):
+            raise
+        raise BackendUnavailable(str(e)) from e
+    except r.ReqlAvailabilityError as e:
+        # We don't know if a write was made, which is just as much the database being unavailable
+        raise BackendUnavailable(str(e)) from e
+
+
+def _written(result):
+    return result.get('inserted', 0) > 0 or result.get('replaced', 0) > 0 or result.get('unchanged', 0) > 0
+
+
+class RethinkBackend(Backend):
+    """Saves everything in a rethinkdb database, every query is ran on a connection from a ConnectionPool
+
+    Reads can be sent somewhere other than the primary, so that heavy reads don't slow down writes
+    Unless primary=True is given to a read, in which case it's always read from the primary with the latest data
+
+    Paramaters:
+        opts -> The options passed to r.connect, db is the database that will be used
+        read_mode -> The read_mode used for reads that don't need to be on the primary, 'outdated' lets any replica
+                     of the table answer the read; even if it's slightly behind the primary
+        read_hosts -> A list of hosts that reads are spread across, instead of the host in opts
+                      Any other read_mode still has every read answered by the table's primary replica
+                      Wherever it's sent, so this needs read_mode to be 'outdated' (which it is if not given)
+        The rest are passed to the ConnectionPool"""
+
+    name = 'rethinkdb'
+
+    def __init__(self, opts, *, read_mode=None, read_hosts=None, **pool_opts):
+        if read_hosts and read_mode is None:
+            read_mode = 'outdated'
+        if read_hosts and read_mode != 'outdated':
+            raise ValueError("Reads sent to db_read_hosts are still answered by the primary with a db_read_mode of {}, "
+                             "set it to outdated (or remove it) to take reads off of the primary".format(read_mode))
+        self.opts = opts
+        self.read_mode = read_mode
+        self.pool = ConnectionPool(opts, **pool_opts)
+        self.read_pools = [ConnectionPool(dict(opts, host=host), **pool_opts) for host in read_hosts or []]
+        self._next_read = 0
+        self._primary_keys = {}
+        self.replica_reads = 0
+        self.primary_reads = 0
+        self.replica_failures = 0
+
+    def _table(self, table, primary):
+        # The table to read from, reads that don't need to be on the primary use read_mode
+        if self.read_mode and not primary:
+            return r.table(table, read_mode=self.read_mode)
+        return r.table(table)
+
+    def _read_pool(self, primary):
+        # Spreads reads across the read hosts, one after the other
+        if primary or not self.read_pools:
+            return self.pool
+        self._next_read = (self._next_read + 1) % len(self.read_pools)
+        return self.read_pools[self._next_read]
+
+    async def _read(self, query, primary):
+        # Runs a read on one of the read hosts, if that host is down the read is made on the primary instead
+        pool = self._read_pool(primary)
+        if pool is not self.pool:
+            try:
+                result = await self._run(query, pool, retry=True)
+                self.replica_reads += 1
+                return result
+            except BackendUnavailable:
+                self.replica_failures += 1
+        self.primary_reads += 1
+        return await self._run(query, retry=True)
+
+    async def _run(self, query, pool=None, *, retry=False):
+        # Runs the query on a connection from the pool, if we get a cursor back it is read in full
+        # Before the connection is given back, as the cursor needs the connection to get the rest of the results
+        # If the driver errors, the pool has thrown away that connection, and the database is most likely down
+        # If retry is True the query is tried once more on a fresh connection first, this is only given for reads
+        # And writes that end up the same if they're made twice; as the first one may have been made before we lost it
+        for attempt in range(2 if retry else 1):
+            try:
+                with _availability():
+                    async with (pool or self.pool).connection() as conn:
+                        result = await query.run(conn)
+                        if isinstance(result, Cursor):
+                            result = await _convert_to_list(result)
+                        return result
+            except BackendUnavailable as e:
+                # Only losing the connection is worth trying again, the pool has already thrown that one away
+                if attempt or not retry or not isinstance(e.__cause__, (r.ReqlDriverError, OSError)):
+                    raise
+
+    async def connect(self):
+        # This also opens the connections the pool keeps around, so that the first commands don't have to
+        try:
+            await self.pool.fill()
+            for pool in self.read_pools:
+                await pool.fill()
+        except (r.ReqlDriverError, OSError) as e:
+            raise BackendUnavailable("Cannot connect to the RethinkDB instance with the following information: "
+                                     "{}".format(self.opts)) from e
+
+    async def close(self):
+        await self.pool.close()
+        for pool in self.read_pools:
+            await pool.close()
+
+    async def table_list(self):
+        try:
+            return await self._run(r.table_list(), retry=True)
+        except r.ReqlOpFailedError:
+            # This means the database does not exist yet
+            return []
+
+    async def ensure(self, tables, indexes):
+        db = self.opts['db']
+        created = []
+        # Get the current databases and check if the one we need is there
+        if db not in await self._run(r.db_list(), retry=True):
+            print('Couldn\'t find database {}...creating now'.format(db))
+            await self._run(r.db_create(db))
+
+        current = await self.table_list()
+        for table, key in tables.items():
+            if table not in current:
+                print("Creating table {}...".format(table))
+                await self._run(r.table_create(table, primary_key=key))
+                created.append(table)
+        print("Done checking tables!")
+
+        # Now make sure all the indexes we query with exist, and are ready to be used
+        for table, table_indexes in indexes.items():
+            current_indexes = await self._run(r.table(table).index_list(), retry=True)
+            for index, fields in table_indexes.items():
+                if index in current_indexes:
+                    continue
+                print("Creating index {} on {}...".format(index, table))
+                if len(fields) == 1:
+                    await self._run(r.table(table).index_create(index, r.row[fields[0]]))
+                else:
+                    await self._run(r.table(table).index_create(index, [r.row[field] for field in fields]))
+            await self._run(r.table(table).index_wait(), retry=True)
+        print("Done checking indexes!")
+        return created
+
+    async def insert(self, table, content):
+        try:
+            result = await self._run(r.table(table).insert(content))
+        except r.ReqlOpFailedError:
+            # This means the table does not exist
+            await self._run(r.table_create(table))
+            result = await self._run(r.table(table).insert(content))
+        return result.get('inserted', 0)
+
+    async def get(self, table, key, primary=False):
+        try:
+            return await self._read(self._table(table, primary).get(key), primary)
+        except r.ReqlOpFailedError:
+            return None
+
+    async def get_all(self, table, index, values, primary=False):
+        try:
+            return await self._read(self._table(table, primary).get_all(*values, index=index), primary)
+        except r.ReqlOpFailedError:
+            return []
+
+    async def scan(self, table, primary=False):
+        try:
+            return await self._read(self._table(table, primary), primary)
+        except r.ReqlOpFailedError:
+            return []
+
+    async def filter(self, table, r_filter, primary=False):
+        try:
+            return await self._read(self._table(table, primary).filter(r_filter), primary)
+        except r.ReqlOpFailedError:
+            return []
+
+    async def delete(self, table, key):
+        try:
+            result = await self._run(r.table(table).get(key).delete(), retry=True)
+        except r.ReqlOpFailedError:
+            return False
+        return result.get('deleted', 0) > 0
+
+    async def update(self, table, key, content):
+        try:
+            result = await self._run(r.table(table).get(key).update(content), retry=True)
+        except r.ReqlOpFailedError:
+            return False
+        return result.get('replaced', 0) > 0 or result.get('unchanged', 0) > 0
+
+    async def replace(self, table, key, content):
+        try:
+            result = await self._run(r.table(table).get(key).replace(content), retry=True)
+        except r.ReqlOpFailedError:
+            return False
+        return result.get('replaced', 0) > 0 or result.get('unchanged', 0) > 0
+
+    async def upsert(self, table, key, patch, increment=False, return_changes=False):
+        # This inserts the patch as a new document, and if a document with this key already exists
+        # The patch gets merged into it instead (the same as an update would)
+        # This is done in one query by the database, so there's no chance of another write sneaking in between
+        # The primary key's name is looked up by the database itself, so that we only need to know the key's value
+        document = r.expr(patch).merge(r.object(r.table(table).info()['primary_key'], key))
+        opts = {'conflict': (lambda _, old, new: old.merge(_added(old, patch))) if increment else 'update'}
+        if return_changes:
+            opts['return_changes'] = 'always'
+
+        try:
+            # Merging the patch in again gives the same document, adding it on again doesn't
+            result = await self._run(r.table(table).insert(document, **opts), retry=not increment)
+        except r.ReqlOpFailedError:
+            result = {}
+
+        # If the changes were requested, give back the document as it is saved now
+        if return_changes:
+            try:
+                return result['changes'][0]['new_val']
+            except (KeyError, IndexError):
+                return None
+        return _written(result)
+
+    async def increment(self, table, documents, field):
+        # This is done by the database in one query, so none of the increments can be lost to another write
+        def increment(key, old, new):
+            return old.merge({field: old[field].default(0).add(new[field])})
+
+        try:
+            result = await self._run(r.table(table).insert(documents, conflict=increment))
+        except r.ReqlOpFailedError:
+            return False
+        return _written(result)
+
+    async def append(self, table, key, field, value):
+        document = r.object(r.table(table).info()['primary_key'], key, field, [value])
+
+        def append(_, old, new):
+            return old.merge({field: old[field].default([]).append(value)})
+
+        try:
+            result = await self._run(r.table(table).insert(document, conflict=append))
+        except r.ReqlOpFailedError:
+            return False
+        return _written(result)
+
+    async def remove_at(self, table, key, field, index):
+        # Checking the index is there is done in the same query, so this can't remove something that was added since
+        def remove(doc):
+            return r.branch(doc[field].default([]).count().gt(index), {field: doc[field].delete_at(index)}, {})
+
+        if index < 0:
+            return False
+        try:
+            result = await self._run(r.table(table).get(key).update(remove))
+        except r.ReqlOpFailedError:
+            return False
+        return result.get('replaced', 0) > 0
+
+    async def _primary_key(self, table):
+        # The bulk writes need to know which field is the primary key, this doesn't change so only ask once
+        key = self._primary_keys.get(table)
+        if key is None:
+            key = self._primary_keys[table] = await self._run(r.table(table).info()['primary_key'], retry=True)
+        return key
+
+    async def bulk_insert(self, table, documents):
+        # With return_changes set to always, there is one change for each document in the order they were given
+        # Including the ones that failed, which have an error instead
+        try:
+            result = await self._run(r.table(table).insert(documents, return_changes='always'))
+        except r.ReqlOpFailedError:
+            # This means the table does not exist
+            await self._run(r.table_create(table))
+            result = await self._run(r.table(table).insert(documents, return_changes='always'))
+        return ['error' not in change and change.get('old_val') is None for change in result.get('changes', [])]
+
+    async def bulk_update(self, table, updates, upsert=False):
+        results = {key: False for key in updates}
+        try:
+            primary_key = await self._primary_key(table)
+            if upsert:
+                documents = [dict(patch, **{primary_key: key}) for key, patch in updates.items()]
+                query = r.table(table).insert(documents, conflict='update', return_changes='always')
+            else:
+                # Each document looks its own patch up, so every update is sent in the same query
+                patches = r.expr({str(key): patch for key, patch in updates.items()})
+                query = r.table(table).get_all(*updates.keys()).update(
+                    lambda doc: patches[doc[primary_key].coerce_to('string')], return_changes='always')
+            result = await self._run(query, retry=True)
+        except r.ReqlOpFailedError:
+            return results
+
+        for change in result.get('changes', []):
+            if 'error' not in change and change.get('new_val') is not None:
+                results[change['new_val'][primary_key]] = True
+        return results
+
+    async def bulk_delete(self, table, keys):
+        results = {key: False for key in keys}
+        try:
+            primary_key = await self._primary_key(table)
+            result = await self._run(r.table(table).get_all(*keys).delete(return_changes=True), retry=True)
+        except r.ReqlOpFailedError:
+            return results
+
+        for change in result.get('changes', []):
+            results[change['old_val'][primary_key]] = True
+        return results
+
+    async def top(self, table, index, limit, keys=None, primary=False):
+        if keys is not None:
+            # The index needs to be on a field of the same name for this to work, as indexes can't be used after get_all
+            query = self._table(table, primary).get_all(*keys).order_by(r.desc(index)).limit(limit)
+        else:
+            query = self._table(table, primary).order_by(index=r.desc(index)).limit(limit)
+
+        try:
+            return await self._read(query, primary)
+        except r.ReqlOpFailedError:
+            return []
+
+    async def rank(self, table, index, value, keys=None, primary=False):
+        # Both of these are counted by the database in one query, so none of the documents need to be sent to us
+        if keys is not None:
+            selection = self._table(table, primary).get_all(*keys)
+            higher = selection.filter(lambda doc: doc[index] > value)
+        else:
+            selection = self._table(table, primary)
+            higher = selection.between(value, r.maxval, index=index, left_bound='open')
+
+        try:
+            result = await self._read(r.expr({'higher': higher.count(), 'total': selection.count()}), primary)
+        except r.ReqlOpFailedError:
+            return 0, 0
+        return result['higher'], result['total']
+
+    async def range(self, table, index, lower, upper, limit=None, descending=False, primary=False):
+        # As this is ordered by the same index we're getting the range from, only the documents returned are read
+        query = self._table(table, primary).between(_bound(lower), _bound(upper), index=index, right_bound='closed')
+        query = query.order_by(index=r.desc(index) if descending else index)
+        if limit is not None:
+            query = query.limit(limit)
+
+        try:
+            return await self._read(query, primary)
+        except r.ReqlOpFailedError:
+            return []
+
+    def iterate(self, table, r_filter=None, batch_size=None, primary=False):
+        query = self._table(table, primary)
+        if r_filter is not None:
+            query = query.filter(r_filter)
+        return ContentIterator(self, query, batch_size, primary)
+
+    def changes(self, table):
+        return Changefeed(self.opts, table)
+
+    def stats(self):
+        stats = super().stats()
+        stats['pool'] = self.pool.stats()
+        if self.read_mode or self.read_pools:
+            stats['read_mode'] = self.read_mode
+            stats['replica_reads'] = self.replica_reads
+            stats['primary_reads'] = self.primary_reads
+            stats['replica_failures'] = self.replica_failures
+            stats['read_pools'] = {pool.opts['host']: pool.stats() for pool in self.read_pools}
+        return stats
+
+
+class ContentIterator:
+    """Goes through the results of a query as they come in, instead of reading them all into a list first
+    The database sends batch_size rows at a time, and the next batch is only requested once we get to it
+    This holds onto a connection from the pool until all rows are read, so if you may stop early use it as:
+
+        async with utils.iter_content('table') as rows:
+            async for row in rows:
+                ...
+
+    This makes sure the cursor is closed and the connection is given back, no matter where you stop"""
+
+    def __init__(self, backend, query, batch_size=None, primary=False):
+        self.backend = backend
+        self.query = query
+        self.batch_size = batch_size
+        self.primary = primary
+        self.pool = None
+        self._conn = None
+        self._cursor = None
+        self._done = False
+
+    async def _open(self):
+        # The same as RethinkBackend._read, if the read host is down the query is made on the primary instead
+        pool = self.backend._read_pool(self.primary)
+        if pool is not self.backend.pool:
+            try:
+                await self._open_on(pool)
+                self.backend.replica_reads += 1
+                return
+            except BackendUnavailable:
+                self.backend.replica_failures += 1
+        self.backend.primary_reads += 1
+        await self._open_on(self.backend.pool)
+
+    async def _open_on(self, pool):
+        with _availability():
+            self._conn = await pool.acquire()
+            self.pool = pool
+            try:
+                opts = {'max_batch_rows': self.batch_size} if self.batch_size else {}
+                self._cursor = await self.query.run(self._conn, **opts)
+            except BaseException as e:
+                # Give the connection back (or throw it away if the driver errored) so we can try again on another host
+                conn, self._conn = self._conn, None
+                await pool.release(conn, discard=isinstance(e, (r.ReqlDriverError, OSError)))
+                raise
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._done:
+            raise StopAsyncIteration
+
+        try:
+            if self._cursor is None:
+                await self._open()
+            with _availability():
+                return await self._cursor.next()
+        except (r.ReqlCursorEmpty, r.ReqlOpFailedError):
+            # Either we've read everything, or the table doesn't exist; either way there's nothing left
+            await self.close()
+            raise StopAsyncIteration
+        except BaseException:
+            await self.close()
+            raise
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        """Stops reading any more rows, and gives the connection back to the pool"""
+        self._done = True
+        cursor, conn = self._cursor, self._conn
+        self._cursor = self._conn = None
+        try:
+            # A cursor that has already been read through is closed already, so there's nothing to wait on
+            closing = cursor.close() if cursor is not None else None
+            if closing is not None:
+                await closing
+        except r.ReqlError:
+            pass
+        finally:
+            if conn is not None:
+                await self.pool.release(conn)
+
+
+class Changefeed:
+    """Follows a table's changefeed, raising BackendUnavailable if the feed is lost
+    The changefeed holds onto its connection for as long as it's open
+    So this uses its own connection, instead of holding one from the pool forever"""
+
+    def __init__(self, opts, table):
+        self.opts = opts
+        self.table = table
+        self._conn = None
+        self._cursor = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            if self._cursor is None:
+                self._conn = await r.connect(**self.opts)
+                query = r.table(self.table).changes(include_initial=True, include_states=True, squash=False)
+                self._cursor = await query.run(self._conn)
+            return await self._cursor.next()
+        except (r.ReqlError, OSError) as e:
+            raise BackendUnavailable(str(e)) from e
+
+    async def close(self):
+        conn = self._conn
+        self._conn = self._cursor = None
+        if conn is not None:
+            try:
+                await conn.close(noreply_wait=False)
+            except (r.ReqlError, OSError):
+                pass
+
+
+async def _convert_to_list(cursor):
+    # This method is here because atm, AsyncioCursor is not iterable
+    # For our purposes, we want a list, so we need to do this manually
+    cursor_list = []
+    while True:
+        try:
+            val = await cursor.next()
+            cursor_list.append(val)
+        except r.ReqlCursorEmpty:
+            break
+    return cursor_list
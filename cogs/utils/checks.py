@@ -1,9 +1,10 @@
 import asyncio
-import rethinkdb as r
+import functools
 
 from discord.ext import commands
 import discord
 from . import config
+from . import usage
 
 loop = asyncio.get_event_loop()
 
@@ -11,7 +12,7 @@ loop = asyncio.get_event_loop()
 required_tables = {
     'battle_records': 'member_id',
     'boops': 'member_id',
-    'command_usage': 'command',
+    'command_counts': 'id',
     'motd': 'date',
     'overwatch': 'member_id',
     'picarto': 'member_id',
@@ -24,49 +25,64 @@ required_tables = {
     'twitch': 'member_id'
 }
 
+# The secondary indexes needed for the tables, as index name: the fields it is made of
+# An index with more than one field is a compound index, which is queried with a list of values in the same order
+required_indexes = {
+    'battle_records': {'rating': ['rating']},
+    'command_counts': {'scope_count': ['scope', 'scope_id', 'count']},
+    'picarto': {'notifications_on': ['notifications_on']},
+    'raffles': {'server_id': ['server_id'], 'expires': ['expires']},
+    'tags': {'server_id_tag': ['server_id', 'tag']},
+    'twitch': {'notifications_on': ['notifications_on']}
+}
+
 
 async def db_check():
     """Used to check if the required database/tables are setup"""
-    db_opts = config.db_opts
-
-    r.set_loop_type('asyncio')
     # First try to connect, and see if the correct information was provided
     try:
-        conn = await r.connect(**db_opts)
-    except r.errors.ReqlDriverError:
-        print("Cannot connect to the RethinkDB instance with the following information: {}".format(db_opts))
+        await config.backend.connect()
+    except config.BackendUnavailable as e:
+        print(e)
 
-        print("The RethinkDB instance you have setup may be down, otherwise please ensure you setup a"
-              " RethinkDB instance, and you have provided the correct database information in config.yml")
+        print("The database you have setup may be down, otherwise please ensure you setup a database"
+              " and you have provided the correct database information in config.yml")
         quit()
         return
 
-    # Get the current databases and check if the one we need is there
-    dbs = await r.db_list().run(conn)
-    if db_opts['db'] not in dbs:
-        # If not, we want to create it
-        print('Couldn\'t find database {}...creating now'.format(db_opts['db']))
-        await r.db_create(db_opts['db']).run(conn)
-        # Then add all the tables
-        for table, key in required_tables.items():
-            print("Creating table {}...".format(table))
-            await r.table_create(table, primary_key=key).run(conn)
-        print("Done!")
-    else:
-        # Otherwise, if the database is setup, make sure all the required tables are there
-        tables = await r.table_list().run(conn)
-        for table, key in required_tables.items():
-            if table not in tables:
-                print("Creating table {}...".format(table))
-                await r.table_create(table, primary_key=key).run(conn)
-        print("Done checking tables!")
+    # Command usage used to be saved as one document per command, if that's all that is here it needs to be
+    # copied over to the new table, once the new table has been created (or finished, if that was interrupted)
+    tables = await config.backend.table_list()
+
+    # Make sure all the required tables are there, as well as the indexes we query with
+    await config.backend.ensure(required_tables, required_indexes)
+
+    await usage.migrate_command_usage(tables)
+
+    # Now that we're connected, any writes left in the journal from before can be made
+    # And the command usage counted so far can start being saved
+    config.write_journal.start(loop)
+    usage.usage_buffer.start(loop)
 
 
 def is_owner(ctx):
     return ctx.message.author.id in config.owner_ids
 
 
+@functools.lru_cache(maxsize=None)
+def _permissions(value):
+    # There are only so many different permission values that get saved
+    # So create the Permissions object for each one once, rather than for every command ran
+    return discord.Permissions(value)
+
+
 def custom_perms(**perms):
+    # Set the default permissions based on what was passed, this will be overriden later if we have custom permissions
+    # This doesn't change, so there's no need to create this every time the check is ran
+    default_perm = discord.Permissions.none()
+    for perm, setting in perms.items():
+        setattr(default_perm, perm, setting)
+
     def predicate(ctx):
         # Return true if this is a private channel, we'll handle that in the registering of the command
         if ctx.message.channel.is_private:
@@ -74,17 +90,15 @@ def custom_perms(**perms):
 
         # Get the member permissions so that we can compare
         member_perms = ctx.message.author.permissions_in(ctx.message.channel)
-        # Next, set the default permissions if one is not used, based on what was passed
-        # This will be overriden later, if we have custom permissions
-        required_perm = discord.Permissions.none()
-        for perm, setting in perms.items():
-            setattr(required_perm, perm, setting)
+        required_perm = default_perm
 
         try:
-            server_settings = config.cache.get('server_settings').values
-            required_perm_value = [x for x in server_settings if x['server_id'] == ctx.message.server.id][0]['permissions'][ctx.command.qualified_name]
-            required_perm = discord.Permissions(required_perm_value)
-        except (TypeError, IndexError, KeyError):
+            server_settings = config.cache['server_settings'].get(ctx.message.server.id)
+            required_perm_value = server_settings['permissions'][ctx.command.qualified_name]
+            # Removed permissions are saved as None, which means the defaults are used again
+            if required_perm_value is not None:
+                required_perm = _permissions(required_perm_value)
+        except (TypeError, KeyError):
             pass
 
         # Now just check if the person running the command has these permissions
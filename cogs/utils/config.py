@@ -1,8 +1,14 @@
 import ruamel.yaml as yaml
 import asyncio
-import rethinkdb as r
+import logging
 import pendulum
 
+from .backends import BackendUnavailable, minval, maxval
+from .lru import LRUCache, MISSING
+from .metrics import QueryStats
+from .journal import WriteJournal, JOURNALED
+
+log = logging.getLogger()
 loop = asyncio.get_event_loop()
 global_config = {}
 
@@ -29,19 +35,85 @@ except KeyError:
     quit()
 
 
-# This is a simple class for the cache concept, all it holds is it's own key and the values
-# With a method that gets content based on it's key
+# This is a simple class for the cache concept, it holds it's own key and the documents in that table
+# The documents are kept up to date by following the table's changefeed, so that each change made
+# Is applied to what we have saved here, rather than reloading the whole table every time something is changed
 class Cache:
-    def __init__(self, key):
+    def __init__(self, key, primary_key):
         self.key = key
-        self.values = {}
+        self.primary_key = primary_key
+        self.documents = {}
         self.refreshed = pendulum.utcnow()
-        loop.create_task(self.update())
+        # Whether or not we are currently following the changefeed, if we're not our documents may be out of date
+        self.live = False
+        self.resyncs = 0
+        self.changes = 0
+        self._task = loop.create_task(self.follow())
+
+    @property
+    def values(self):
+        return self.documents.values()
+
+    def get(self, key):
+        """Returns the document saved with this primary key, or None if there isn't one"""
+        return self.documents.get(key)
+
+    def staleness(self):
+        """Returns how many seconds our documents may be out of date for, 0 if we're following the changefeed"""
+        if self.live:
+            return 0
+        return (pendulum.utcnow() - self.refreshed).total_seconds()
+
+    def _apply(self, documents, change):
+        old = change.get('old_val')
+        new = change.get('new_val')
+        if new is not None:
+            documents[new[self.primary_key]] = new
+        elif old is not None:
+            documents.pop(old[self.primary_key], None)
 
     async def update(self):
-        self.values = await get_content(self.key)
+        """Reloads every document in the table"""
+        content = await get_content(self.key) or []
+        self.documents = {doc[self.primary_key]: doc for doc in content}
         self.refreshed = pendulum.utcnow()
 
+    async def follow(self):
+        delay = 1
+        while True:
+            feed = backend.changes(self.key)
+            try:
+                self.resyncs += 1
+
+                # Until the feed tells us it is ready, we're given all the current documents
+                # So build those up separately, and keep using the old ones until this is done
+                documents = {}
+                async for change in feed:
+                    state = change.get('state')
+                    if state == 'ready':
+                        self.documents = documents
+                        self.live = True
+                        delay = 1
+                    elif state is None:
+                        self._apply(documents, change)
+                        self.changes += 1
+                    self.refreshed = pendulum.utcnow()
+            except asyncio.CancelledError:
+                raise
+            except BackendUnavailable as e:
+                log.warning("Lost the changefeed for {}: {}".format(self.key, e))
+            finally:
+                self.live = False
+                await feed.close()
+
+            # Wait a bit before subscribing again, increasing that wait if the database stays unavailable
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+
+    def close(self):
+        """Stops following the changefeed"""
+        self._task.cancel()
+
 
 # Default bot's description
 bot_description = global_config.get("description")
@@ -55,6 +127,20 @@ discord_bots_key = global_config.get('discord_bots_key', "")
 carbon_key = global_config.get('carbon_key', "")
 # The client ID for twitch requsets
 twitch_key = global_config.get('twitch_key', "")
+# Where the twitch API is, this can be changed to point the poller at a fake API (see benchmarks/fake_twitch.py)
+twitch_api_url = global_config.get('twitch_api_url', "https://api.twitch.tv/kraken")
+# How many channels are checked in one request (twitch allows up to 100), and how many of those requests are made at once
+twitch_batch_size = min(global_config.get('twitch_batch_size', 100), 100)
+twitch_batch_concurrency = global_config.get('twitch_batch_concurrency', 4)
+# The most stream notifications (someone going live or offline) that are sent at once
+notification_concurrency = global_config.get('notification_concurrency', 5)
+# How often (in seconds) we check for anyone going live or offline on twitch/picarto
+# This is checked more often (down to the min) while people are going live/offline, and less often (up to the max) when not
+stream_poll_interval = global_config.get('stream_poll_interval', 30)
+stream_poll_min_interval = global_config.get('stream_poll_min_interval', 15)
+stream_poll_max_interval = global_config.get('stream_poll_max_interval', 90)
+# How much (as a fraction of their interval) background jobs' waits are randomly changed by, so shards aren't in step
+poll_jitter = global_config.get('poll_jitter', 0.1)
 # The steam API key
 steam_key = global_config.get("steam_key", "")
 # The key for youtube API calls
@@ -93,6 +179,94 @@ db_pass = global_config.get('db_pass', '')
 # db_opts = {'host': db_host, 'db': db_name, 'port': db_port, 'ssl':
 # {'ca_certs': db_cert}, 'user': db_user, 'password': db_pass}
 db_opts = {'host': db_host, 'db': db_name, 'port': db_port, 'user': db_user, 'password': db_pass}
+# Where everything is saved, either 'rethinkdb', or 'memory' to keep everything in memory without a database server
+db_backend = global_config.get('db_backend', 'rethinkdb')
+# Where the memory backend saves everything to disk, if this isn't set nothing is saved when the bot stops
+db_path = global_config.get('db_path', None)
+# Reads that don't need the latest data can be sent somewhere other than the primary, to take load off of it
+# db_read_mode can be set to 'outdated' to let any replica of a table answer reads, even if it's a bit behind
+# And db_read_hosts is a list of hosts that reads are spread across, instead of db_host
+# Which needs db_read_mode to be 'outdated', this is the default when there are read hosts
+db_read_mode = global_config.get('db_read_mode', None)
+db_read_hosts = global_config.get('db_read_hosts', [])
+# The least and most amount of connections we'll keep open to the database
+db_pool_min = global_config.get('db_pool_min', 1)
+db_pool_max = global_config.get('db_pool_max', 10)
+# How long we'll wait for a connection to free up, before giving up on a query
+db_pool_timeout = global_config.get('db_pool_timeout', 10)
+
+# The backend that every helper below goes through
+# The rethinkdb driver is only imported if we're using it, so the memory backend doesn't need it installed
+if db_backend == 'memory':
+    from .backends.memory import MemoryBackend
+
+    backend = MemoryBackend(db_path)
+elif db_backend == 'rethinkdb':
+    from .backends.rethink import RethinkBackend
+
+    try:
+        backend = RethinkBackend(db_opts, read_mode=db_read_mode, read_hosts=db_read_hosts, min_size=db_pool_min,
+                                 max_size=db_pool_max, timeout=db_pool_timeout)
+    except ValueError as e:
+        print(e)
+        quit()
+else:
+    print("Unknown db_backend {}, this needs to be either rethinkdb or memory".format(db_backend))
+    quit()
+
+# How often (in seconds) command usage is saved, and how many usage counters can wait to be saved at once
+usage_flush_interval = global_config.get('usage_flush_interval', 10)
+usage_buffer_size = global_config.get('usage_buffer_size', 10000)
+
+# The tables that get_content will cache documents for, based on their key
+# This is setup in config.yml as table_cache, for example:
+# table_cache:
+#   server_settings: {ttl: 300, size: 5000, negative_ttl: 60}
+table_caches = {table: LRUCache(**opts) for table, opts in (global_config.get('table_cache') or {}).items()}
+
+# How many rows we ask the database for at a time, when going through a table with iter_content/iter_filter
+db_batch_size = global_config.get('db_batch_size', 200)
+
+# How many documents are sent in one query, when writing many at once with the bulk_* helpers
+db_write_batch_size = global_config.get('db_write_batch_size', 500)
+
+# Where writes are saved while the database is unavailable, so they can be made once it's back
+db_journal_path = global_config.get('db_journal_path', 'write_journal')
+# The most writes that can wait in the journal, and how often (in seconds) we check if the database is back
+db_journal_size = global_config.get('db_journal_size', 10000)
+db_journal_interval = global_config.get('db_journal_interval', 5)
+
+# How long (in milliseconds) a query can take before it is logged as slow
+slow_query_ms = global_config.get('slow_query_ms', 250)
+
+# Every helper below records how long it took, and how many rows it returned, in here
+query_stats = QueryStats(slow_threshold=slow_query_ms)
+
+# The most connections the http client can have open at once, in total and to any one host
+http_limit = global_config.get('http_limit', 100)
+http_limit_per_host = global_config.get('http_limit_per_host', 10)
+# How long (in seconds) DNS lookups are cached for, and how long an idle connection is kept open to be reused
+http_dns_ttl = global_config.get('http_dns_ttl', 300)
+http_keepalive = global_config.get('http_keepalive', 30)
+# The most responses that are cached at once, for requests that ask to be cached
+http_cache_size = global_config.get('http_cache_size', 1000)
+# How many times a failed request is retried, and how long (in seconds) the first and longest waits between retries are
+http_retries = global_config.get('http_retries', 3)
+http_backoff = global_config.get('http_backoff', 0.5)
+http_backoff_max = global_config.get('http_backoff_max', 10)
+# How long (in seconds) each attempt at a request can take, and how long the request can take in total
+http_timeout = global_config.get('http_timeout', 10)
+http_deadline = global_config.get('http_deadline', 30)
+# How many requests a second can be made to a host, and how many can be made at once after not making any for a while
+# 0 means hosts aren't limited unless they're given their own limit in http_rate_limits, in the format:
+#   api.twitch.tv: {rate: 1, burst: 5}
+http_rate = global_config.get('http_rate', 10)
+http_burst = global_config.get('http_burst', 20)
+http_rate_limits = global_config.get('http_rate_limits') or {}
+
+# The most bytes that can be downloaded (such as an image), and how many are held in memory before using a temporary file
+download_max_size = global_config.get('download_max_size', 8 * 1024 * 1024)
+download_spool_size = global_config.get('download_spool_size', 1024 * 1024)
 
 # This will be a dictionary that holds the cache object, based on the key that is saved
 cache = {}
@@ -104,7 +278,7 @@ cache = {}
     ca che[k] = Cache(k)"""
 
 # We still need 'cache' for prefixes and custom permissions however, so for now, just include that
-cache['server_settings'] = Cache('server_settings')
+cache['server_settings'] = Cache('server_settings', 'server_id')
 
 async def update_cache():
     for value in cache.values():
@@ -116,128 +290,278 @@ def command_prefix(bot, message):
     # So assume it's in cache, or it doesn't exist
     # If the prefix does exist in the database and isn't in our cache; too bad, something has messed up
     # But it is not worth a query for every single message the bot detects, to fix
+    # The cache is keyed by the server's ID, so this is the same cost no matter how many servers we're in
     try:
-        prefixes = cache['server_settings'].values
-        prefix = [x for x in prefixes if x['server_id'] == message.server.id][0]['prefix']
-        return prefix or default_prefix
-    except (KeyError, TypeError, IndexError, AttributeError):
+        server_settings = cache['server_settings'].get(message.server.id)
+        return server_settings.get('prefix') or default_prefix
+    except (KeyError, TypeError, AttributeError):
         return default_prefix
 
 
+def _invalidate(table, key=None):
+    # Called after anything is written, so that the next get_content goes to the database instead of the cache
+    table_cache = table_caches.get(table)
+    if table_cache is None:
+        return
+    if key is None:
+        table_cache.clear()
+    else:
+        table_cache.invalidate(key)
+
+
+async def _write(op, table, key, *args, entries=None):
+    # Makes the write on the backend, unless it's unavailable (or there are older writes still waiting to be made)
+    # Then the write is added to the journal to be made once it's back, and JOURNALED is returned instead
+    # The bulk helpers give the writes for each of their documents as entries, so that those can be deduped
+    # They return JOURNALED for each document themselves
+    # If writes are waiting, they're made first if the backend is back, so that reads aren't left waiting on the journal
+    if await write_journal.catch_up():
+        try:
+            return await getattr(backend, op)(table, *args)
+        except BackendUnavailable as e:
+            log.warning("Couldn't write to {}, saving the write in the journal: {}".format(table, e))
+
+    entries = entries or [(op, key, args)]
+    if not all(write_journal.serializable(entry_key, *entry_args) for _, entry_key, entry_args in entries):
+        # Such as a lambda filter, which can't be saved to be made later, so this write isn't made at all
+        log.error("Couldn't write to {}, and the write can't be saved in the journal so it wasn't made: {}".format(
+            table, op))
+        return None
+
+    for entry_op, entry_key, entry_args in entries:
+        write_journal.add(entry_op, table, entry_key, *entry_args)
+    return JOURNALED
+
+
+async def _replay(op, table, args):
+    # Makes a write that was saved in the journal
+    await getattr(backend, op)(table, *args)
+    _invalidate(table)
+
+
+# Writes that failed because the database was unavailable wait in here, until they can be made
+write_journal = WriteJournal(db_journal_path or None, _replay, max_size=db_journal_size, interval=db_journal_interval)
+
+
+@query_stats.timed('add')
 async def add_content(table, content):
-    r.set_loop_type("asyncio")
-    conn = await r.connect(**db_opts)
     # First we need to make sure that this entry doesn't exist
     # For all rethinkDB cares, multiple entries can exist with the same content
     # For our purposes however, we do not want this
-    try:
-        result = await r.table(table).insert(content).run(conn)
-    except r.ReqlOpFailedError:
-        # This means the table does not exist
-        await r.table_create(table).run(conn)
-        await r.table(table).insert(content).run(conn)
-        result = {}
+    inserted = await _write('insert', table, None, content)
 
-    await conn.close()
-    if table == 'server_settings':
-        loop.create_task(cache[table].update())
-    return result.get('inserted', 0) > 0
+    # We don't know the name of this table's primary key here, so forget everything we cached for it
+    _invalidate(table)
 
+    if inserted is JOURNALED:
+        return JOURNALED
+    return inserted > 0
 
-async def remove_content(table, key):
-    r.set_loop_type("asyncio")
-    conn = await r.connect(**db_opts)
-    try:
-        result = await r.table(table).get(key).delete().run(conn)
-    except r.ReqlOpFailedError:
-        result = {}
-        pass
 
-    await conn.close()
-    if table == 'server_settings':
-        loop.create_task(cache[table].update())
-    return result.get('deleted', 0) > 0
+@query_stats.timed('remove')
+async def remove_content(table, key):
+    result = await _write('delete', table, key, key)
+    _invalidate(table, key)
+    return result
 
 
+@query_stats.timed('update')
 async def update_content(table, content, key):
-    r.set_loop_type("asyncio")
-    conn = await r.connect(**db_opts)
     # This method is only for updating content, so if we find that it doesn't exist, just return false
-    try:
-        # Update based on the content and filter passed to us
-        # rethinkdb allows you to do many many things inside of update
-        # This is why we're accepting a variable and using it, whatever it may be, as the query
-        result = await r.table(table).get(key).update(content).run(conn)
-    except r.ReqlOpFailedError:
-        result = {}
-
-    await conn.close()
-    if table == 'server_settings':
-        loop.create_task(cache[table].update())
-    return result.get('replaced', 0) > 0 or result.get('unchanged', 0) > 0
+    # The content is merged into what is saved, nested objects included
+    result = await _write('update', table, key, key, content)
+    _invalidate(table, key)
+    return result
 
 
+@query_stats.timed('replace')
 async def replace_content(table, content, key):
     # This method is here because .replace and .update can have some different functionalities
-    r.set_loop_type("asyncio")
-    conn = await r.connect(**db_opts)
-    try:
-        result = await r.table(table).get(key).replace(content).run(conn)
-    except r.ReqlOpFailedError:
-        result = {}
+    result = await _write('replace', table, key, key, content)
+    _invalidate(table, key)
+    return result
+
+
+@query_stats.timed('upsert')
+async def upsert_content(table, key, patch, *, increment=False, return_changes=False):
+    # This inserts the patch as a new document, and if a document with this key already exists
+    # The patch gets merged into it instead (the same as an update would)
+    # If increment is True, the numbers in the patch are added onto what is saved instead, treating missing ones as 0
+    # This is done in one query by the database, so there's no chance of another write sneaking in between
+    # If the changes are requested, the document as it is saved now is returned
+    # If the write has to wait in the journal, we don't know what the document will be yet, so JOURNALED is returned
+    result = await _write('upsert', table, key, key, patch, increment, return_changes)
+    _invalidate(table, key)
+    return result
+
+
+@query_stats.timed('increment')
+async def increment_content(table, content, field='count'):
+    # Inserts the documents given, and for any that already exist, adds their field onto what is saved instead
+    # This is done by the database in one query, so none of the increments can be lost to another write
+    result = await _write('increment', table, None, content, field)
+    _invalidate(table)
+    return result
+
+
+@query_stats.timed('append')
+async def append_content(table, key, field, value):
+    # Appends value to the list saved in field, creating the list (and the document) if they don't exist yet
+    # This is done in one query, so two appends at the same time can't overwrite each other
+    result = await _write('append', table, key, key, field, value)
+    _invalidate(table, key)
+    return result
+
+
+@query_stats.timed('remove_at')
+async def remove_at_content(table, key, field, index):
+    # Removes the value at index from the list saved in field, returning False if there was nothing there to remove
+    # This is done in one query, so a value appended at the same time can't be lost
+    result = await _write('remove_at', table, key, key, field, index)
+    _invalidate(table, key)
+    return result
+
+
+def _batches(items):
+    # Splits the items up into lists of db_write_batch_size, so that one huge write doesn't hold everything else up
+    items = list(items)
+    for i in range(0, len(items), db_write_batch_size):
+        yield items[i:i + db_write_batch_size]
+
+
+@query_stats.timed('bulk_add')
+async def bulk_add_content(table, documents):
+    """Inserts every document given, in one query per batch
+    Returns a list of whether each document was inserted, in the same order they were given"""
+    results = []
+    for batch in _batches(documents):
+        result = await _write('bulk_insert', table, None, batch)
+        results.extend([JOURNALED] * len(batch) if result is JOURNALED else result)
+
+    _invalidate(table)
+    return results
+
+
+@query_stats.timed('bulk_update')
+async def bulk_update_content(table, updates, *, upsert=False):
+    """Merges each patch into the document with its key, given as a dictionary of key: patch
+    Each batch is sent in one query, instead of one update_content per document
+    If upsert is True, documents that don't exist yet are created from their patch
+    Returns a dictionary of key: whether that document was updated"""
+    results = {}
+    for batch in _batches(updates.items()):
+        # If these need to be journaled, each document is journaled on its own so that they can be deduped
+        op, extra = ('upsert', [False, False]) if upsert else ('update', [])
+        entries = [(op, key, [key, patch] + extra) for key, patch in batch]
+        result = await _write('bulk_update', table, None, dict(batch), upsert, entries=entries)
+        results.update({key: JOURNALED for key, _ in batch} if result is JOURNALED else result)
+
+    for key in updates:
+        _invalidate(table, key)
+    return results
+
+
+@query_stats.timed('bulk_remove')
+async def bulk_remove_content(table, keys):
+    """Removes every document with one of these keys, in one query per batch
+    Returns a dictionary of key: whether that document existed"""
+    results = {}
+    for batch in _batches(keys):
+        entries = [('delete', key, [key]) for key in batch]
+        result = await _write('bulk_delete', table, None, batch, entries=entries)
+        results.update({key: JOURNALED for key in batch} if result is JOURNALED else result)
+
+    for key in keys:
+        _invalidate(table, key)
+    return results
+
+
+@query_stats.timed('get')
+async def get_content(table, key=None, *, primary=False):
+    # Reads (this and the helpers below) can be answered by a replica, if one is setup
+    # If primary is True, the read is made on the primary instead; for when we need the latest data
+    # Such as when what is read is about to be changed and written back
+
+    # If this table is setup to be cached, check if we already have this document first
+    # A read from the primary skips this, as what's cached could be out of date as well
+    table_cache = table_caches.get(table) if key else None
+    if table_cache is not None and not primary:
+        content = table_cache.get(key)
+        if content is not MISSING:
+            return content
+
+    # If this key is written to while we're reading it, what we read can't be cached as it may be out of date
+    version = table_cache.version(key) if table_cache is not None else None
+    if key:
+        content = await backend.get(table, key, primary)
+    else:
+        content = await backend.scan(table, primary) or None
+
+    if table_cache is not None:
+        table_cache.set(key, content, version)
+    return content
 
-    await conn.close()
-    if table == 'server_settings':
-        loop.create_task(cache[table].update())
-    return result.get('replaced', 0) > 0 or result.get('unchanged', 0) > 0
 
+@query_stats.timed('filter')
+async def filter_content(table: str, r_filter, *, primary=False):
+    return await backend.filter(table, r_filter, primary) or None
 
-async def get_content(table, key=None):
-    r.set_loop_type("asyncio")
-    conn = await r.connect(**db_opts)
 
-    try:
-        if key:
-            cursor = await r.table(table).get(key).run(conn)
-        else:
-            cursor = await r.table(table).run(conn)
-        if cursor is None:
-            content = None
-        elif type(cursor) is not dict:
-            content = await _convert_to_list(cursor)
-            if len(content) == 0:
-                content = None
-        else:
-            content = cursor
-    except (IndexError, r.ReqlOpFailedError):
-        content = None
-
-    await conn.close()
-    return content
+@query_stats.timed('get_all')
+async def get_all_content(table: str, index: str, *values, primary=False):
+    # This gets every document that matches any of the values given on the index
+    # Unlike filter_content, this only has to look at the matching documents, instead of the whole table
+    # For compound indexes, each value is a list of the fields in the same order as the index
+    return await backend.get_all(table, index, values, primary) or None
 
-async def filter_content(table: str, r_filter):
-    r.set_loop_type("asyncio")
-    conn = await r.connect(**db_opts)
-    try:
-        cursor = await r.table(table).filter(r_filter).run(conn)
-        content = await _convert_to_list(cursor)
-        if len(content) == 0:
-            content = None
-    except (IndexError, r.ReqlOpFailedError):
-        content = None
-
-    await conn.close()
-    return content
 
+@query_stats.timed('top')
+async def get_top_content(table: str, index: str, limit: int, *, keys=None, primary=False):
+    """Returns the top documents (highest first) based on the index given, up to limit of them
+    If keys is provided, only the documents with those primary keys are included
 
-async def _convert_to_list(cursor):
-    # This method is here because atm, AsyncioCursor is not iterable
-    # For our purposes, we want a list, so we need to do this manually
-    cursor_list = []
-    while True:
-        try:
-            val = await cursor.next()
-            cursor_list.append(val)
-        except r.ReqlCursorEmpty:
-            break
-    return cursor_list
+    This uses the index to read only the documents returned, so the cost depends on limit
+    (or how many keys are given) and not on how big the table is"""
+    if keys is not None and len(keys) == 0:
+        return []
+    return await backend.top(table, index, limit, keys, primary)
+
+
+@query_stats.timed('range')
+async def get_range_content(table: str, index: str, lower, upper, *, limit=None, descending=False, primary=False):
+    """Returns the documents with a value on the index between lower and upper (inclusive), ordered by that index
+    As this is ordered by the same index we're getting the range from, only the documents returned are read
+    For compound indexes, minval and maxval can be used to match anything in the remaining fields"""
+    return await backend.range(table, index, lower, upper, limit, descending, primary)
+
+
+@query_stats.timed('rank')
+async def get_rank(table: str, index: str, value, *, keys=None, primary=False):
+    """Returns a tuple of (rank, total), where rank is where value would place (1 being the highest)
+    Based on the index given, and total is how many documents there are
+    If keys is provided, only the documents with those primary keys are counted
+
+    Both of these are counted by the database in one query, so none of the documents need to be sent to us"""
+    if keys is not None and len(keys) == 0:
+        return 1, 0
+    higher, total = await backend.rank(table, index, value, keys, primary)
+    return higher + 1, total
+
+
+@query_stats.timed_iterator('iter')
+def iter_content(table: str, *, batch_size=None, primary=False):
+    """Returns an async iterator over every document in the table
+    The rows are read in batches as they're needed, instead of all at once. If you may stop early use it as:
+
+        async with utils.iter_content('table') as rows:
+            async for row in rows:
+                ...
+
+    This makes sure everything used to read the rows is cleaned up, no matter where you stop"""
+    return backend.iterate(table, None, batch_size or db_batch_size, primary)
+
+
+@query_stats.timed_iterator('iter_filter')
+def iter_filter(table: str, r_filter, *, batch_size=None, primary=False):
+    """Returns an async iterator over every document in the table that matches the filter"""
+    return backend.iterate(table, r_filter, batch_size or db_batch_size, primary)
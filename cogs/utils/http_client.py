@@ -0,0 +1,312 @@
+import asyncio
+import collections
+import copy
+import email.utils
+import functools
+import random
+import time
+import urllib.parse
+
+import aiohttp
+
+from . import config
+from .lru import MISSING
+from .ratelimit import RateLimiter, INTERACTIVE
+
+
+class HTTPClient:
+    """One aiohttp session that every request the bot makes goes through
+    Connections are kept alive and reused, and DNS lookups are cached, so that requests to the same host
+    don't have to look it up and connect (and do a TLS handshake) all over again
+
+    The connector in the aiohttp we use can't limit connections per host, or expire its DNS cache
+    So requests wait on a semaphore (in total, and for their host) here instead, and the cache is cleared every dns_ttl
+
+    Paramaters:
+        limit -> The most requests that can be made at once
+        limit_per_host -> The most requests that can be made to one host at once
+        dns_ttl -> How long (in seconds) DNS lookups are cached for
+        keepalive -> How long (in seconds) an idle connection is kept open for, to be reused
+        limiter -> The RateLimiter that requests wait on before they're made"""
+
+    def __init__(self, *, limit=100, limit_per_host=10, dns_ttl=300, keepalive=30, limiter=None):
+        self.limiter = limiter or RateLimiter(rate=None)
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.keepalive = keepalive
+        self._session = None
+        self._dns_cleared = time.monotonic()
+        # These are created the first time they're needed, so that they're made on the bot's event loop
+        self._semaphore = None
+        self._host_semaphores = {}
+
+        self.sessions = 0
+        self.requests = collections.Counter()
+
+    @property
+    def session(self):
+        """The session to make requests with, this is created the first time it's needed
+        (and again if it was closed) so it should only be used from inside a coroutine"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(use_dns_cache=True, keepalive_timeout=self.keepalive)
+            self._session = aiohttp.ClientSession(connector=connector, headers={'User-Agent': config.user_agent})
+            self._dns_cleared = time.monotonic()
+            self.sessions += 1
+        elif time.monotonic() - self._dns_cleared > self.dns_ttl:
+            # Look every host up again the next time it's used, in case it's moved
+            self._session.connector.clear_dns_cache()
+            self._dns_cleared = time.monotonic()
+        return self._session
+
+    def semaphores(self, host):
+        """Returns the semaphores a request to host needs to hold, in the order they're acquired
+        The one for host comes first, so that requests queued up behind a busy host don't hold onto a slot
+        Every other host could be using"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        semaphore = self._host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = self._host_semaphores[host] = asyncio.Semaphore(self.limit_per_host)
+        return semaphore, self._semaphore
+
+    def request(self, method, url, *, priority=INTERACTIVE, **kwargs):
+        """The same as session.request, used as `async with http_client.request(...) as response:`
+        This waits for the host's rate limit first, with priority being INTERACTIVE or BACKGROUND
+        A priority of None skips that, for a caller that has already waited for its turn"""
+        host = urllib.parse.urlsplit(url).hostname
+        self.requests[host] += 1
+        return _Request(self, host, priority, method, url, kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    async def close(self):
+        """Closes every connection that is open, this should be called once, when the bot is shutting down"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def stats(self):
+        """Returns a dictionary of the counters for this client"""
+        stats = {
+            'sessions': self.sessions,
+            'limit': self.limit,
+            'limit_per_host': self.limit_per_host,
+            'requests': dict(self.requests),
+            # How many requests to each host are being made right now
+            'active': {host: self.limit_per_host - semaphore._value
+                       for host, semaphore in self._host_semaphores.items() if semaphore._value < self.limit_per_host}
+        }
+        connector = self._session.connector if self._session is not None else None
+        if connector is not None:
+            # How many connections are sitting idle, ready to be reused
+            stats['idle_connections'] = sum(len(conns) for conns in getattr(connector, '_conns', {}).values())
+        return stats
+
+
+class _Request:
+    # Waits for the rate limit, and for a free connection, before making the request, since that needs to be awaited
+    def __init__(self, client, host, priority, method, url, kwargs):
+        self.client = client
+        self.host = host
+        self.priority = priority
+        self.method = method
+        self.url = url
+        self.kwargs = kwargs
+        self._context = None
+        self._held = []
+
+    async def __aenter__(self):
+        if self.priority is not None:
+            await self.client.limiter.acquire(self.host, self.priority)
+        try:
+            for semaphore in self.client.semaphores(self.host):
+                await semaphore.acquire()
+                self._held.append(semaphore)
+            self._context = self.client.session.request(self.method, self.url, **self.kwargs)
+            return await self._context.__aenter__()
+        except BaseException:
+            # __aexit__ isn't called if this fails, so let the next request go now
+            self._release()
+            raise
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            return await self._context.__aexit__(exc_type, exc, tb)
+        finally:
+            self._release()
+
+    def _release(self):
+        while self._held:
+            self._held.pop().release()
+
+
+class RetryPolicy:
+    """How requests are retried when they fail in a way that might work if tried again
+    That's only a server error (5xx) or a timeout/dropped connection, and only for methods that are safe to repeat
+    Anything else (such as a 404) is just how it is, so asking again would only add to the load on the API
+
+    Between attempts we wait an exponentially growing, random amount of time, so that everyone who failed at
+    the same time doesn't retry at the same time. If the response says how long to wait (Retry-After), we wait that
+
+    Paramaters:
+        retries -> The most times a request is retried, after the first attempt
+        backoff -> How long (in seconds) the first wait between attempts can be, this doubles each attempt
+        backoff_max -> The longest (in seconds) we'll wait between attempts
+        timeout -> How long (in seconds) each attempt can take
+        deadline -> How long (in seconds) a request can take in total, including every retry and wait"""
+
+    idempotent = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+    def __init__(self, *, retries=3, backoff=0.5, backoff_max=10, timeout=10, deadline=30):
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.deadline = deadline
+
+        # host: {'retries', 'timeouts', 'errors', 'gave_up'}
+        self.hosts = collections.defaultdict(collections.Counter)
+
+    def can_retry(self, method, attempt):
+        return method.upper() in self.idempotent and attempt < self.retries
+
+    @staticmethod
+    def retryable(status):
+        return status >= 500
+
+    def delay(self, attempt, retry_after=None):
+        """How long to wait before the next attempt, after attempt (starting from 0) failed"""
+        # We wait as long as we're asked to, if that's past the deadline the request just gives up instead
+        if retry_after is not None:
+            return retry_after
+        # "Full jitter", anywhere between nothing and the exponential backoff
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+
+    @staticmethod
+    def retry_after(response):
+        """Returns how many seconds the response asked us to wait before trying again, or None"""
+        value = response.headers.get('Retry-After')
+        if value is None:
+            return None
+        # This can either be a number of seconds, or a date to wait until
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, email.utils.mktime_tz(email.utils.parsedate_tz(value)) - time.time())
+        except TypeError:
+            # parsedate_tz returns None if this isn't a date either
+            return None
+
+    def stats(self):
+        """Returns a dictionary of the counters for each host"""
+        return {host: dict(counts) for host, counts in self.hosts.items()}
+
+
+class ResponseCache:
+    """A cache of responses, for requests that are made over and over with the same result (like searches)
+    Each response is cached for as long as the request asks for, and once there are size responses cached
+    The least recently used one is removed. If a request is already being made when the same request comes in
+    It waits for the response to that one instead of making its own, so only one request is sent for all of them
+
+    Paramaters:
+        size -> The most responses that will be cached at once"""
+
+    def __init__(self, *, size=1000):
+        self.size = size
+        # key: (expires, response)
+        self._entries = collections.OrderedDict()
+        # key: the task making that request
+        self._inflight = {}
+
+        self.evictions = 0
+        self.expirations = 0
+        # host: {'hits', 'misses', 'coalesced'}
+        self.hosts = collections.defaultdict(collections.Counter)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, key):
+        try:
+            expires, value = self._entries[key]
+        except KeyError:
+            return MISSING
+        if expires < time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            return MISSING
+        self._entries.move_to_end(key)
+        return value
+
+    def _done(self, key, ttl, task):
+        self._inflight.pop(key, None)
+        # Checking the exception here also means it isn't logged as never retrieved, if every caller was cancelled
+        if task.cancelled() or task.exception() is not None:
+            return
+        # A failed request returns None, which we want to try again next time instead of caching
+        value = task.result()
+        if value is None:
+            return
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def fetch(self, key, host, ttl, make):
+        """Returns what is cached for key, otherwise the result of the coroutine make() which is cached for ttl seconds
+        Requests for the same key made while make() is running wait for that result, instead of calling make() again"""
+        value = self._get(key)
+        if value is not MISSING:
+            self.hosts[host]['hits'] += 1
+            return copy.deepcopy(value)
+
+        task = self._inflight.get(key)
+        if task is None:
+            self.hosts[host]['misses'] += 1
+            # This runs as its own task so that if whoever started it is cancelled, everyone else waiting still gets it
+            task = asyncio.ensure_future(make())
+            self._inflight[key] = task
+            task.add_done_callback(functools.partial(self._done, key, ttl))
+        else:
+            self.hosts[host]['coalesced'] += 1
+
+        # Callers are free to change what they get back, so make sure they each get their own copy
+        return copy.deepcopy(await asyncio.shield(task))
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        """Returns a dictionary of the counters for this cache, with the hit ratio for each host"""
+        hosts = {}
+        for host, counts in self.hosts.items():
+            lookups = counts['hits'] + counts['misses'] + counts['coalesced']
+            hosts[host] = dict(counts, hit_ratio=round((counts['hits'] + counts['coalesced']) / lookups, 3)
+                               if lookups else 0.0)
+        return {
+            'entries': len(self._entries),
+            'size': self.size,
+            'inflight': len(self._inflight),
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hosts': hosts
+        }
+
+
+# The client every cog should make their requests with
+http_client = HTTPClient(limit=config.http_limit, limit_per_host=config.http_limit_per_host,
+                         dns_ttl=config.http_dns_ttl, keepalive=config.http_keepalive,
+                         limiter=RateLimiter(rate=config.http_rate, burst=config.http_burst, hosts=config.http_rate_limits))
+# The responses utilities.request was asked to cache
+response_cache = ResponseCache(size=config.http_cache_size)
+# How utilities.request retries failed requests
+retry_policy = RetryPolicy(retries=config.http_retries, backoff=config.http_backoff, backoff_max=config.http_backoff_max,
+                           timeout=config.http_timeout, deadline=config.http_deadline)
@@ -1,10 +1,10 @@
-import aiohttp
 import datetime
 import os
-from shutil import copyfile
 
 from PIL import Image, ImageDraw, ImageFont, ImageOps
 
+from .utilities import download_image
+
 base_path = "images/banner/base"
 tmp_path = "images/banner/tmp"
 whitneyMedium = "/usr/share/fonts/whitney-medium.ttf"
@@ -26,20 +26,15 @@ async def create_banner(member, image_title, data):
     os.makedirs(tmp_path, exist_ok=True)
     offset = 125
 
-    # Open up the avatar, save it as a temporary file
+    # Download the avatar, this is only written to a temporary file if it's too big to keep in memory
     avatar_url = member.avatar_url
-    avatar_path = "{}/avatar_{}_{}.jpg".format(tmp_path, member.id, int(datetime.datetime.utcnow().timestamp()))
+    avatar_file = None
     # Ensure the user has an avatar
     if avatar_url != "":
-        with aiohttp.ClientSession() as s:
-            async with s.get(avatar_url) as r:
-                val = await r.read()
-                with open(avatar_path, "wb") as f:
-                    f.write(val)
-    # Otherwise use the default avatar
-    else:
-        avatar_src_path = "{}/default_avatar.png".format(base_path)
-        copyfile(avatar_src_path, avatar_path)
+        avatar_file = await download_image(avatar_url)
+    # Otherwise (or if we couldn't download it) use the default avatar
+    if avatar_file is None:
+        avatar_file = open("{}/default_avatar.png".format(base_path), "rb")
 
     # Parse the data we need to create our image
     username = (member.display_name[:23] + '...') if len(member.display_name) > 23 else member.display_name
@@ -52,8 +47,10 @@ async def create_banner(member, image_title, data):
 
     # This is the background to the avatar
     mask = Image.open('{}/mask.png'.format(base_path)).convert('L')
-    user_avatar = Image.open(avatar_path)
-    output = ImageOps.fit(user_avatar, mask.size, centering=(0.5, 0.5))
+    # Once the avatar has been resized, we're done with the file it was downloaded into
+    with avatar_file:
+        user_avatar = Image.open(avatar_file)
+        output = ImageOps.fit(user_avatar, mask.size, centering=(0.5, 0.5))
     output.putalpha(mask)
 
     # Here's our finalized avatar image that we'll use
@@ -106,6 +103,4 @@ async def create_banner(member, image_title, data):
     base_image.paste(header, (0, 0), header)
     base_image.save(output_file)
 
-    os.remove(avatar_path)
-
     return output_file
@@ -0,0 +1,290 @@
+import asyncio
+import collections
+import copy
+import json
+import logging
+import os
+import time
+import traceback
+
+from .backends import BackendUnavailable
+
+log = logging.getLogger()
+
+
+class _Journaled:
+    # This is falsy, as we don't know yet if the write will work once it's made
+    # So a caller that adds when an update "failed" (or the other way around) journals that write as well
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return 'JOURNALED'
+
+
+# Returned by the write helpers instead of their result, when the write was saved in the journal to be made later
+JOURNALED = _Journaled()
+
+
+def _merge(patch, newer):
+    # Merges two update patches together, giving the same result as applying one after the other
+    for field, value in newer.items():
+        if isinstance(value, dict) and isinstance(patch.get(field), dict):
+            _merge(patch[field], value)
+        else:
+            patch[field] = copy.deepcopy(value)
+    return patch
+
+
+class WriteJournal:
+    """Holds onto writes that couldn't be made because the backend was unavailable, and makes them once it's back
+    Every write is saved to an append only file first, so they aren't lost if the bot is restarted in the meantime
+
+    While there are writes waiting, new writes are added to the end of the journal instead of being made right away
+    So that everything is written in the same order it was made. Writes that no longer matter are dropped:
+    A remove of a document drops anything waiting for that document before it (a replace drops the updates to it)
+    And updates to the same document one after another are merged into one
+
+    Paramaters:
+        path -> The file the journal is saved in, if None the journal is only kept in memory
+        apply -> A coroutine that makes a write, given (op, table, args), raising BackendUnavailable if it couldn't
+        max_size -> The most writes that can wait at once, after this the oldest are dropped
+        interval -> How often (in seconds) we check if the backend is back, while there are writes waiting"""
+
+    def __init__(self, path, apply, *, max_size=10000, interval=5):
+        self.path = path
+        self.apply = apply
+        self.max_size = max_size
+        self.interval = interval
+
+        # seq: {'op', 'table', 'key', 'args'}, in the order they need to be written
+        self._entries = collections.OrderedDict()
+        self._seq = 0
+        self._inflight = None
+        self._file = None
+        self._task = None
+        self._lock = asyncio.Lock()
+        # When we last failed to replay, so that catch_up doesn't keep trying while the backend is still down
+        self._failed_at = None
+
+        self.journaled = 0
+        self.replayed = 0
+        self.superseded = 0
+        self.merged = 0
+        self.dropped = 0
+        self.failures = 0
+        self.max_depth = 0
+        self.oldest = None
+
+        if path is not None:
+            self._load()
+            self._file = open(path, 'a')
+
+    @property
+    def pending(self):
+        """How many writes are waiting to be made"""
+        return len(self._entries)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line can be cut off if we were stopped mid-write, that write was never journaled
+                    break
+                if 'drop' in record:
+                    self._entries.pop(record['drop'], None)
+                else:
+                    self._entries[record['seq']] = record['entry']
+                    self._seq = max(self._seq, record['seq'])
+        if self._entries:
+            self.oldest = time.monotonic()
+            log.warning("Loaded {} writes from the journal, these will be made once the database is available".format(
+                len(self._entries)))
+
+    def _record(self, record):
+        if self._file is not None:
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+
+    def _drop(self, seq):
+        del self._entries[seq]
+        self._record({'drop': seq})
+
+    @staticmethod
+    def _describe(entry):
+        # What is logged for a write we had to give up on, so that it can be made by hand if it's needed
+        return "{} on {} ({}): {}".format(entry['op'], entry['table'], entry['key'], json.dumps(entry['args']))
+
+    def _truncate(self):
+        # Everything has been written, so there's no need to keep any of this on disk anymore
+        if self._file is not None:
+            self._file.close()
+            self._file = open(self.path, 'w')
+
+    def _same_document(self, entry):
+        # The writes waiting for the same document as entry, most recent first
+        if entry['key'] is None:
+            return []
+        return [seq for seq, e in reversed(self._entries.items())
+                if seq != self._inflight and e['table'] == entry['table'] and e['key'] == entry['key']]
+
+    @staticmethod
+    def serializable(key, *args):
+        """Returns whether a write with this key and args can be saved in the journal
+        Everything is saved as JSON, so something like a lambda filter can't be"""
+        try:
+            json.dumps([key, list(args)])
+        except (TypeError, ValueError):
+            return False
+        return True
+
+    def add(self, op, table, key, *args):
+        """Adds a write to the end of the journal, key is the primary key of the document it writes to (if known)
+        Raises ValueError if the write can't be saved in the journal (see serializable)"""
+        if not self.serializable(key, *args):
+            raise ValueError("Can't save this {} on {} in the journal, its arguments aren't JSON".format(op, table))
+        # The caller still has the args (such as an update's patch), so they can't change what's waiting in here
+        entry = {'op': op, 'table': table, 'key': key, 'args': copy.deepcopy(list(args))}
+        self.journaled += 1
+        same = self._same_document(entry)
+
+        if op in ('replace', 'delete'):
+            # Whatever was waiting to be written to this document doesn't matter anymore
+            # Except that writes that create the document need to stay for a replace, otherwise it has nothing to replace
+            for seq in same:
+                if op == 'delete' or self._entries[seq]['op'] in ('update', 'replace'):
+                    self._drop(seq)
+                    self.superseded += 1
+        elif self._mergeable(entry) and same and self._mergeable(self._entries[same[0]]) and \
+                self._entries[same[0]]['op'] == op and self._nothing_keyless_after(same[0], table):
+            # If the last write waiting for this document is the same kind of update, just add this onto it
+            last = self._entries[same[0]]
+            _merge(last['args'][1], entry['args'][1])
+            self._record({'seq': same[0], 'entry': last})
+            self.merged += 1
+            return
+
+        self._seq += 1
+        self._entries[self._seq] = entry
+        self._record({'seq': self._seq, 'entry': entry})
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+
+        while len(self._entries) > self.max_size:
+            seq = next(s for s in self._entries if s != self._inflight)
+            log.error("The write journal is full, dropped the oldest write waiting, {}".format(
+                self._describe(self._entries[seq])))
+            self._drop(seq)
+            self.dropped += 1
+        self.max_depth = max(self.max_depth, len(self._entries))
+
+    @staticmethod
+    def _mergeable(entry):
+        # Updates, and upserts that aren't incrementing, give the same result if their patches are merged first
+        return entry['op'] == 'update' or (entry['op'] == 'upsert' and not entry['args'][2])
+
+    def _nothing_keyless_after(self, seq, table):
+        # Writes without a key (like inserts and increments) could touch this document too
+        # So if any of those come after the write we would merge into, merging could change the order things happen
+        after = False
+        for s, e in self._entries.items():
+            if s == seq:
+                after = True
+            elif after and e['key'] is None and e['table'] == table:
+                return False
+        return True
+
+    async def replay(self):
+        """Makes every write that is waiting, in order, stopping if the backend is still unavailable
+        Returns True if everything was written"""
+        async with self._lock:
+            while self._entries:
+                seq, entry = next(iter(self._entries.items()))
+                self._inflight = seq
+                try:
+                    await self.apply(entry['op'], entry['table'], entry['args'])
+                except BackendUnavailable:
+                    self.failures += 1
+                    self._failed_at = time.monotonic()
+                    return False
+                finally:
+                    self._inflight = None
+                # This may have been dropped while we were writing it, if the journal filled up
+                if seq in self._entries:
+                    self._drop(seq)
+                self.replayed += 1
+
+            self.oldest = None
+            self._failed_at = None
+            self._truncate()
+            return True
+
+    async def catch_up(self):
+        """Replays the journal right away, instead of waiting for the next check, returning True if nothing is waiting
+        This isn't tried again until interval has passed since the backend was last unavailable, so that writes made
+        while it's down don't each wait on it"""
+        if not self._entries:
+            return True
+        # Nothing is replayed until we've connected (see start)
+        if self._task is None or (self._failed_at is not None and time.monotonic() - self._failed_at < self.interval):
+            return False
+        try:
+            if await self.replay():
+                log.warning("The database is available again, all the writes in the journal have been made")
+                return True
+            return False
+        except Exception:
+            # The replay loop is what gives up on a write that can't be made, so just leave it for that
+            self._failed_at = time.monotonic()
+            return False
+
+    async def _replay_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if self._entries:
+                try:
+                    if await self.replay():
+                        log.warning("The database is available again, all the writes in the journal have been made")
+                except Exception as e:
+                    # Something other than the backend being down, this write isn't going to work
+                    # Drop it so that everything after it isn't stuck waiting forever
+                    self.failures += 1
+                    if self._entries:
+                        seq = next(iter(self._entries))
+                        log.error("Failed to replay a write from the journal, dropped {}\n{}".format(
+                            self._describe(self._entries[seq]), traceback.format_exc()))
+                        self._drop(seq)
+                        self.dropped += 1
+                    else:
+                        log.error("Failed to replay a write from the journal: {0.__class__.__name__}: {0}".format(e))
+
+    def start(self, loop):
+        """Starts checking for the backend to come back, this should only be called once we've connected"""
+        if self._task is None:
+            self._task = loop.create_task(self._replay_loop())
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def stats(self):
+        """Returns a dictionary of the counters for this journal"""
+        return {
+            'pending': len(self._entries),
+            'max_pending': self.max_depth,
+            'max_size': self.max_size,
+            'oldest_s': round(time.monotonic() - self.oldest, 3) if self.oldest is not None else 0.0,
+            'journaled': self.journaled,
+            'replayed': self.replayed,
+            'superseded': self.superseded,
+            'merged': self.merged,
+            'dropped': self.dropped,
+            'failures': self.failures
+        }
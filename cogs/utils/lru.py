@@ -0,0 +1,127 @@
+import collections
+import copy
+import time
+
+# Used to tell the difference between "we have nothing cached" and "we cached that nothing was saved"
+MISSING = object()
+
+
+class LRUCache:
+    """A cache of a table's documents, based on their key
+    Entries expire after ttl seconds, and once there are size entries the least recently used one is removed
+    Keys that have nothing saved for them are cached as well (for negative_ttl seconds, or ttl if not given)
+    So that we're not asking the database over and over for something that isn't there
+
+    Each key has a version that changes whenever it's invalidated, a read gets the version before it starts
+    And gives it to set; if the key was invalidated while we were reading, what we read is out of date and isn't cached
+
+    Paramaters:
+        ttl -> How long (in seconds) a document is cached for
+        size -> The most documents that will be cached at once
+        negative_ttl -> How long (in seconds) to remember that a key has nothing saved"""
+
+    def __init__(self, *, ttl=60, size=1000, negative_ttl=None):
+        self.ttl = ttl
+        self.size = size
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self._entries = collections.OrderedDict()
+        # key: the version it was given when it was last invalidated, the oldest are forgotten after size of them
+        # Any key that isn't in here has the version _floor, which is at least the version of every key forgotten
+        self._versions = collections.OrderedDict()
+        self._version = 0
+        self._floor = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.stale = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns a copy of what is cached for key, or MISSING if it isn't cached"""
+        try:
+            expires, value = self._entries[key]
+        except (KeyError, TypeError):
+            self.misses += 1
+            return MISSING
+
+        if expires < time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return MISSING
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        # Callers are free to change what they get back, so make sure that doesn't change what we have cached
+        return copy.deepcopy(value)
+
+    def version(self, key):
+        """Returns the version of key, this should be gotten before reading what is given to set"""
+        try:
+            return self._versions.get(key, self._floor)
+        except TypeError:
+            return self._floor
+
+    def set(self, key, value, version=None):
+        """Caches the value for key, a value of None means that nothing is saved for that key
+        If version is given, the value is only cached if key hasn't been invalidated since that version"""
+        ttl = self.negative_ttl if value is None else self.ttl
+        if ttl <= 0:
+            return
+        if version is not None and version != self.version(key):
+            self.stale += 1
+            return
+        try:
+            self._entries[key] = (time.monotonic() + ttl, copy.deepcopy(value))
+        except TypeError:
+            # Keys that can't be hashed (like a filter) just aren't cached
+            return
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        """Removes key from the cache, so that the next lookup goes to the database"""
+        # If this isn't a plain key, it's a filter that could match anything we have cached
+        if not isinstance(key, (str, int)):
+            self.clear()
+            return
+        if self._entries.pop(key, None) is not None:
+            self.invalidations += 1
+
+        self._version += 1
+        self._versions[key] = self._version
+        self._versions.move_to_end(key)
+        while len(self._versions) > self.size:
+            _, self._floor = self._versions.popitem(last=False)
+
+    def clear(self):
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+        # Every key is at a new version now
+        self._version += 1
+        self._floor = self._version
+        self._versions.clear()
+
+    def stats(self):
+        """Returns a dictionary of the counters for this cache"""
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'size': self.size,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 3) if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'invalidations': self.invalidations,
+            'stale': self.stale
+        }
@@ -0,0 +1,241 @@
+import bisect
+import collections
+import functools
+import logging
+import time
+
+import pendulum
+
+from .journal import JOURNALED
+
+log = logging.getLogger()
+
+
+class Histogram:
+    """Counts how many values fall into each bucket, so we can see how values are spread out
+    Without having to keep every value we've seen
+
+    Paramaters:
+        buckets -> The upper bound of each bucket, anything over the last one goes into an overflow bucket"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        """Returns the upper bound of the bucket that the percent'th value falls in
+        This is an estimate, the real value is somewhere between this bucket's bounds"""
+        if not self.count:
+            return 0.0
+        target = self.count * percent / 100
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                # Nothing was slower than the slowest value we've seen, so don't report more than that
+                return min(bound, round(self.max, 3))
+        return self.max
+
+    @property
+    def average(self):
+        return self.total / self.count if self.count else 0.0
+
+
+# The buckets (in milliseconds) that query times are counted in
+latency_buckets = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+
+class QueryStats:
+    """Keeps track of how long each helper takes, how many rows it returns, and how often it errors
+    Based on the table and operation, so that we can find out what is hitting the database the most
+
+    Paramaters:
+        slow_threshold -> How long (in milliseconds) a query can take before it's logged as slow
+        slow_log_size -> How many of the most recent slow queries are kept"""
+
+    def __init__(self, *, slow_threshold=250, slow_log_size=50):
+        self.slow_threshold = slow_threshold
+        self.latency = collections.defaultdict(lambda: Histogram(latency_buckets))
+        self.rows = collections.Counter()
+        self.errors = collections.Counter()
+        self.slow_queries = collections.deque(maxlen=slow_log_size)
+
+    def record(self, table, operation, elapsed, rows=0, error=None):
+        """Records one call of operation on table, that took elapsed seconds"""
+        key = (table, operation)
+        elapsed *= 1000
+        self.latency[key].add(elapsed)
+        self.rows[key] += rows
+        if error is not None:
+            self.errors[key] += 1
+
+        if elapsed >= self.slow_threshold:
+            self.slow_queries.append({'time': str(pendulum.utcnow()), 'table': table, 'operation': operation,
+                                      'ms': round(elapsed, 3), 'rows': rows,
+                                      'error': error.__class__.__name__ if error is not None else None})
+            log.warning("Slow query: {} on {} took {:.1f}ms ({} rows)".format(operation, table, elapsed, rows))
+
+    def timed(self, operation):
+        """A decorator for the config helpers, that records every call made to it
+        The first argument given to the helper needs to be the table"""
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(table, *args, **kwargs):
+                start = time.monotonic()
+                try:
+                    result = await func(table, *args, **kwargs)
+                except Exception as e:
+                    self.record(table, operation, time.monotonic() - start, error=e)
+                    raise
+                self.record(table, operation, time.monotonic() - start, _rows(result))
+                return result
+
+            return wrapper
+
+        return decorator
+
+    def timed_iterator(self, operation):
+        """The same as timed, for the helpers that return an async iterator instead of being a coroutine
+        The time recorded is from the first row being asked for (which opens the cursor) until we stop reading
+        With the amount of rows that were read"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(table, *args, **kwargs):
+                return _TimedIterator(self, table, operation, func(table, *args, **kwargs))
+
+            return wrapper
+
+        return decorator
+
+    def reset(self):
+        self.latency.clear()
+        self.rows.clear()
+        self.errors.clear()
+        self.slow_queries.clear()
+
+    def stats(self):
+        """Returns a dictionary of table: {operation: stats}, for every table and operation that has been used"""
+        stats = collections.defaultdict(dict)
+        for (table, operation), histogram in self.latency.items():
+            stats[table][operation] = {
+                'calls': histogram.count,
+                'rows': self.rows[(table, operation)],
+                'errors': self.errors[(table, operation)],
+                'avg_ms': round(histogram.average, 3),
+                'p50_ms': histogram.percentile(50),
+                'p95_ms': histogram.percentile(95),
+                'p99_ms': histogram.percentile(99),
+                'max_ms': round(histogram.max, 3),
+                'total_ms': round(histogram.total, 3)
+            }
+        return dict(stats)
+
+
+class _TimedIterator:
+    # Passes everything through to the iterator, recording it once it's read through, fails, or is closed
+    def __init__(self, stats, table, operation, iterator):
+        self.stats = stats
+        self.table = table
+        self.operation = operation
+        self.iterator = iterator
+        self.rows = 0
+        self._start = None
+        self._recorded = False
+
+    def _record(self, error=None):
+        if self._recorded or self._start is None:
+            return
+        self._recorded = True
+        self.stats.record(self.table, self.operation, time.monotonic() - self._start, self.rows, error)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._start is None:
+            self._start = time.monotonic()
+        try:
+            row = await self.iterator.__anext__()
+        except StopAsyncIteration:
+            self._record()
+            raise
+        except Exception as e:
+            self._record(e)
+            raise
+        self.rows += 1
+        return row
+
+    async def __aenter__(self):
+        await self.iterator.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._record()
+        return await self.iterator.__aexit__(exc_type, exc, tb)
+
+    async def close(self):
+        self._record()
+        await self.iterator.close()
+
+
+class PollStats:
+    """Keeps track of how long each cycle of a poller takes, and how many items (such as channels) it checked
+    So that we can see how it keeps up as more is added for it to check"""
+
+    def __init__(self):
+        self.duration = Histogram([b * 1000 for b in [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]])
+        self.items = 0
+        self.requests = 0
+        self.failures = 0
+        self.last = None
+
+    def record(self, elapsed, items, requests=0, failures=0):
+        """Records one cycle, that took elapsed seconds to check items with requests (failures of which failed)"""
+        self.duration.add(elapsed * 1000)
+        self.items += items
+        self.requests += requests
+        self.failures += failures
+        self.last = {
+            'duration_ms': round(elapsed * 1000, 3),
+            'items': items,
+            'items_per_second': round(items / elapsed, 1) if elapsed else 0.0,
+            'requests': requests,
+            'failures': failures
+        }
+
+    def stats(self):
+        """Returns a dictionary of the last cycle, and totals over every cycle"""
+        total_s = self.duration.total / 1000
+        return {
+            'cycles': self.duration.count,
+            'last': self.last,
+            'avg_ms': round(self.duration.average, 3),
+            'p95_ms': self.duration.percentile(95),
+            'max_ms': round(self.duration.max, 3),
+            'items_per_second': round(self.items / total_s, 1) if total_s else 0.0,
+            'requests': self.requests,
+            'failures': self.failures
+        }
+
+
+def _rows(result):
+    # How many rows a helper gave back (or wrote), based on what it returned
+    # A journaled write hasn't written anything yet
+    if result is None or result is False or result is JOURNALED:
+        return 0
+    if isinstance(result, list):
+        # bulk_add_content returns whether each document was inserted, so don't count the ones that weren't
+        return len([r for r in result if r is not False and r is not JOURNALED])
+    if isinstance(result, dict) and result and all(isinstance(v, bool) or v is JOURNALED for v in result.values()):
+        # The bulk helpers return key: whether it was written
+        return len([v for v in result.values() if v])
+    return 1
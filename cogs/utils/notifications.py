@@ -0,0 +1,138 @@
+import asyncio
+import time
+
+import discord
+
+from . import config
+
+
+class StreamNotifier:
+    """Lets a member's servers know when they go live or offline, on any streaming site
+    The site is given as a provider, which is asked who is live each time we check
+
+    Whether each member is live is kept here, so we only need to compare against what we saw last time
+    The live flag saved with each member is only used the first time we see them (such as after a restart)
+    Any flags that changed are saved in one write, and the messages are sent a few at a time
+
+    Paramaters:
+        bot -> The bot, used to find the servers and channels to send to
+        provider -> The streaming site, which needs to have:
+            table -> The table members are saved in, with their url saved as {table}_url
+            channel_name(url) -> Returns the (lower-cased) channel in a url
+            live_channels(channels) -> A coroutine returning (the channels that are live, the channels it couldn't check)
+            changed_channels() -> Optional, returns the channels that went live or offline during the last live_channels
+                                  So that anyone else we've already seen can be skipped, or None to check everyone
+        concurrency -> The most messages that are sent at once"""
+
+    def __init__(self, bot, provider, *, concurrency=5):
+        self.bot = bot
+        self.provider = provider
+        self.table = provider.table
+        self.url_field = '{}_url'.format(provider.table)
+        self.concurrency = concurrency
+        # member_id: whether they were live the last time we checked, and the channel we checked
+        self.live = {}
+        self.channels = {}
+
+        self.checks = 0
+        self.went_live = 0
+        self.went_offline = 0
+        self.sent = 0
+        self.send_failures = 0
+        self.last_check_ms = 0.0
+
+    async def check(self):
+        """Checks everyone with notifications on once, saving and announcing anyone who went live or offline
+        Returns how many members went live or offline, so the scheduler can check more often while that's happening"""
+        start = time.monotonic()
+        members = await config.get_all_content(self.table, 'notifications_on', 1) or []
+        channels = {}
+        for data in members:
+            try:
+                channels[data['member_id']] = self.provider.channel_name(data[self.url_field])
+            except (AttributeError, KeyError):
+                # A url that was saved before we checked them properly, there's no channel to look up
+                continue
+
+        live, unknown = await self.provider.live_channels(set(channels.values()))
+        changed = self.provider.changed_channels() if hasattr(self.provider, 'changed_channels') else None
+
+        # The members whose live status changed, these are all saved at once after we've checked everyone
+        flips = {}
+        announcements = []
+        for data in members:
+            m_id = data['member_id']
+            # If we couldn't check them this time, leave them as they are until the next check
+            if m_id not in channels or channels[m_id] in unknown:
+                continue
+            # Their channel didn't change since last time, so they're still whatever we saw then
+            if changed is not None and self.channels.get(m_id) == channels[m_id] and channels[m_id] not in changed:
+                continue
+            online = channels[m_id] in live
+            was_live = self.live.get(m_id, bool(data.get('live')))
+            self.live[m_id] = online
+            self.channels[m_id] = channels[m_id]
+            if online == was_live:
+                continue
+
+            flips[m_id] = {'live': int(online)}
+            if online:
+                self.went_live += 1
+                fmt = "{} has just gone live! View their stream at <{}>"
+            else:
+                self.went_offline += 1
+                fmt = "{} has just gone offline! View their stream next time at <{}>"
+            announcements.extend((s_id, m_id, fmt, data[self.url_field]) for s_id in data.get('servers', []))
+
+        # Forget about anyone who isn't being checked anymore
+        for m_id in set(self.live) - set(channels):
+            del self.live[m_id]
+            self.channels.pop(m_id, None)
+
+        # Save these first, so that if sending fails partway through we don't announce them again next time
+        if flips:
+            await config.bulk_update_content(self.table, flips)
+        await self.announce(announcements)
+
+        self.checks += 1
+        self.last_check_ms = round((time.monotonic() - start) * 1000, 3)
+        return len(flips)
+
+    async def announce(self, announcements):
+        """Sends each (server_id, member_id, format, url), a few at a time"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def send(s_id, m_id, fmt, url):
+            server = self.bot.get_server(s_id)
+            if server is None:
+                return
+            member = server.get_member(m_id)
+            if member is None:
+                return
+            # The server's settings are kept up to date in the cache, so there's no need to look them up
+            server_settings = config.cache['server_settings'].get(s_id) or {}
+            channel = server.get_channel(server_settings.get('notification_channel', s_id))
+            if channel is None:
+                return
+            async with semaphore:
+                try:
+                    await self.bot.send_message(channel, fmt.format(member.display_name, url))
+                    self.sent += 1
+                except discord.HTTPException:
+                    # Most likely we can't talk in that channel, that shouldn't stop everyone else's messages
+                    self.send_failures += 1
+
+        await asyncio.gather(*[send(*announcement) for announcement in announcements])
+
+    def stats(self):
+        """Returns a dictionary of the counters for this notifier"""
+        return {
+            'tracked': len(self.live),
+            'live': len([live for live in self.live.values() if live]),
+            'checks': self.checks,
+            'last_check_ms': self.last_check_ms,
+            'went_live': self.went_live,
+            'went_offline': self.went_offline,
+            'sent': self.sent,
+            'send_failures': self.send_failures
+        }
@@ -0,0 +1,180 @@
+import asyncio
+import collections
+import time
+
+import rethinkdb as r
+
+r.set_loop_type("asyncio")
+
+
+class PoolTimeout(Exception):
+    """Raised when a connection could not be acquired from the pool in time"""
+    pass
+
+
+class ConnectionPool:
+    """A pool of long lived rethinkdb connections
+    Opening a connection means a TCP connection, a handshake and authentication, so instead of doing that
+    for every query, we keep a few connections open and hand them out as they are needed
+
+    Paramaters:
+        opts -> The options passed to r.connect
+        min_size -> The amount of connections to keep open, even when idle
+        max_size -> The most connections that can be open at once, any more acquires will wait
+        timeout -> How long (in seconds) to wait for a connection before raising PoolTimeout
+        health_check -> How long (in seconds) a connection can sit idle before it is checked before use"""
+
+    def __init__(self, opts, *, min_size=1, max_size=10, timeout=10, health_check=30):
+        self.opts = opts
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check = health_check
+
+        # This holds (connection, time it was released) for all the idle connections we have
+        self._idle = collections.deque()
+        self._semaphore = asyncio.Semaphore(max_size)
+        self._size = 0
+        self._closed = False
+
+        # The counters we'll use to figure out how to size the pool
+        self.acquired = 0
+        self.waited = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.saturated = 0
+        self.timeouts = 0
+        self.reconnects = 0
+        self.discarded = 0
+
+    @property
+    def size(self):
+        """The amount of connections currently open, idle or in use"""
+        return self._size
+
+    @property
+    def in_use(self):
+        return self._size - len(self._idle)
+
+    async def _connect(self):
+        conn = await r.connect(**self.opts)
+        self._size += 1
+        return conn
+
+    async def _close(self, conn):
+        self._size -= 1
+        try:
+            await conn.close(noreply_wait=False)
+        except r.ReqlDriverError:
+            pass
+
+    async def _healthy(self, conn, released):
+        # A connection that was just used is almost certainly fine, so only check the ones that sat for a while
+        if not conn.is_open():
+            return False
+        if time.monotonic() - released < self.health_check:
+            return True
+        try:
+            await r.expr(1).run(conn)
+            return True
+        except r.ReqlDriverError:
+            return False
+
+    async def fill(self):
+        """Opens connections until we have at least min_size of them"""
+        while self._size < self.min_size:
+            self._idle.append((await self._connect(), time.monotonic()))
+
+    async def acquire(self):
+        """Returns a connection, waiting up to timeout seconds for one to free up if the pool is saturated"""
+        if self._closed:
+            raise r.ReqlDriverError("The connection pool has been closed")
+
+        start = time.monotonic()
+        if self._semaphore.locked():
+            self.saturated += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise PoolTimeout("Could not get a database connection within {} seconds".format(self.timeout))
+
+        waited = time.monotonic() - start
+        if waited > 0.001:
+            self.waited += 1
+        self.wait_time += waited
+        self.max_wait_time = max(self.max_wait_time, waited)
+
+        try:
+            # Reuse the most recently released connection first, so that extra connections go idle and get checked
+            while self._idle:
+                conn, released = self._idle.pop()
+                if await self._healthy(conn, released):
+                    break
+                # This one has been dropped by the server, so throw it away and open a new one in its place
+                self.reconnects += 1
+                await self._close(conn)
+            else:
+                conn = await self._connect()
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+        self.acquired += 1
+        return conn
+
+    async def release(self, conn, *, discard=False):
+        """Gives a connection back to the pool
+        If discard is True, or the connection was closed, the connection will be closed instead of reused"""
+        try:
+            if discard or self._closed or not conn.is_open():
+                self.discarded += 1
+                await self._close(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+        finally:
+            self._semaphore.release()
+
+    def connection(self):
+        """Used as `async with pool.connection() as conn:`, releasing the connection when done
+        If the driver errors while the connection is in use, the connection is discarded instead of reused"""
+        return _PoolContext(self)
+
+    async def close(self):
+        """Closes every idle connection, connections in use will be closed when they are released"""
+        self._closed = True
+        while self._idle:
+            conn, _ = self._idle.pop()
+            await self._close(conn)
+
+    def stats(self):
+        """Returns a dictionary of the counters for this pool"""
+        return {
+            'size': self._size,
+            'idle': len(self._idle),
+            'in_use': self.in_use,
+            'min_size': self.min_size,
+            'max_size': self.max_size,
+            'acquired': self.acquired,
+            'waited': self.waited,
+            'saturated': self.saturated,
+            'timeouts': self.timeouts,
+            'reconnects': self.reconnects,
+            'discarded': self.discarded,
+            'avg_wait_ms': round(self.wait_time / self.acquired * 1000, 3) if self.acquired else 0.0,
+            'max_wait_ms': round(self.max_wait_time * 1000, 3)
+        }
+
+
+class _PoolContext:
+    def __init__(self, pool):
+        self.pool = pool
+        self.conn = None
+
+    async def __aenter__(self):
+        self.conn = await self.pool.acquire()
+        return self.conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        discard = exc_type is not None and issubclass(exc_type, r.ReqlDriverError)
+        await self.pool.release(self.conn, discard=discard)
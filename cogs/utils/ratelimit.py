@@ -0,0 +1,141 @@
+import asyncio
+import collections
+import heapq
+import itertools
+import time
+
+from .metrics import Histogram, latency_buckets
+
+# Requests made for a command someone is waiting on go ahead of anything we're doing in the background
+INTERACTIVE = 0
+BACKGROUND = 1
+
+
+class TokenBucket:
+    """Allows rate requests a second on average, with up to burst at once
+    Requests that have to wait are let through in order of priority, then in the order they asked
+
+    Paramaters:
+        rate -> How many requests a second are allowed
+        burst -> The most requests that can be made at once, after not making any for a while"""
+
+    def __init__(self, rate, burst):
+        # Either of these being 0 would mean nobody is ever let through
+        if not rate or rate <= 0:
+            raise ValueError("The rate of a token bucket needs to be more than 0, not {}".format(rate))
+        if not burst or burst < 1:
+            raise ValueError("The burst of a token bucket needs to be at least 1, not {}".format(burst))
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self._updated = time.monotonic()
+        # (priority, order asked, future)
+        self._waiters = []
+        self._order = itertools.count()
+        self._task = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    @property
+    def waiting(self):
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    async def acquire(self, priority=INTERACTIVE):
+        """Waits until a request can be made"""
+        self._refill()
+        # Nobody is waiting ahead of us, so if there's a token we can go right away
+        if not self._waiters and self.tokens >= 1:
+            self.tokens -= 1
+            return
+
+        future = asyncio.Future()
+        heapq.heappush(self._waiters, (priority, next(self._order), future))
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._release())
+        await future
+
+    async def _release(self):
+        # Hands out tokens to whoever is first in line, as they come back
+        while self._waiters:
+            self._refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            # If they stopped waiting (their command was cancelled) they don't need the token
+            if not future.done():
+                self.tokens -= 1
+                future.set_result(None)
+
+
+class RateLimiter:
+    """Limits how fast requests are made to each host, with a token bucket for each one
+    So that we stay under an API's limits instead of getting ourselves temporarily banned
+
+    Paramaters:
+        rate -> How many requests a second can be made to a host that doesn't have its own limit
+        burst -> The most requests that can be made at once to a host that doesn't have its own limit
+        hosts -> {host: {'rate': ..., 'burst': ...}} for hosts with their own limits
+    A rate of 0 (or None) means there's no limit, a host given without a rate uses the rate every host does"""
+
+    def __init__(self, *, rate=10, burst=20, hosts=None):
+        self.rate = rate
+        self.burst = burst
+        self.hosts = hosts or {}
+        self._buckets = {}
+        # Make sure every limit we've been given works now, instead of the first time a request is made to that host
+        if rate and (not burst or burst < 1):
+            raise ValueError("The burst for rate limits needs to be at least 1, not {}".format(burst))
+        for host in self.hosts:
+            self.limits(host)
+
+        # host: how long (in milliseconds) requests waited for their turn
+        self.wait = collections.defaultdict(lambda: Histogram(latency_buckets))
+        self.delayed = collections.Counter()
+
+    def limits(self, host):
+        """Returns the (rate, burst) for host, or None if it isn't limited"""
+        limits = self.hosts.get(host) or {}
+        rate = limits.get('rate', self.rate)
+        if not rate:
+            return None
+        burst = limits.get('burst', self.burst)
+        if rate < 0 or not burst or burst < 1:
+            raise ValueError("The rate limit for {} needs a rate more than 0 and a burst of at least 1, not a rate of {} "
+                             "and a burst of {}".format(host, rate, burst))
+        return rate, burst
+
+    def bucket(self, host):
+        """Returns the token bucket for host, or None if it isn't limited"""
+        try:
+            return self._buckets[host]
+        except KeyError:
+            limits = self.limits(host)
+            bucket = self._buckets[host] = TokenBucket(*limits) if limits is not None else None
+            return bucket
+
+    async def acquire(self, host, priority=INTERACTIVE):
+        """Waits until a request can be made to host"""
+        bucket = self.bucket(host)
+        if bucket is None:
+            return
+        start = time.monotonic()
+        await bucket.acquire(priority)
+        waited = (time.monotonic() - start) * 1000
+        self.wait[host].add(waited)
+        if waited >= 1:
+            self.delayed[host] += 1
+
+    def stats(self):
+        """Returns a dictionary of how long requests to each host waited, and how many are waiting now"""
+        return {host: {
+            'requests': histogram.count,
+            'delayed': self.delayed[host],
+            'waiting': self._buckets[host].waiting if self._buckets.get(host) is not None else 0,
+            'avg_wait_ms': round(histogram.average, 3),
+            'p95_wait_ms': histogram.percentile(95),
+            'max_wait_ms': round(histogram.max, 3)
+        } for host, histogram in self.wait.items()}
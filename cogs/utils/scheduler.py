@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import random
+import time
+import traceback
+
+from . import config
+from .metrics import Histogram, latency_buckets
+
+log = logging.getLogger()
+
+
+class Job:
+    """A coroutine that is run over and over, every interval seconds
+
+    Each wait is randomly made up to jitter (a fraction of the interval) longer or shorter
+    So that jobs on every shard, started at the same time, don't keep hitting an API at the same time
+    If the job fails, the wait doubles each time it fails in a row (up to max_backoff) before it's tried again
+
+    If the job is adaptive, it returns how much changed when it ran (such as how many streams went live/offline)
+    Whenever something changed the interval is halved, down to min_interval, so we catch the next change sooner
+    And whenever nothing did it's slowly raised again, up to max_interval
+
+    Paramaters:
+        name -> What the job is called, in the stats
+        func -> The coroutine function that is run
+        interval -> How long (in seconds) to wait between runs
+        min_interval/max_interval -> How short and long the interval can be, if the job is adaptive
+        jitter -> How much of the interval the wait can be randomly changed by, 0.1 is up to 10%
+        max_backoff -> The longest (in seconds) we'll wait after the job fails
+        wait_for -> A coroutine function that is awaited before the job is first run (such as bot.wait_until_ready)"""
+
+    def __init__(self, name, func, *, interval, min_interval=None, max_interval=None, jitter=0.1, max_backoff=None,
+                 wait_for=None):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.min_interval = min_interval or interval
+        self.max_interval = max_interval or interval
+        self.jitter = jitter
+        self.max_backoff = max_backoff or max(self.max_interval, interval) * 10
+        self.wait_for = wait_for
+        self.task = None
+
+        self.runs = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.run_time = Histogram(latency_buckets)
+        self.lag = Histogram(latency_buckets)
+        self.last_run = None
+        self.last_error = None
+        self.next_run = None
+
+    @property
+    def adaptive(self):
+        return self.min_interval != self.max_interval
+
+    def delay(self):
+        """How long to wait until the next run, based on how the last one went"""
+        if self.consecutive_failures:
+            delay = min(self.max_backoff, self.interval * 2 ** self.consecutive_failures)
+        else:
+            delay = self.interval
+        return max(0.0, delay * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def adapt(self, changed):
+        if not self.adaptive or not isinstance(changed, (int, float)):
+            return
+        if changed:
+            self.interval = max(self.min_interval, self.interval / 2)
+        else:
+            self.interval = min(self.max_interval, self.interval * 1.25)
+
+    async def run_once(self):
+        start = time.monotonic()
+        try:
+            changed = await self.func()
+        except Exception as e:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_error = '{0.__class__.__name__}: {0}'.format(e)
+            tb = traceback.format_exc()
+            log.error("The {} job failed ({} in a row)\n{}".format(self.name, self.consecutive_failures, tb))
+        else:
+            self.consecutive_failures = 0
+            self.adapt(changed)
+        finally:
+            self.runs += 1
+            self.last_run = time.time()
+            self.run_time.add((time.monotonic() - start) * 1000)
+
+    async def loop(self):
+        if self.wait_for is not None:
+            await self.wait_for()
+        # Wait a random part of the jitter before the first run too, so shards that started together aren't in step
+        event_loop = asyncio.get_event_loop()
+        self.next_run = event_loop.time() + random.uniform(0, self.interval * self.jitter)
+        while True:
+            await asyncio.sleep(max(0.0, self.next_run - event_loop.time()))
+            # How late we are, which is how busy the event loop is
+            self.lag.add(max(0.0, event_loop.time() - self.next_run) * 1000)
+            await self.run_once()
+            self.next_run = event_loop.time() + self.delay()
+
+    def stats(self):
+        """Returns a dictionary of how this job has been running"""
+        return {
+            'interval': round(self.interval, 3),
+            'runs': self.runs,
+            'failures': self.failures,
+            'consecutive_failures': self.consecutive_failures,
+            'last_error': self.last_error,
+            'avg_run_ms': round(self.run_time.average, 3),
+            'max_run_ms': round(self.run_time.max, 3),
+            'avg_lag_ms': round(self.lag.average, 3),
+            'max_lag_ms': round(self.lag.max, 3),
+            'next_run_in': round(self.next_run - asyncio.get_event_loop().time(), 3) if self.next_run else None
+        }
+
+
+class Scheduler:
+    """Runs the background jobs (such as the stream pollers), each on their own interval
+    Jobs are added with add, which takes the same arguments as Job, and are cancelled with remove
+
+    Paramaters:
+        loop -> The event loop the jobs are run on
+        jitter -> The jitter used for jobs that don't give their own"""
+
+    def __init__(self, loop=None, *, jitter=0.1):
+        self.loop = loop or asyncio.get_event_loop()
+        self.jitter = jitter
+        self.jobs = {}
+
+    def add(self, name, func, **kwargs):
+        """Starts running func as a job, replacing any job already running with the same name"""
+        self.remove(name)
+        kwargs.setdefault('jitter', self.jitter)
+        job = self.jobs[name] = Job(name, func, **kwargs)
+        job.task = self.loop.create_task(job.loop())
+        return job
+
+    def remove(self, name):
+        job = self.jobs.pop(name, None)
+        if job is not None and job.task is not None:
+            job.task.cancel()
+
+    def close(self):
+        for name in list(self.jobs):
+            self.remove(name)
+
+    def stats(self):
+        """Returns a dictionary of name: stats, for every job"""
+        return {name: job.stats() for name, job in self.jobs.items()}
+
+
+# Every background job is run by this
+scheduler = Scheduler(config.loop, jitter=config.poll_jitter)
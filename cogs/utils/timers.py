@@ -0,0 +1,115 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+import traceback
+
+from .metrics import Histogram, latency_buckets
+
+log = logging.getLogger()
+
+
+class Timers:
+    """Waits for deadlines, and calls back with the keys whose deadlines have passed
+    The deadlines are kept in a heap, so we only ever have to look at the next one, and sleep until exactly then
+    Instead of waking up every so often to check everything
+
+    Paramaters:
+        callback -> A coroutine that is given a list of the keys whose deadline passed
+        retry -> How long (in seconds) to wait before trying those keys again, if the callback fails"""
+
+    def __init__(self, callback, *, retry=60):
+        self.callback = callback
+        self.retry = retry
+        # (deadline, order added, key), a key's entry is out of date if its deadline isn't the one in _deadlines
+        self._heap = []
+        self._deadlines = {}
+        self._order = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+        self.fired = 0
+        self.failures = 0
+        # How late (in milliseconds) the callback was for each deadline
+        self.late = Histogram(latency_buckets)
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def schedule(self, key, deadline):
+        """Calls back with key once deadline (a unix timestamp) has passed, replacing its deadline if it had one"""
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, next(self._order), key))
+        # This may be sooner than what we're currently waiting for
+        self._wakeup.set()
+
+    def cancel(self, key):
+        """Stops waiting for key's deadline, it's left in the heap and skipped once it gets to the top"""
+        self._deadlines.pop(key, None)
+
+    def _next(self):
+        # Drop anything from the top of the heap that was cancelled or rescheduled, returning the next real deadline
+        while self._heap:
+            deadline, _, key = self._heap[0]
+            if self._deadlines.get(key) == deadline:
+                return deadline
+            heapq.heappop(self._heap)
+        return None
+
+    def _pop_due(self, now):
+        due = []
+        while self._next() is not None and self._heap[0][0] <= now:
+            deadline, _, key = heapq.heappop(self._heap)
+            del self._deadlines[key]
+            self.late.add((now - deadline) * 1000)
+            due.append(key)
+        return due
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            deadline = self._next()
+            wait = None if deadline is None else deadline - time.time()
+            if wait is None or wait > 0:
+                # Wake up at the deadline, or as soon as something is scheduled
+                # This is capped at an hour so that a change to the system clock can't leave us asleep for too long
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), None if wait is None else min(wait, 3600))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            due = self._pop_due(time.time())
+            try:
+                await self.callback(due)
+                self.fired += len(due)
+            except Exception:
+                self.failures += 1
+                log.error("Failed to handle the timers that were due, trying again in {} seconds\n{}".format(
+                    self.retry, traceback.format_exc()))
+                retry_at = time.time() + self.retry
+                for key in due:
+                    # Unless it was given a new deadline while we were calling back
+                    if key not in self._deadlines:
+                        self.schedule(key, retry_at)
+
+    def start(self, loop):
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def stats(self):
+        """Returns a dictionary of the counters for these timers"""
+        deadline = self._next()
+        return {
+            'pending': len(self._deadlines),
+            'next_in': round(deadline - time.time(), 3) if deadline is not None else None,
+            'fired': self.fired,
+            'failures': self.failures,
+            'avg_late_ms': round(self.late.average, 3),
+            'max_late_ms': round(self.late.max, 3)
+        }
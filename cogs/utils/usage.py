@@ -0,0 +1,258 @@
+import asyncio
+import collections
+import logging
+import time
+
+from . import config
+
+log = logging.getLogger()
+
+
+# The table usage is saved in, there is one row per command for each of it's total, member, and server usage
+# Keeping these as separate rows (instead of a member/server map in one document per command) keeps each row small
+# And lets the database order the counts for a member or server with the scope_count index
+usage_table = 'command_counts'
+
+
+def _row(command, scope, scope_id, count):
+    return {'id': '{}:{}:{}'.format(scope, scope_id, command),
+            'command': command,
+            'scope': scope,
+            'scope_id': scope_id,
+            'count': count}
+
+
+def _rows(command, total, members, servers):
+    rows = [_row(command, 'total', 'all', total)]
+    rows.extend(_row(command, 'member', m_id, count) for m_id, count in members.items())
+    rows.extend(_row(command, 'server', s_id, count) for s_id, count in servers.items())
+    return rows
+
+
+async def command_usage(command, member_id, server_id=None):
+    """Returns a dictionary of how many times the command has been used in total, by the member, and on the server
+    Returns None if the command has never been used"""
+    keys = ['total:all:{}'.format(command), 'member:{}:{}'.format(member_id, command)]
+    if server_id is not None:
+        keys.append('server:{}:{}'.format(server_id, command))
+
+    rows = await config.get_all_content(usage_table, 'id', *keys)
+    if rows is None:
+        return None
+
+    usage = {'total': 0, 'member': 0, 'server': 0}
+    for row in rows:
+        usage[row['scope']] = row['count']
+    return usage
+
+
+async def top_commands(scope, scope_id, limit=5):
+    """Returns a list of (command, count) for the most used commands by a member or on a server
+    scope should be 'member' or 'server', and scope_id the ID of that member or server"""
+    rows = await config.get_range_content(usage_table, 'scope_count', [scope, scope_id, config.minval],
+                                          [scope, scope_id, config.maxval], limit=limit, descending=True)
+    return [(row['command'], row['count']) for row in rows]
+
+
+# The row in the usage table that records whether the migration from command_usage has finished
+migration_marker = _row('command_usage', 'migration', 'command_usage', 0)
+
+
+async def _save_counts(rows):
+    # The counts are saved as they are, instead of added on, so copying a row a second time doesn't change anything
+    await config.bulk_update_content(usage_table, {row['id']: row for row in rows}, upsert=True)
+
+
+async def migrate_command_usage(tables):
+    """Copies the usage saved in the old command_usage table (one document per command) into the new table
+    tables is the list of tables there were before the new table was created
+    This is ran when the new table is created, and again on startup if the bot was stopped before it finished
+
+    The counts are copied as they are, so the usage buffer isn't saved until this is done
+    Otherwise anything it saved first would be overwritten, and copying again after a restart is only safe
+    Because nothing else has been added to the new table in the meantime"""
+    if 'command_usage' not in tables:
+        return
+    if usage_table in tables:
+        marker = await config.get_content(usage_table, migration_marker['id'], primary=True)
+        # A table without a marker was migrated before we started saving one
+        if marker is None or marker.get('done'):
+            return
+
+    async with usage_buffer.hold():
+        print("Migrating command usage to {}...".format(usage_table))
+        await config.upsert_content(usage_table, migration_marker['id'], dict(migration_marker, done=False))
+        rows = []
+        async with config.iter_content('command_usage') as documents:
+            async for doc in documents:
+                rows.extend(_rows(doc['command'], doc.get('total_usage', 0), doc.get('member_usage') or {},
+                                  doc.get('server_usage') or {}))
+                if len(rows) >= 1000:
+                    await _save_counts(rows)
+                    rows = []
+        if rows:
+            await _save_counts(rows)
+        await config.upsert_content(usage_table, migration_marker['id'], {'done': True})
+        print("Done migrating command usage!")
+
+
+class UsageBuffer:
+    """Counts command usage in memory, and saves it to the usage table in batches
+    Instead of a read and write of the whole document for every command that is ran, counts for the same
+    command/member/server are added together and written in one query every interval seconds
+
+    Paramaters:
+        interval -> How often (in seconds) the buffered counts are saved
+        max_size -> The most counters that will be held before new ones are dropped
+                    Once half of this is reached, the counts are saved without waiting for the interval"""
+
+    def __init__(self, *, interval=10, max_size=10000):
+        self.interval = interval
+        self.max_size = max_size
+        self._pending = {}
+        self._size = 0
+        self._lock = asyncio.Lock()
+        self._flushing = False
+
+        # The counters we'll use to see how the buffer is doing
+        self.flushes = 0
+        self.failures = 0
+        self.dropped = 0
+        self.last_batch = 0
+        self.max_batch = 0
+        self.last_flush_time = 0.0
+        self.max_flush_time = 0.0
+        self.total_flush_time = 0.0
+
+        self._task = None
+
+    @property
+    def size(self):
+        """The amount of counters currently waiting to be saved"""
+        return self._size
+
+    def _add(self, command, total, members, servers):
+        # Adds the counts given into the buffer, returning False if there was no room for them
+        # Only new counters take up room, adding to a counter that is already here is always fine
+        counters = self._pending.get(command)
+        if counters is None:
+            new = 1 + len(members) + len(servers)
+        else:
+            new = len([m for m in members if m not in counters['member_usage']]) + \
+                  len([s for s in servers if s not in counters['server_usage']])
+        if new and self._size + new > self.max_size:
+            return False
+
+        if counters is None:
+            counters = {'total_usage': 0,
+                        'member_usage': collections.Counter(),
+                        'server_usage': collections.Counter()}
+            self._pending[command] = counters
+        counters['total_usage'] += total
+        counters['member_usage'].update(members)
+        counters['server_usage'].update(servers)
+        self._size += new
+        return True
+
+    def record(self, command, member_id, server_id=None):
+        """Adds one to the usage of the command, for the member and server given"""
+        members = {member_id: 1}
+        servers = {server_id: 1} if server_id is not None else {}
+        if not self._add(command, 1, members, servers):
+            self.dropped += 1
+
+        # If the buffer is getting full, don't wait for the interval to save it (once we've connected)
+        if self._size >= self.max_size // 2 and not self._flushing and self._task is not None:
+            self._flushing = True
+            config.loop.create_task(self._try_flush())
+
+    def hold(self):
+        """Used as `async with usage_buffer.hold():`, nothing is saved until the block is done
+        Commands ran in the meantime are still counted, and are saved by the first flush after it"""
+        return self._lock
+
+    async def _try_flush(self):
+        try:
+            await self.flush()
+        except Exception:
+            # flush already logged this, and kept the counts to try again next time
+            pass
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self._try_flush()
+
+    def start(self, loop):
+        """Starts saving the counts every interval, this should only be called once we've connected"""
+        if self._task is None:
+            self._task = loop.create_task(self._flush_loop())
+
+    async def flush(self):
+        """Saves everything that has been buffered, in one query"""
+        async with self._lock:
+            self._flushing = True
+            try:
+                if not self._pending:
+                    return
+
+                # Swap out the buffer first, so that commands ran while we're saving go to the new one
+                pending = self._pending
+                self._pending = {}
+                self._size = 0
+
+                batch = []
+                for command, counters in pending.items():
+                    batch.extend(_rows(command, counters['total_usage'], counters['member_usage'],
+                                       counters['server_usage']))
+
+                start = time.monotonic()
+                try:
+                    # A journaled batch will be saved once the database is back, so it mustn't be saved again
+                    result = await config.increment_content(usage_table, batch)
+                    if not result and result is not config.JOURNALED:
+                        raise RuntimeError("Nothing was saved to {}".format(usage_table))
+                except Exception as e:
+                    # Put everything back that we can, so that the next flush tries again
+                    self.failures += 1
+                    for command, counters in pending.items():
+                        if not self._add(command, counters['total_usage'], counters['member_usage'],
+                                         counters['server_usage']):
+                            self.dropped += 1
+                    log.error("Failed to save command usage: {0.__class__.__name__}: {0}".format(e))
+                    raise
+
+                elapsed = time.monotonic() - start
+                self.flushes += 1
+                self.last_batch = len(batch)
+                self.max_batch = max(self.max_batch, len(batch))
+                self.last_flush_time = elapsed
+                self.max_flush_time = max(self.max_flush_time, elapsed)
+                self.total_flush_time += elapsed
+            finally:
+                self._flushing = False
+
+    async def close(self):
+        """Stops the periodic saving, and saves whatever is left"""
+        if self._task is not None:
+            self._task.cancel()
+        await self.flush()
+
+    def stats(self):
+        """Returns a dictionary of the counters for this buffer"""
+        return {
+            'pending': self._size,
+            'max_size': self.max_size,
+            'flushes': self.flushes,
+            'failures': self.failures,
+            'dropped': self.dropped,
+            'last_batch': self.last_batch,
+            'max_batch': self.max_batch,
+            'last_flush_ms': round(self.last_flush_time * 1000, 3),
+            'max_flush_ms': round(self.max_flush_time * 1000, 3),
+            'avg_flush_ms': round(self.total_flush_time / self.flushes * 1000, 3) if self.flushes else 0.0
+        }
+
+
+# The buffer that every command's usage is recorded in
+usage_buffer = UsageBuffer(interval=config.usage_flush_interval, max_size=config.usage_buffer_size)
@@ -1,10 +1,19 @@
-import aiohttp
 from io import BytesIO
+import aiohttp
+import asyncio
+import functools
 import inspect
+import tempfile
+import urllib.parse
 
 from . import config
+from .http_client import http_client, response_cache, retry_policy
+from .ratelimit import INTERACTIVE
 from PIL import Image
 
+# How many bytes are read at a time when downloading
+download_chunk_size = 64 * 1024
+
 
 def convert_to_jpeg(pfile):
     # Open the file given
@@ -82,60 +91,161 @@ def find_command(bot, command):
 
 
 async def download_image(url):
-    """Returns a file-like object based on the URL provided"""
-    headers = {'User-Agent': config.user_agent}
-    # Simply read the image, to get the bytes
-    bts = await request(url, attr='read')
-    if bts is None:
-        return None
-
-    # Then wrap it in a BytesIO object, to be used like an actual file
-    image = BytesIO(bts)
-    return image
-
+    """Returns a file-like object based on the URL provided, or None if it isn't an image we can download
+    This is a SpooledTemporaryFile (see download), which PIL can open as it is
+    But it isn't a real file object before python 3.11, so read it into a BytesIO before uploading it to discord"""
+    return await download(url, content_types=('image/',))
+
+
+async def download(url, *, content_types=None, max_size=None, spool_size=None):
+    """Downloads url a chunk at a time, returning it as a file-like object (or None if the download failed)
+    The download stops as soon as it goes over max_size bytes, so a huge file is never held in memory
+    It's held in memory up to spool_size bytes, anything bigger than that is written to a temporary file instead
+
+    Paramaters:
+        content_types -> The content types that can be downloaded (such as ('image/',)), None allows anything
+        max_size -> The most bytes that can be downloaded, download_max_size if not given
+        spool_size -> How many bytes can be held in memory before they're written to disk, download_spool_size if not
+        given"""
+    max_size = max_size or config.download_max_size
+    spool_size = spool_size or config.download_spool_size
+
+    async def reader(response):
+        content_type = response.headers.get('Content-Type', '').lower()
+        if content_types and not content_type.startswith(tuple(content_types)):
+            return None
+        # If we're told how big it is, there's no need to start downloading something that's too big
+        length = response.headers.get('Content-Length', '')
+        if length.isdigit() and int(length) > max_size:
+            return None
+
+        file = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        size = 0
+        try:
+            while True:
+                chunk = await response.content.read(download_chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_size:
+                    file.close()
+                    return None
+                file.write(chunk)
+        except BaseException:
+            # This attempt failed (or was cancelled), don't leave the file sitting around
+            file.close()
+            raise
+
+        file.seek(0)
+        return file
+
+    return await _request(url, reader=reader)
+
+
+async def request(url, *, headers=None, payload=None, method='GET', attr='json', cache_ttl=None, timeout=None,
+                  deadline=None, priority=INTERACTIVE):
+    """Makes a request, returning the attribute of the response requested (or None if the request failed)
+    If cache_ttl is given, the result is cached for that many seconds, based on the method, url, and paramaters
+    So this should only be used for lookups that give back the same thing each time
+    timeout and deadline override how long each attempt, and the whole request, can take (see RetryPolicy)
+    priority is INTERACTIVE for a command someone is waiting on, or BACKGROUND for anything else (such as pollers)
+    Which decides who goes first when we have to wait for a host's rate limit"""
+    make = functools.partial(_request, url, headers=headers, payload=payload, method=method, attr=attr,
+                             timeout=timeout, deadline=deadline, priority=priority)
+    if not cache_ttl:
+        return await make()
 
-async def request(url, *, headers=None, payload=None, method='GET', attr='json'):
-    # Make sure our User Agent is what's set, and ensure it's sent even if no headers are passed
-    if headers == None:
-        headers = {}
-    headers['User-Agent'] = config.user_agent
+    try:
+        key = (method.upper(), url, attr, tuple(sorted((payload or {}).items())))
+        hash(key)
+    except TypeError:
+        # Paramaters that can't be hashed (such as a list) just aren't cached
+        return await make()
+
+    return await response_cache.fetch(key, urllib.parse.urlsplit(url).hostname, cache_ttl, make)
+
+
+async def _request(url, *, headers=None, payload=None, method='GET', attr='json', timeout=None, deadline=None,
+                   priority=INTERACTIVE, reader=None):
+    # reader is a coroutine given the successful response, that returns what it wants from it (instead of attr)
+    # Our User Agent is sent by the shared client on every request, these headers are just added onto it
+    policy = retry_policy
+    host = urllib.parse.urlsplit(url).hostname
+    timeout = timeout or policy.timeout
+    loop = asyncio.get_event_loop()
+    give_up_at = loop.time() + (deadline or policy.deadline)
+
+    attempt = 0
+    while True:
+        retry_after = None
+        # Wait for our turn under the host's rate limit, which shouldn't count against the attempt's timeout
+        # But can't go past the deadline
+        try:
+            await asyncio.wait_for(http_client.limiter.acquire(host, priority), give_up_at - loop.time())
+        except asyncio.TimeoutError:
+            policy.hosts[host]['gave_up'] += 1
+            return None
 
-    # Try 5 times
-    for i in range(5):
         try:
-            # Create the session with our headeres
-            with aiohttp.ClientSession(headers=headers) as session:
+            # Each attempt gets its timeout, but never more than what's left of the deadline
+            with aiohttp.Timeout(min(timeout, give_up_at - loop.time())):
                 # Make the request, based on the method, url, and paramaters given
-                async with session.request(method, url, params=payload) as response:
-                    # If the request wasn't successful, re-attempt
-                    if response.status != 200:
-                        continue
-
-                    try:
-                        # Get the attribute requested
-                        return_value = getattr(response, attr)
-                        # Next check if this can be called
-                        if callable(return_value):
-                            return_value = return_value()
-                        # If this is awaitable, await it
-                        if inspect.isawaitable(return_value):
-                            return_value = await return_value
-
-                        # Then return it
-                        return return_value
-                    except AttributeError:
-                        # If an invalid attribute was requested, return None
+                # This goes through the shared client, so the connection to this host is reused if we have one open
+                async with http_client.request(method, url, priority=None, headers=headers,
+                                               params=payload) as response:
+                    if response.status == 200:
+                        if reader is not None:
+                            return await reader(response)
+                        return await _response_attr(response, attr)
+                    # Only a server error might go differently if we ask again, anything else won't
+                    if not policy.retryable(response.status):
                         return None
-        # If an error was hit other than the one we want to catch, try again
-        except:
-            continue
+                    retry_after = policy.retry_after(response)
+        except asyncio.TimeoutError:
+            policy.hosts[host]['timeouts'] += 1
+        except aiohttp.ClientConnectionError:
+            # The connection was refused or dropped, which is as likely to be temporary as a timeout
+            policy.hosts[host]['errors'] += 1
+        except aiohttp.ClientError:
+            # Anything else (such as a response we couldn't read) isn't going to change by trying again
+            policy.hosts[host]['errors'] += 1
+            return None
+
+        # Make sure there's enough time left to wait, and then try again
+        delay = policy.delay(attempt, retry_after)
+        if not policy.can_retry(method, attempt) or loop.time() + delay >= give_up_at:
+            policy.hosts[host]['gave_up'] += 1
+            return None
+        policy.hosts[host]['retries'] += 1
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def _response_attr(response, attr):
+    try:
+        # Get the attribute requested
+        return_value = getattr(response, attr)
+        # Next check if this can be called
+        if callable(return_value):
+            return_value = return_value()
+        # If this is awaitable, await it
+        if inspect.isawaitable(return_value):
+            return_value = await return_value
+
+        # Then return it
+        return return_value
+    except AttributeError:
+        # If an invalid attribute was requested, return None
+        return None
+    except ValueError:
+        # The response wasn't valid json
+        return None
 
 
 async def update_records(key, winner, loser):
     # We're using the Harkness scale to rate
     # http://opnetchessclub.wikidot.com/harkness-rating-system
-    r_filter = lambda row: (row['member_id'] == str(winner.id)) | (row['member_id'] == str(loser.id))
-    matches = await config.filter_content(key, r_filter)
+    matches = await config.get_all_content(key, 'member_id', str(winner.id), str(loser.id), primary=True)
 
     winner_stats = {}
     loser_stats = {}
@@ -183,9 +293,4 @@ async def update_records(key, winner, loser):
     winner_stats = {'wins': winner_wins, 'losses': winner_losses, 'rating': winner_rating}
     loser_stats = {'wins': loser_wins, 'losses': loser_losses, 'rating': loser_rating}
 
-    if not await config.update_content(key, winner_stats, winner.id):
-        winner_stats['member_id'] = winner.id
-        await config.add_content(key, winner_stats)
-    if not await config.update_content(key, loser_stats, loser.id):
-        loser_stats['member_id'] = loser.id
-        await config.add_content(key, loser_stats)
+    await config.bulk_update_content(key, {winner.id: winner_stats, loser.id: loser_stats}, upsert=True)
@@ -0,0 +1,15 @@
+import os
+import sys
+import tempfile
+
+# cogs.utils reads config.yml from the directory it's imported from, so give it a minimal one to read
+# That uses the memory backend without a db_path, so nothing is saved anywhere
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+config_dir = tempfile.mkdtemp()
+with open(os.path.join(config_dir, 'config.yml'), 'w') as f:
+    f.write("bot_token: 'test'\n"
+            "owner_id: []\n"
+            "db_backend: 'memory'\n")
+os.chdir(config_dir)
@@ -0,0 +1,48 @@
+import asyncio
+
+from cogs.utils.http_client import HTTPClient
+
+
+class FakeResponse:
+    def __init__(self, released):
+        self.released = released
+
+    async def __aenter__(self):
+        # Requests to the busy host don't finish until we let them
+        await self.released.wait()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+
+class FakeSession:
+    closed = False
+
+    def __init__(self):
+        self.released = {'busy.example.com': asyncio.Event(), 'other.example.com': asyncio.Event()}
+        self.released['other.example.com'].set()
+
+    def request(self, method, url, **kwargs):
+        return FakeResponse(self.released[url.split('/')[2]])
+
+
+async def _get(client, url):
+    async with client.get(url, priority=None) as response:
+        return response
+
+
+def test_busy_host_does_not_block_other_hosts():
+    loop = asyncio.get_event_loop()
+    client = HTTPClient(limit=3, limit_per_host=2)
+    client._session = session = FakeSession()
+
+    # Two of these are being made, and the rest are waiting for the busy host
+    busy = [loop.create_task(_get(client, 'http://busy.example.com/')) for _ in range(5)]
+    loop.run_until_complete(asyncio.sleep(0.01))
+
+    # If the ones waiting held onto a slot, there wouldn't be one left for this
+    loop.run_until_complete(asyncio.wait_for(_get(client, 'http://other.example.com/'), 1))
+
+    session.released['busy.example.com'].set()
+    loop.run_until_complete(asyncio.wait_for(asyncio.gather(*busy), 1))